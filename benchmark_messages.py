@@ -0,0 +1,86 @@
+"""消息广播路径基准测试：对比pydantic Message、MessageRecord逐客户端序列化以及缓存帧只序列化一次
+三种方式在构造和向多个WebSocket客户端发送时的CPU与内存分配
+
+    python benchmark_messages.py --messages 20000 --clients 5
+"""
+import argparse
+import json
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+from typing import Callable, Dict
+
+from main import Message, MessageRecord, MessageType, RoleType
+
+CONTENT = "这是一个用于基准测试的AI回复，包含一段典型长度的中文内容。" * 20
+
+
+def pydantic_broadcast(clients: int):
+    message = Message(
+        id=str(uuid.uuid4()),
+        role=RoleType.PRODUCT_AI,
+        message_type=MessageType.AI_RESPONSE,
+        content=CONTENT,
+        timestamp=datetime.now()
+    )
+    for _ in range(clients):
+        json.dumps({"type": "new_message", "message": message.model_dump(mode="json")})
+    return message
+
+
+def record_broadcast(clients: int):
+    message = MessageRecord(RoleType.PRODUCT_AI, MessageType.AI_RESPONSE, CONTENT)
+    for _ in range(clients):
+        json.dumps({"type": "new_message", "message": message.to_dict()})
+    return message
+
+
+def frame_broadcast(clients: int):
+    message = MessageRecord(RoleType.PRODUCT_AI, MessageType.AI_RESPONSE, CONTENT)
+    frame = message.frame()
+    for _ in range(clients):
+        len(frame)  # 各客户端发送同一个字符串
+    return message
+
+
+def measure(broadcast: Callable[[int], object], messages: int, clients: int) -> Dict[str, float]:
+    start = time.perf_counter()
+    for _ in range(messages):
+        broadcast(clients)
+    cpu_us = (time.perf_counter() - start) / messages * 1e6
+
+    # 分配：广播过程中的峰值，以及消息本身留在内存中（热窗口）的大小
+    tracemalloc.start()
+    kept = [broadcast(clients) for _ in range(messages)]
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return {
+        "cpu_us_per_broadcast": round(cpu_us, 2),
+        "retained_bytes_per_message": round(retained / messages),
+        "peak_bytes_per_message": round(peak / messages),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="消息广播路径基准测试")
+    parser.add_argument("--messages", type=int, default=20000, help="每种实现广播的消息数")
+    parser.add_argument("--clients", type=int, default=5, help="每条消息发送的WebSocket客户端数")
+    args = parser.parse_args()
+
+    results = {
+        "pydantic": measure(pydantic_broadcast, args.messages, args.clients),
+        "record": measure(record_broadcast, args.messages, args.clients),
+        "frame": measure(frame_broadcast, args.messages, args.clients),
+    }
+    baseline = results["pydantic"]
+    results["reduction"] = {
+        name: {key: f"{1 - results[name][key] / baseline[key]:.0%}" for key in baseline}
+        for name in ("record", "frame")
+    }
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
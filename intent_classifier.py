@@ -0,0 +1,241 @@
+"""本地话语类型分类器：基于字符n-gram的多项式朴素贝叶斯，用于在本地快速判别话语类型
+
+训练：
+    python intent_classifier.py train --data data/intent_examples.jsonl --out intent_model.json
+评估（留一交叉验证）：
+    python intent_classifier.py evaluate --data data/intent_examples.jsonl
+预测：
+    python intent_classifier.py predict --model intent_model.json "为什么要这样设计"
+
+另有基于嵌入向量的最近质心分类器（CentroidClassifier），样本嵌入由服务端调用Ollama /api/embed生成，
+保存为.npy文件并以mmap方式加载
+"""
+import argparse
+import json
+import math
+import re
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+_PUNCTUATION = re.compile(r"[\s，。！？、；：“”‘’（）《》…,.!?;:'\"()\[\]<>~～-]+")
+
+
+class IntentPrediction:
+    __slots__ = ("label", "confidence", "scores")
+
+    def __init__(self, label: str, confidence: float, scores: Dict[str, float]):
+        self.label = label
+        self.confidence = confidence
+        self.scores = scores
+
+    def to_dict(self) -> Dict:
+        return {"label": self.label, "confidence": self.confidence, "scores": self.scores}
+
+
+class IntentClassifier:
+    """字符n-gram多项式朴素贝叶斯分类器，置信度为各类别后验概率的最大值"""
+
+    def __init__(self, min_n: int = 1, max_n: int = 3, alpha: float = 0.5):
+        self.min_n = min_n
+        self.max_n = max_n
+        self.alpha = alpha
+        self.class_counts: Dict[str, int] = {}
+        self.feature_counts: Dict[str, Dict[str, int]] = {}
+        self.total_features: Dict[str, int] = {}
+        self.vocabulary: set = set()
+
+    def features(self, text: str) -> List[str]:
+        # 以^和$标记首尾，使"好的"这类短句的整句特征与句中出现区分开
+        normalized = "^" + _PUNCTUATION.sub(" ", text.lower()).strip() + "$"
+        grams = []
+        for n in range(self.min_n, self.max_n + 1):
+            for i in range(len(normalized) - n + 1):
+                gram = normalized[i:i + n]
+                if gram.strip():
+                    grams.append(gram)
+        return grams
+
+    def fit(self, examples: List[Tuple[str, str]]) -> "IntentClassifier":
+        self.class_counts = {}
+        self.feature_counts = {}
+        self.total_features = {}
+        self.vocabulary = set()
+        for text, label in examples:
+            self.class_counts[label] = self.class_counts.get(label, 0) + 1
+            counts = self.feature_counts.setdefault(label, {})
+            for gram in self.features(text):
+                counts[gram] = counts.get(gram, 0) + 1
+                self.total_features[label] = self.total_features.get(label, 0) + 1
+                self.vocabulary.add(gram)
+        return self
+
+    def predict(self, text: str) -> Optional[IntentPrediction]:
+        if not self.class_counts:
+            return None
+        grams = self.features(text)
+        total_examples = sum(self.class_counts.values())
+        vocabulary_size = len(self.vocabulary) + 1
+        log_scores = {}
+        for label, class_count in self.class_counts.items():
+            counts = self.feature_counts.get(label, {})
+            denominator = math.log(self.total_features.get(label, 0) + self.alpha * vocabulary_size)
+            score = math.log(class_count / total_examples)
+            for gram in grams:
+                score += math.log(counts.get(gram, 0) + self.alpha) - denominator
+            log_scores[label] = score
+
+        # softmax得到后验概率
+        best = max(log_scores.values())
+        exp_scores = {label: math.exp(score - best) for label, score in log_scores.items()}
+        total = sum(exp_scores.values())
+        probabilities = {label: value / total for label, value in exp_scores.items()}
+        label = max(probabilities, key=probabilities.get)
+        return IntentPrediction(label, probabilities[label], probabilities)
+
+    def to_dict(self) -> Dict:
+        return {
+            "min_n": self.min_n,
+            "max_n": self.max_n,
+            "alpha": self.alpha,
+            "class_counts": self.class_counts,
+            "feature_counts": self.feature_counts,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "IntentClassifier":
+        classifier = cls(data["min_n"], data["max_n"], data["alpha"])
+        classifier.class_counts = data["class_counts"]
+        classifier.feature_counts = data["feature_counts"]
+        classifier.total_features = {label: sum(counts.values()) for label, counts in classifier.feature_counts.items()}
+        classifier.vocabulary = {gram for counts in classifier.feature_counts.values() for gram in counts}
+        return classifier
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str) -> "IntentClassifier":
+        with open(path, "r", encoding="utf-8") as f:
+            return cls.from_dict(json.load(f))
+
+
+class CentroidClassifier:
+    """嵌入向量最近质心分类器：各类别样本嵌入的均值归一化后作为质心，
+    判别只需一次矩阵-向量点积，置信度为相似度经温度缩放后softmax的最大值"""
+
+    def __init__(self, labels: List[str], centroids: np.ndarray, temperature: float = 0.05):
+        self.labels = labels
+        self.centroids = centroids
+        self.temperature = temperature
+
+    @classmethod
+    def from_embeddings(cls, embeddings: np.ndarray, labels: List[str], temperature: float = 0.05) -> "CentroidClassifier":
+        label_array = np.asarray(labels)
+        unique_labels = sorted(set(labels))
+        normalized = _normalize(np.asarray(embeddings, dtype=np.float32))
+        centroids = np.stack([normalized[label_array == label].mean(axis=0) for label in unique_labels])
+        return cls(unique_labels, _normalize(centroids), temperature)
+
+    def predict(self, vector: np.ndarray) -> IntentPrediction:
+        similarities = self.centroids @ _normalize(np.asarray(vector, dtype=np.float32))
+        scaled = similarities / self.temperature
+        probabilities = np.exp(scaled - scaled.max())
+        probabilities /= probabilities.sum()
+        best = int(probabilities.argmax())
+        return IntentPrediction(self.labels[best], float(probabilities[best]),
+                                {label: float(p) for label, p in zip(self.labels, probabilities)})
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def save_embeddings(path: str, embeddings: np.ndarray, meta: Dict):
+    """嵌入矩阵保存为.npy，标签、模型等元数据保存在同名的.json文件中"""
+    with open(path, "wb") as f:
+        np.save(f, np.asarray(embeddings, dtype=np.float32))
+    with open(path + ".json", "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+
+
+def load_embeddings(path: str) -> Tuple[np.ndarray, Dict]:
+    """以mmap方式加载嵌入矩阵，不把整个文件读入内存"""
+    with open(path + ".json", "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    return np.load(path, mmap_mode="r"), meta
+
+
+def load_examples(path: str) -> List[Tuple[str, str]]:
+    """读取JSONL格式的标注数据，每行形如 {"text": "...", "label": "1"}"""
+    examples = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            examples.append((record["text"], str(record["label"])))
+    return examples
+
+
+def evaluate(examples: List[Tuple[str, str]], threshold: float = 0.0) -> Dict:
+    """留一交叉验证，返回准确率以及置信度不低于阈值时的覆盖率和准确率"""
+    correct = covered = covered_correct = 0
+    for i, (text, label) in enumerate(examples):
+        classifier = IntentClassifier().fit(examples[:i] + examples[i + 1:])
+        prediction = classifier.predict(text)
+        if prediction is None:
+            continue
+        correct += prediction.label == label
+        if prediction.confidence >= threshold:
+            covered += 1
+            covered_correct += prediction.label == label
+    total = len(examples)
+    return {
+        "examples": total,
+        "accuracy": correct / total if total else 0.0,
+        "threshold": threshold,
+        "coverage": covered / total if total else 0.0,
+        "covered_accuracy": covered_correct / covered if covered else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地话语类型分类器")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    train_parser = subparsers.add_parser("train", help="从标注数据训练模型")
+    train_parser.add_argument("--data", nargs="+", required=True, help="JSONL标注数据文件，可以指定多个")
+    train_parser.add_argument("--out", default="intent_model.json", help="模型输出路径")
+    train_parser.add_argument("--alpha", type=float, default=0.5, help="加法平滑系数")
+    train_parser.add_argument("--max-n", type=int, default=3, help="字符n-gram的最大长度")
+
+    evaluate_parser = subparsers.add_parser("evaluate", help="留一交叉验证")
+    evaluate_parser.add_argument("--data", nargs="+", required=True, help="JSONL标注数据文件，可以指定多个")
+    evaluate_parser.add_argument("--threshold", type=float, default=0.99, help="置信度阈值")
+
+    predict_parser = subparsers.add_parser("predict", help="预测一句话的类型")
+    predict_parser.add_argument("--model", default="intent_model.json", help="模型路径")
+    predict_parser.add_argument("text", help="待判别的话语")
+
+    args = parser.parse_args()
+
+    if args.command == "predict":
+        prediction = IntentClassifier.load(args.model).predict(args.text)
+        print(json.dumps(prediction.to_dict() if prediction else None, ensure_ascii=False, indent=2))
+        return
+
+    examples = [example for path in args.data for example in load_examples(path)]
+    if args.command == "train":
+        classifier = IntentClassifier(max_n=args.max_n, alpha=args.alpha).fit(examples)
+        classifier.save(args.out)
+        print(f"已使用 {len(examples)} 条样本训练模型，保存到 {args.out}")
+    else:
+        print(json.dumps(evaluate(examples, args.threshold), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
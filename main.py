@@ -1,24 +1,153 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
 from contextlib import asynccontextmanager
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 import json
 import asyncio
 import httpx
+import numpy as np
 from datetime import datetime
 import uuid
 from enum import Enum
 import logging
 import socket
 import random
+import os
+import re
+import contextvars
+import base64
+import hashlib
+import heapq
+import zlib
+import sqlite3
+import tempfile
+from intent_classifier import (CentroidClassifier, IntentClassifier, IntentPrediction, load_embeddings,
+                               load_examples, save_embeddings)
+import time
+from collections import OrderedDict, deque
+from bisect import bisect_left
+
+# Ollama连接配置
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+# 多个Ollama主机以逗号分隔，未配置时只使用OLLAMA_BASE_URL；可用"url|N"单独指定某台主机的并发上限
+OLLAMA_HOSTS = [host.strip() for host in os.getenv("OLLAMA_HOSTS", OLLAMA_BASE_URL).split(",") if host.strip()]
+OLLAMA_HEALTH_CHECK_INTERVAL = float(os.getenv("OLLAMA_HEALTH_CHECK_INTERVAL", "15"))
+# 每台主机同时处理的请求数上限，应与该主机的OLLAMA_NUM_PARALLEL一致
+OLLAMA_MAX_CONCURRENCY = int(os.getenv("OLLAMA_MAX_CONCURRENCY", "2"))
+# 排队每满该秒数，请求的有效优先级提升一级，避免低优先级请求饿死
+OLLAMA_PRIORITY_AGING_SECONDS = float(os.getenv("OLLAMA_PRIORITY_AGING_SECONDS", "10"))
+OLLAMA_MAX_CONNECTIONS = int(os.getenv("OLLAMA_MAX_CONNECTIONS", "32"))
+OLLAMA_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OLLAMA_MAX_KEEPALIVE_CONNECTIONS", "16"))
+OLLAMA_KEEPALIVE_EXPIRY = float(os.getenv("OLLAMA_KEEPALIVE_EXPIRY", "300"))
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "10"))
+# 是否以流式方式从Ollama读取回复，并向WebSocket客户端推送增量
+OLLAMA_STREAMING = os.getenv("OLLAMA_STREAMING", "1") == "1"
+# 弹性策略：按端点延迟分位数自适应超时、带抖动的有限重试、按主机熔断
+OLLAMA_TIMEOUT_MIN = float(os.getenv("OLLAMA_TIMEOUT_MIN", "60"))
+OLLAMA_TIMEOUT_MAX = float(os.getenv("OLLAMA_TIMEOUT_MAX", "1000"))
+OLLAMA_TIMEOUT_MULTIPLIER = float(os.getenv("OLLAMA_TIMEOUT_MULTIPLIER", "3"))
+OLLAMA_TIMEOUT_MIN_SAMPLES = int(os.getenv("OLLAMA_TIMEOUT_MIN_SAMPLES", "10"))
+OLLAMA_MAX_RETRIES = int(os.getenv("OLLAMA_MAX_RETRIES", "2"))
+OLLAMA_RETRY_BACKOFF = float(os.getenv("OLLAMA_RETRY_BACKOFF", "0.5"))
+OLLAMA_BREAKER_THRESHOLD = int(os.getenv("OLLAMA_BREAKER_THRESHOLD", "5"))
+OLLAMA_BREAKER_COOLDOWN = float(os.getenv("OLLAMA_BREAKER_COOLDOWN", "30"))
+
+# 提示词布局：stable_prefix 将角色前言和对话历史放在前面、本轮指令放在末尾，以复用Ollama的KV缓存；
+# system_first 为旧布局，每轮指令放在system位置
+PROMPT_LAYOUT = os.getenv("PROMPT_LAYOUT", "stable_prefix")
+
+# 模型常驻时长（传给Ollama的keep_alive），以及定期续期的间隔秒数
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+OLLAMA_KEEP_ALIVE_INTERVAL = float(os.getenv("OLLAMA_KEEP_ALIVE_INTERVAL", "240"))
+
+# 话语类型判别结果缓存
+DISCRIMINATION_CACHE_SIZE = int(os.getenv("DISCRIMINATION_CACHE_SIZE", "2048"))
+DISCRIMINATION_CACHE_TTL = float(os.getenv("DISCRIMINATION_CACHE_TTL", "86400"))
+DISCRIMINATION_CACHE_PATH = os.getenv("DISCRIMINATION_CACHE_PATH", "")  # 为空时只缓存在内存中
+
+# 话语类型判别的约束解码：限制生成长度并用JSON schema把输出约束为单个选项数字
+DISCRIMINATION_NUM_PREDICT = int(os.getenv("DISCRIMINATION_NUM_PREDICT", "1"))
+DISCRIMINATION_USE_FORMAT = os.getenv("DISCRIMINATION_USE_FORMAT", "1") == "1"
+
+# 判别请求微批处理：在等待窗口内到达的判别请求合并为一次LLM调用，等待时间为0时关闭
+DISCRIMINATION_BATCH_MAX_SIZE = int(os.getenv("DISCRIMINATION_BATCH_MAX_SIZE", "8"))
+DISCRIMINATION_BATCH_MAX_WAIT_MS = float(os.getenv("DISCRIMINATION_BATCH_MAX_WAIT_MS", "5"))
+
+# 按调用类型路由模型：话语判别、各角色、总结可以分别指定模型与Ollama options
+MODEL_ROUTES_PATH = os.getenv("MODEL_ROUTES_PATH", "model_routes.json")
+
+# 消息存储：内存中只保留最近的热窗口，更早的消息只保存在会话数据库中
+MESSAGE_HOT_WINDOW = int(os.getenv("MESSAGE_HOT_WINDOW", "200"))
+MESSAGE_SPILL_BATCH = int(os.getenv("MESSAGE_SPILL_BATCH", "50"))
+
+# 会话持久化：SQLite WAL模式，短时间窗口内产生的写入合并为一个事务提交
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "orchestra_sessions.db")  # 为空时使用临时文件，重启后不保留
+SESSION_DB_COMMIT_INTERVAL = float(os.getenv("SESSION_DB_COMMIT_INTERVAL", "0.05"))
+SESSION_DB_MAX_BATCH = int(os.getenv("SESSION_DB_MAX_BATCH", "500"))
+
+# 自上次总结后累计的消息数达到该值时在后台生成新总结，对话上下文只发送总结和之后的消息；0表示关闭
+SUMMARY_TRIGGER_MESSAGES = int(os.getenv("SUMMARY_TRIGGER_MESSAGES", "30"))
+
+# 多会话：会话表按id分片
+SESSION_SHARDS = int(os.getenv("SESSION_SHARDS", "16"))
+# 空闲会话淘汰：没有连接和进行中的轮次、空闲超过该时间的会话从内存移除，再次访问时从磁盘恢复
+SESSION_IDLE_SECONDS = float(os.getenv("SESSION_IDLE_SECONDS", "900"))
+# 常驻会话消息的估算内存上限，超出时按最近最少使用的顺序提前淘汰空闲会话
+SESSION_MEMORY_BUDGET_MB = float(os.getenv("SESSION_MEMORY_BUDGET_MB", "256"))
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", "30"))
+
+# 重连补发：客户端落后不超过该条数时只补发缺失的消息
+WS_REPLAY_LIMIT = int(os.getenv("WS_REPLAY_LIMIT", "500"))
+# 新连接只发送最近的少量消息，更早的历史由客户端按游标分页加载
+WS_INITIAL_SNAPSHOT = int(os.getenv("WS_INITIAL_SNAPSHOT", "20"))
+HISTORY_PAGE_LIMIT = int(os.getenv("HISTORY_PAGE_LIMIT", "50"))
+HISTORY_PAGE_MAX = int(os.getenv("HISTORY_PAGE_MAX", "200"))
+# 按类型过滤历史时单次请求最多向前扫描的消息数，不足一页时返回游标由客户端继续翻页
+HISTORY_SCAN_LIMIT = int(os.getenv("HISTORY_SCAN_LIMIT", "1000"))
+
+# 推测执行：判别话语类型的同时按预测分支提前生成产品AI回复，预测正确则直接采用
+SPECULATIVE_PRODUCT_AI = os.getenv("SPECULATIVE_PRODUCT_AI", "0") == "1"
+
+# 本地话语类型分类器：置信度达到阈值时直接采用，否则回退到LLM
+INTENT_CLASSIFIER_ENABLED = os.getenv("INTENT_CLASSIFIER_ENABLED", "1") == "1"
+INTENT_MODEL_PATH = os.getenv("INTENT_MODEL_PATH", "intent_model.json")
+INTENT_EXAMPLES_PATH = os.getenv("INTENT_EXAMPLES_PATH", "data/intent_examples.jsonl")  # 没有模型文件时用于启动时训练
+INTENT_CONFIDENCE_THRESHOLD = float(os.getenv("INTENT_CONFIDENCE_THRESHOLD", "0.99"))
+# 本地高置信度结果中抽样交给LLM复核的比例，用于统计一致率
+INTENT_SHADOW_RATE = float(os.getenv("INTENT_SHADOW_RATE", "0.1"))
+INTENT_FEEDBACK_PATH = os.getenv("INTENT_FEEDBACK_PATH", "")  # 记录LLM判别结果，可作为再训练的标注数据
+
+# 嵌入最近质心分类器：指定嵌入模型后启用，样本嵌入缓存在.npy文件中并以mmap方式加载
+INTENT_EMBEDDING_MODEL = os.getenv("INTENT_EMBEDDING_MODEL", "")  # 如 nomic-embed-text，为空时关闭
+INTENT_EMBEDDINGS_PATH = os.getenv("INTENT_EMBEDDINGS_PATH", "intent_embeddings.npy")
+INTENT_EMBEDDING_THRESHOLD = float(os.getenv("INTENT_EMBEDDING_THRESHOLD", "0.9"))
+INTENT_EMBEDDING_TEMPERATURE = float(os.getenv("INTENT_EMBEDDING_TEMPERATURE", "0.05"))
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    await orchestra_state.initialize_model()
-    yield
+    await session_db.start()
+    await ollama_client.start()
+    await ollama_backends.start()
+    await session_registry.initialize_default_model()
+    await session_registry.start()
+    model_router.load()
+    await model_warmer.start()
+    await discrimination_cache.load()
+    intent_service.load()
+    await embedding_intent.load()
+    try:
+        yield
+    finally:
+        await discrimination_cache.close()
+        await intent_service.stop()
+        await model_warmer.stop()
+        await ollama_backends.stop()
+        await ollama_client.close()
+        await session_registry.stop()
+        await session_db.close()
 
 app = FastAPI(title="OrchestraAI", description="Multi-AI Collaboration Platform", lifespan=lifespan)
 
@@ -57,44 +186,1663 @@ class MessageType(str, Enum):
     ERROR = "error"
 
 class Message(BaseModel):
+    """对外接口中的消息格式，进程内部使用MessageRecord"""
     id: str
     role: RoleType
     message_type: MessageType
     content: str
     timestamp: datetime
     metadata: Optional[Dict[str, Any]] = None
+    seq: int = 0  # 会话内单调递增的序号，写入消息存储时分配
+
+class MessagePage(BaseModel):
+    messages: List[Message]
+    last_seq: int
+
+class HistoryPage(MessagePage):
+    next_cursor: Optional[str] = None  # 为空表示没有更早的消息
+
+class MessageRecord:
+    """进程内的紧凑消息记录，用于消息存储和广播路径：__slots__没有实例字典，
+    角色和类型直接引用枚举成员而不是各自持有字符串，时间戳保存为float。
+    构造时不做校验，只在对外接口（WebSocket帧、HTTP响应、数据库）处转换为与Message相同格式的字典。
+    写入消息存储后记录不再修改，其JSON只生成一次并缓存，广播、重连补发、历史查询和数据库共用"""
+
+    __slots__ = ("seq", "id", "role", "message_type", "content", "timestamp", "metadata", "_json")
+
+    def __init__(self, role: RoleType, message_type: MessageType, content: str,
+                 metadata: Optional[Dict[str, Any]] = None, id: Optional[str] = None,
+                 timestamp: Optional[float] = None, seq: int = 0):
+        self.seq = seq  # 会话内单调递增的序号，写入消息存储时分配
+        self.id = id or str(uuid.uuid4())
+        self.role = role
+        self.message_type = message_type
+        self.content = content
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.metadata = metadata
+        self._json: Optional[str] = None
+
+    def assign_seq(self, seq: int):
+        self.seq = seq
+        self._json = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        """与Message.model_dump(mode="json")的结果相同"""
+        return {
+            "id": self.id,
+            "role": self.role.value,
+            "message_type": self.message_type.value,
+            "content": self.content,
+            "timestamp": datetime.fromtimestamp(self.timestamp).isoformat(),
+            "metadata": self.metadata,
+            "seq": self.seq,
+        }
+
+    def to_json(self) -> str:
+        if self._json is None:
+            self._json = json.dumps(self.to_dict(), ensure_ascii=False)
+        return self._json
+
+    def frame(self) -> str:
+        """new_message事件的WebSocket帧，在缓存的消息JSON外拼接一层"""
+        return '{"type": "new_message", "message": ' + self.to_json() + '}'
+
+    @classmethod
+    def from_json(cls, data: str) -> "MessageRecord":
+        # 数据库中的记录由本进程写入，不再经过pydantic校验；原始JSON直接作为缓存
+        fields = json.loads(data)
+        record = cls(RoleType(fields["role"]), MessageType(fields["message_type"]), fields["content"],
+                     fields.get("metadata"), fields["id"], datetime.fromisoformat(fields["timestamp"]).timestamp(),
+                     fields.get("seq", 0))
+        record._json = data
+        return record
+
+
+def dumps_with_messages(payload: Dict[str, Any], messages: List[MessageRecord]) -> str:
+    """把消息列表以缓存的JSON拼接进payload，不再逐条序列化"""
+    head = json.dumps(payload, ensure_ascii=False)
+    return head[:-1] + ', "messages": [' + ", ".join(message.to_json() for message in messages) + ']}'
+
+class OllamaHTTPClient:
+    """进程内共享的Ollama HTTP客户端，由lifespan负责创建和关闭，复用keep-alive连接"""
 
-class OrchestraState:
     def __init__(self):
-        self.messages: List[Message] = []
-        self.websocket_connections: List[WebSocket] = []
-        self.selected_model: str = ""
-        self.conversation_summaries: Dict[str, str] = {}  # 各阶段的对话总结
-        
-    async def initialize_model(self):
-        """初始化选择第一个可用模型"""
-        if not self.selected_model:
+        self.client: Optional[httpx.AsyncClient] = None
+        self.closed = False
+        self.requests_total = 0
+        self.requests_failed = 0
+        self.requests_in_flight = 0
+        self.max_in_flight = 0
+
+    def _create_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=OLLAMA_MAX_CONNECTIONS,
+                max_keepalive_connections=OLLAMA_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=OLLAMA_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(1000.0, connect=OLLAMA_CONNECT_TIMEOUT),
+        )
+
+    async def start(self):
+        self.closed = False
+        if self.client is None:
+            self.client = self._create_client()
+            logger.info(f"Ollama共享客户端已创建 (最大连接数: {OLLAMA_MAX_CONNECTIONS}, 保活连接数: {OLLAMA_MAX_KEEPALIVE_CONNECTIONS})")
+
+    async def close(self):
+        self.closed = True
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+            logger.info("Ollama共享客户端已关闭")
+
+    def get_client(self) -> httpx.AsyncClient:
+        # 关闭后（应用退出过程中）不再重建客户端，避免泄漏无人关闭的连接池
+        if self.closed:
+            raise RuntimeError("Ollama共享客户端已关闭")
+        # lifespan之外（如脚本直接调用）按需创建
+        if self.client is None:
+            self.client = self._create_client()
+        return self.client
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        client = self.get_client()
+        self.requests_total += 1
+        self.requests_in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.requests_in_flight)
+        try:
+            return await client.request(method, url, **kwargs)
+        except Exception:
+            self.requests_failed += 1
+            raise
+        finally:
+            self.requests_in_flight -= 1
+
+    @asynccontextmanager
+    async def stream(self, method: str, url: str, **kwargs):
+        """流式请求，连接在退出上下文时归还连接池"""
+        client = self.get_client()
+        self.requests_total += 1
+        self.requests_in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.requests_in_flight)
+        try:
+            async with client.stream(method, url, **kwargs) as response:
+                yield response
+        except Exception:
+            self.requests_failed += 1
+            raise
+        finally:
+            self.requests_in_flight -= 1
+
+    def _idle_flags(self) -> Optional[List[bool]]:
+        """连接池中各连接是否空闲；依赖httpx的私有属性，版本变化或自定义transport时返回None"""
+        if self.client is None:
+            return []
+        try:
+            pool = getattr(self.client, "_transport", None)
+            pool = getattr(pool, "_pool", None)
+            connections = getattr(pool, "connections", None)
+            if connections is None:
+                return None
+            return [bool(conn.is_idle()) for conn in connections]
+        except Exception:
+            return None
+
+    def stats(self) -> Dict[str, Any]:
+        """连接池统计，用于调整连接池大小；无法读取连接池时connections各项为None"""
+        flags = self._idle_flags()
+        if flags is None:
+            total = idle = active = None
+        else:
+            total, idle = len(flags), sum(flags)
+            active = total - idle
+        return {
+            "started": self.client is not None,
+            "limits": {
+                "max_connections": OLLAMA_MAX_CONNECTIONS,
+                "max_keepalive_connections": OLLAMA_MAX_KEEPALIVE_CONNECTIONS,
+                "keepalive_expiry": OLLAMA_KEEPALIVE_EXPIRY,
+            },
+            "connections": {
+                "total": total,
+                "idle": idle,
+                "active": active,
+            },
+            "requests": {
+                "total": self.requests_total,
+                "failed": self.requests_failed,
+                "in_flight": self.requests_in_flight,
+                "max_in_flight": self.max_in_flight,
+            },
+        }
+
+ollama_client = OllamaHTTPClient()
+
+class OllamaBackendUnavailable(Exception):
+    """没有健康且提供所需模型的Ollama主机"""
+
+class OllamaCircuitOpenError(OllamaBackendUnavailable):
+    """提供所需模型的主机均已熔断或因无法连接被剔除，请求被快速拒绝；错误已在主机状态变化时广播过"""
+
+class CircuitBreaker:
+    """单台主机的熔断器：连续失败达到阈值后打开，冷却后放行一个探测请求（半开），成功则关闭"""
+
+    def __init__(self):
+        self.state = "closed"  # closed / open / half_open
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.opens_total = 0
+
+    def available(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at < OLLAMA_BREAKER_COOLDOWN:
+            return False
+        return not self.probing
+
+    def on_admit(self):
+        if self.state != "closed":
+            self.state = "half_open"
+            self.probing = True
+
+    def on_release(self):
+        # 探测请求被取消而没有结果时回到打开状态，下一个请求可立即探测
+        if self.state == "half_open" and self.probing:
+            self.state = "open"
+            self.probing = False
+
+    def record_success(self):
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.probing = False
+
+    def record_failure(self) -> bool:
+        """记录一次失败，返回熔断器是否因此而打开"""
+        self.consecutive_failures += 1
+        self.probing = False
+        if self.state == "half_open" or (self.state == "closed" and self.consecutive_failures >= OLLAMA_BREAKER_THRESHOLD):
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.opens_total += 1
+            return True
+        return False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "opens_total": self.opens_total,
+            "retry_in": max(0.0, OLLAMA_BREAKER_COOLDOWN - (time.monotonic() - self.opened_at)) if self.state == "open" else 0.0,
+        }
+
+class LatencyTracker:
+    """按端点记录最近的成功请求延迟，超时取p99的若干倍并限制在上下限之间"""
+
+    def __init__(self, max_samples: int = 200):
+        self.max_samples = max_samples
+        self.samples: Dict[str, deque] = {}
+
+    def record(self, endpoint: str, seconds: float):
+        self.samples.setdefault(endpoint, deque(maxlen=self.max_samples)).append(seconds)
+
+    def percentile(self, endpoint: str, q: float) -> Optional[float]:
+        samples = self.samples.get(endpoint)
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def read_timeout(self, endpoint: str) -> float:
+        samples = self.samples.get(endpoint)
+        if not samples or len(samples) < OLLAMA_TIMEOUT_MIN_SAMPLES:
+            return OLLAMA_TIMEOUT_MAX
+        return min(max(self.percentile(endpoint, 0.99) * OLLAMA_TIMEOUT_MULTIPLIER, OLLAMA_TIMEOUT_MIN), OLLAMA_TIMEOUT_MAX)
+
+    def timeout(self, endpoint: str) -> httpx.Timeout:
+        return httpx.Timeout(self.read_timeout(endpoint), connect=OLLAMA_CONNECT_TIMEOUT)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            endpoint: {
+                "samples": len(samples),
+                "p50": self.percentile(endpoint, 0.5),
+                "p95": self.percentile(endpoint, 0.95),
+                "p99": self.percentile(endpoint, 0.99),
+                "timeout": self.read_timeout(endpoint),
+            }
+            for endpoint, samples in self.samples.items()
+        }
+
+def is_retryable_error(error: Exception) -> bool:
+    """只重试请求尚未被Ollama处理的连接级错误"""
+    return isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError))
+
+class OllamaBackend:
+    """单个Ollama主机的状态"""
+
+    def __init__(self, url: str, max_concurrency: int = OLLAMA_MAX_CONCURRENCY):
+        self.url = url
+        self.max_concurrency = max_concurrency
+        self.breaker = CircuitBreaker()
+        self.healthy = True
+        self.models: Optional[List[str]] = None  # None表示尚未获取过/api/tags
+        self.outstanding = 0
+        self.requests_total = 0
+        self.failures_total = 0
+        self.last_error = ""
+        self.last_checked: Optional[datetime] = None
+
+    def serves(self, model: Optional[str]) -> bool:
+        if not model or self.models is None:
+            return True
+        return model in self.models
+
+    def mark_down(self, reason: str) -> bool:
+        """标记为不健康，返回主机是否因此而被剔除（之前是健康的）"""
+        ejected = self.healthy
+        if ejected:
+            logger.warning(f"Ollama主机 {self.url} 已被剔除: {reason}")
+        self.healthy = False
+        self.last_error = reason
+        return ejected
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "models": self.models,
+            "outstanding": self.outstanding,
+            "max_concurrency": self.max_concurrency,
+            "requests_total": self.requests_total,
+            "failures_total": self.failures_total,
+            "last_error": self.last_error,
+            "breaker": self.breaker.stats(),
+            "last_checked": self.last_checked.isoformat() if self.last_checked else None,
+        }
+
+class RequestPriority(int, Enum):
+    """Ollama请求的优先级，数值越小越优先"""
+    INTERACTIVE = 0
+    CLASSIFICATION = 1
+    SUMMARY = 2
+    BATCH = 3
+
+class _Waiter:
+    __slots__ = ("model", "priority", "target", "enqueued_at", "seq", "future")
+
+    def __init__(self, model: Optional[str], priority: RequestPriority, seq: int,
+                 target: Optional["OllamaBackend"] = None):
+        self.model = model
+        self.priority = priority
+        self.target = target  # 指定主机（如预热），为空时由调度器选择
+        self.enqueued_at = time.monotonic()
+        self.seq = seq
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+class OllamaScheduler:
+    """Ollama请求的中心调度器：按优先级准入，限制每台主机的并发数，并通过老化避免低优先级请求饿死"""
+
+    def __init__(self, pool: "OllamaBackendPool"):
+        self.pool = pool
+        self._waiters: List[_Waiter] = []
+        self._seq = 0
+        self.admitted = {p.name.lower(): 0 for p in RequestPriority}
+        self.wait_time_total = {p.name.lower(): 0.0 for p in RequestPriority}
+        self.max_wait_time = {p.name.lower(): 0.0 for p in RequestPriority}
+
+    def _effective_priority(self, waiter: _Waiter, now: float) -> float:
+        return waiter.priority - (now - waiter.enqueued_at) / OLLAMA_PRIORITY_AGING_SECONDS
+
+    def _free_backend(self, model: Optional[str], target: Optional[OllamaBackend] = None) -> Optional[OllamaBackend]:
+        backends = [target] if target is not None else self.pool.backends
+        candidates = [b for b in backends
+                      if b.healthy and b.serves(model) and b.breaker.available() and b.outstanding < b.max_concurrency]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda b: b.outstanding / b.max_concurrency)
+
+    def _unavailable_error(self, model: Optional[str], target: Optional[OllamaBackend] = None) -> Optional[Exception]:
+        """没有任何主机能为该模型服务时返回应抛出的异常，否则返回None（只是暂时繁忙）"""
+        backends = [target] if target is not None else self.pool.backends
+        serving = [b for b in backends if b.serves(model)]
+        if not serving:
+            return OllamaBackendUnavailable(f"没有Ollama主机提供模型: {model}")
+        # 提供该模型的主机都被剔除或熔断：错误已在状态变化时广播，排队和新的请求静默地快速失败
+        if not any(b.healthy and b.breaker.available() for b in serving):
+            return OllamaCircuitOpenError(f"提供模型 {model} 的Ollama主机均已熔断或无法连接")
+        return None
+
+    def _admit(self, backend: OllamaBackend, priority: RequestPriority, waited: float):
+        backend.outstanding += 1
+        backend.breaker.on_admit()
+        name = priority.name.lower()
+        self.admitted[name] += 1
+        self.wait_time_total[name] += waited
+        self.max_wait_time[name] = max(self.max_wait_time[name], waited)
+
+    def _dispatch(self):
+        if not self._waiters:
+            return
+        now = time.monotonic()
+        for waiter in sorted(self._waiters, key=lambda w: (self._effective_priority(w, now), w.seq)):
+            if waiter.future.done():
+                self._waiters.remove(waiter)
+                continue
+            backend = self._free_backend(waiter.model, waiter.target)
+            if backend is None:
+                # 排队期间主机熔断或被剔除，快速失败而不是无限等待
+                error = self._unavailable_error(waiter.model, waiter.target)
+                if error is not None:
+                    self._waiters.remove(waiter)
+                    waiter.future.set_exception(error)
+                continue
+            self._waiters.remove(waiter)
+            self._admit(backend, waiter.priority, now - waiter.enqueued_at)
+            waiter.future.set_result(backend)
+
+    async def acquire(self, model: Optional[str], priority: RequestPriority,
+                      target: Optional[OllamaBackend] = None) -> OllamaBackend:
+        """等待一台提供该模型且有空闲槽位的主机（指定target时只等待该主机），返回时已占用一个槽位"""
+        error = self._unavailable_error(model, target)
+        if error is not None:
+            raise error
+
+        self._seq += 1
+        waiter = _Waiter(model, priority, self._seq, target)
+        self._waiters.append(waiter)
+        self._dispatch()
+        try:
+            return await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                self.release(waiter.future.result())
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+
+    def free_slots(self, model: Optional[str]) -> int:
+        return sum(max(0, b.max_concurrency - b.outstanding) for b in self.pool.backends
+                   if b.healthy and b.serves(model) and b.breaker.available())
+
+    def release(self, backend: OllamaBackend):
+        backend.outstanding -= 1
+        backend.breaker.on_release()
+        self._dispatch()
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        queued = {p.name.lower(): 0 for p in RequestPriority}
+        oldest_wait = {p.name.lower(): 0.0 for p in RequestPriority}
+        for waiter in self._waiters:
+            name = waiter.priority.name.lower()
+            queued[name] += 1
+            oldest_wait[name] = max(oldest_wait[name], now - waiter.enqueued_at)
+        return {
+            "aging_seconds": OLLAMA_PRIORITY_AGING_SECONDS,
+            "queue_depth": len(self._waiters),
+            "queued": queued,
+            "oldest_wait": oldest_wait,
+            "admitted": self.admitted,
+            "avg_wait_time": {
+                name: self.wait_time_total[name] / count if count else 0.0
+                for name, count in self.admitted.items()
+            },
+            "max_wait_time": self.max_wait_time,
+            "backends": {
+                b.url: {"in_flight": b.outstanding, "max_concurrency": b.max_concurrency}
+                for b in self.pool.backends
+            },
+        }
+
+class OllamaBackendPool:
+    """多主机Ollama后端池：按模型筛选主机，经调度器准入后选择负载最低的一台"""
+
+    def __init__(self, hosts: List[str]):
+        self.backends = []
+        for host in hosts:
+            url, _, limit = host.partition("|")
+            self.backends.append(OllamaBackend(url.strip().rstrip("/"), int(limit) if limit else OLLAMA_MAX_CONCURRENCY))
+        self.scheduler = OllamaScheduler(self)
+        self.latency = LatencyTracker()
+        self.retries_total = 0
+        self._health_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        await self.refresh()
+        if self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def stop(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+            self._health_task = None
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(OLLAMA_HEALTH_CHECK_INTERVAL)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Ollama健康检查时发生错误: {str(e)}")
+
+    async def check(self, backend: OllamaBackend):
+        """通过/api/tags检查主机健康并刷新其模型列表"""
+        backend.last_checked = datetime.now()
+        try:
+            response = await ollama_client.request("GET", f"{backend.url}/api/tags", timeout=10.0)
+            if response.status_code == 200:
+                backend.models = [model["name"] for model in response.json().get("models", [])]
+                if not backend.healthy:
+                    logger.info(f"Ollama主机 {backend.url} 已恢复")
+                backend.healthy = True
+                backend.last_error = ""
+            else:
+                await self._mark_down(backend, f"HTTP {response.status_code}")
+        except Exception as e:
+            await self._mark_down(backend, str(e) or type(e).__name__)
+
+    async def refresh(self):
+        await asyncio.gather(*(self.check(backend) for backend in self.backends))
+        # 主机恢复后可能有排队请求可以准入
+        self.scheduler._dispatch()
+
+    def list_models(self) -> List[str]:
+        """所有健康主机上可用模型的并集，保持首次出现的顺序"""
+        models: List[str] = []
+        for backend in self.backends:
+            if backend.healthy and backend.models:
+                models.extend(m for m in backend.models if m not in models)
+        return models
+
+    async def _mark_down(self, backend: OllamaBackend, reason: str) -> bool:
+        if not backend.mark_down(reason):
+            return False
+        await self._announce(f"Ollama主机 {backend.url} 不可用({reason})，已暂停使用，恢复后自动启用")
+        return True
+
+    async def _announce(self, error_msg: str):
+        # 主机被剔除或熔断时只广播一次错误，排队中的请求随后快速失败而不再逐条报错
+        logger.error(error_msg)
+        await broadcast_message_all(RoleType.ETHER, MessageType.ERROR, error_msg)
+
+    async def _record_failure(self, backend: OllamaBackend, reason: str, error: Optional[Exception] = None):
+        backend.failures_total += 1
+        backend.last_error = reason
+        opened = backend.breaker.record_failure()
+        # 连接级错误说明主机不可达，立即剔除，等待健康检查恢复
+        ejected = isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout)) and await self._mark_down(backend, reason)
+        if opened and not ejected:
+            await self._announce(f"Ollama主机 {backend.url} 连续失败({reason})，已熔断 {OLLAMA_BREAKER_COOLDOWN:.0f} 秒")
+        self.scheduler._dispatch()
+
+    @staticmethod
+    def _raise_if_ejected(backend: OllamaBackend, error: Exception):
+        """不再重试的连接错误改为OllamaCircuitOpenError抛出：剔除主机时已广播过错误，调用方不再逐条报错"""
+        if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout)) and not backend.healthy:
+            raise OllamaCircuitOpenError(f"Ollama主机 {backend.url} 无法连接: {str(error) or type(error).__name__}") from error
+
+    def _record_success(self, backend: OllamaBackend, endpoint: str, seconds: float):
+        backend.breaker.record_success()
+        self.latency.record(endpoint, seconds)
+
+    async def _backoff(self, attempt: int):
+        # 全抖动指数退避
+        self.retries_total += 1
+        await asyncio.sleep(random.uniform(0, OLLAMA_RETRY_BACKOFF * (2 ** attempt)))
+
+    async def request(self, method: str, path: str, model: Optional[str] = None,
+                      priority: RequestPriority = RequestPriority.INTERACTIVE,
+                      target: Optional[OllamaBackend] = None, **kwargs) -> httpx.Response:
+        """经调度器准入后发送请求；target指定主机时只发往该主机（如在每台主机上预热模型）"""
+        endpoint = f"{method} {path} {model or ''}".strip()
+        kwargs.setdefault("timeout", self.latency.timeout(endpoint))
+        attempt = 0
+        while True:
+            backend = await self.scheduler.acquire(model, priority, target)
+            backend.requests_total += 1
+            start = time.monotonic()
+            try:
+                response = await ollama_client.request(method, f"{backend.url}{path}", **kwargs)
+            except Exception as e:
+                await self._record_failure(backend, str(e) or type(e).__name__, e)
+                if attempt < OLLAMA_MAX_RETRIES and is_retryable_error(e):
+                    attempt += 1
+                    await self._backoff(attempt)
+                    continue
+                self._raise_if_ejected(backend, e)
+                raise
+            finally:
+                self.scheduler.release(backend)
+
+            if response.status_code >= 500:
+                await self._record_failure(backend, f"HTTP {response.status_code}")
+                if attempt < OLLAMA_MAX_RETRIES:
+                    attempt += 1
+                    await self._backoff(attempt)
+                    continue
+            else:
+                self._record_success(backend, endpoint, time.monotonic() - start)
+            return response
+
+    async def get(self, path: str, model: Optional[str] = None, **kwargs) -> httpx.Response:
+        return await self.request("GET", path, model=model, **kwargs)
+
+    async def post(self, path: str, model: Optional[str] = None, **kwargs) -> httpx.Response:
+        return await self.request("POST", path, model=model, **kwargs)
+
+    @asynccontextmanager
+    async def stream(self, method: str, path: str, model: Optional[str] = None,
+                     priority: RequestPriority = RequestPriority.INTERACTIVE, **kwargs):
+        """流式请求；只在收到响应头之前重试，超时以首字节延迟为准（之后每次读取单独计时）"""
+        endpoint = f"{method} {path} stream {model or ''}".strip()
+        kwargs.setdefault("timeout", self.latency.timeout(endpoint))
+        attempt = 0
+        while True:
+            backend = await self.scheduler.acquire(model, priority)
+            backend.requests_total += 1
+            start = time.monotonic()
+            yielded = False
             try:
-                async with httpx.AsyncClient() as client:
-                    response = await client.get("http://localhost:11434/api/tags", timeout=10.0)
-                    if response.status_code == 200:
-                        data = response.json()
-                        models = [model["name"] for model in data.get("models", [])]
-                        if models:
-                            self.selected_model = models[0]
-                            logger.info(f"自动选择第一个可用模型: {self.selected_model}")
-                        else:
-                            logger.warning("未找到可用的模型")
+                async with ollama_client.stream(method, f"{backend.url}{path}", **kwargs) as response:
+                    if response.status_code >= 500:
+                        await response.aread()
+                        await self._record_failure(backend, f"HTTP {response.status_code}")
+                        if attempt < OLLAMA_MAX_RETRIES:
+                            attempt += 1
+                            await self._backoff(attempt)
+                            continue
                     else:
-                        logger.error(f"获取模型列表失败: {response.status_code}")
+                        self._record_success(backend, endpoint, time.monotonic() - start)
+                    yielded = True
+                    yield response
+                    return
+            except Exception as e:
+                if yielded:
+                    # 响应已交给调用方，只有传输层错误才计入主机失败，且不再重试
+                    if isinstance(e, httpx.TransportError):
+                        await self._record_failure(backend, str(e) or type(e).__name__, e)
+                    raise
+                await self._record_failure(backend, str(e) or type(e).__name__, e)
+                if attempt < OLLAMA_MAX_RETRIES and is_retryable_error(e):
+                    attempt += 1
+                    await self._backoff(attempt)
+                    continue
+                self._raise_if_ejected(backend, e)
+                raise
+            finally:
+                self.scheduler.release(backend)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "health_check_interval": OLLAMA_HEALTH_CHECK_INTERVAL,
+            "backends": [backend.stats() for backend in self.backends],
+        }
+
+    def resilience_stats(self) -> Dict[str, Any]:
+        return {
+            "max_retries": OLLAMA_MAX_RETRIES,
+            "retries_total": self.retries_total,
+            "breakers": {backend.url: backend.breaker.stats() for backend in self.backends},
+            "latency": self.latency.stats(),
+        }
+
+ollama_backends = OllamaBackendPool(OLLAMA_HOSTS)
+
+class OllamaAPIError(Exception):
+    """Ollama返回了非200状态码"""
+
+class SingleFlight:
+    """合并并发的相同请求：同一key在途时，后来者直接共享首个请求的结果。
+    每个key附带一个订阅者列表传给上游请求，等待者可以加入列表接收过程中的推送（如流式增量），离开时自动移除"""
+
+    def __init__(self):
+        self._inflight: Dict[str, Tuple[asyncio.Future, List[Any]]] = {}
+        self._refs: Dict[asyncio.Future, int] = {}
+        self.leaders = 0
+        self.shared = 0
+        self.cancelled = 0
+
+    @staticmethod
+    def make_key(*parts: Any) -> str:
+        payload = json.dumps(parts, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _done(self, key: str, task: asyncio.Future):
+        entry = self._inflight.get(key)
+        if entry is not None and entry[0] is task:
+            del self._inflight[key]
+        # 所有等待者都已离开时，避免"Task exception was never retrieved"
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key: str, fn, subscriber: Any = None):
+        """fn接收该key的订阅者列表；subscriber非空时在等待期间加入列表"""
+        entry = self._inflight.get(key)
+        if entry is None:
+            self.leaders += 1
+            subscribers: List[Any] = []
+            task = asyncio.ensure_future(fn(subscribers))
+            self._inflight[key] = (task, subscribers)
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            task, subscribers = entry
+            self.shared += 1
+            logger.info(f"合并相同的在途请求: {key[:12]}")
+        self._refs[task] = self._refs.get(task, 0) + 1
+        if subscriber is not None:
+            subscribers.append(subscriber)
+        try:
+            # shield保证单个等待者被取消时不会中断其他等待者共享的上游请求
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # 最后一个等待者离开时取消上游请求，让Ollama立即释放槽位
+            if self._refs[task] == 1 and not task.done():
+                task.cancel()
+                self.cancelled += 1
+            raise
+        finally:
+            # 被取消（如用户停止）的等待者不再接收推送，其余等待者不受影响
+            if subscriber is not None:
+                subscribers.remove(subscriber)
+            self._refs[task] -= 1
+            if self._refs[task] == 0:
+                del self._refs[task]
+
+    def waiting(self, key: str) -> bool:
+        """该key的请求是否仍在进行且有等待者"""
+        entry = self._inflight.get(key)
+        return entry is not None and self._refs.get(entry[0], 0) > 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._inflight),
+            "leaders": self.leaders,
+            "shared": self.shared,
+            "cancelled": self.cancelled,
+        }
+
+ollama_singleflight = SingleFlight()
+
+class ResponseCache:
+    """按内容哈希索引的LRU+TTL缓存，按模型划分命名空间，可选持久化为JSON文件"""
+
+    def __init__(self, max_entries: int, ttl: float, path: str = ""):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._save_task: Optional[asyncio.Task] = None
+        self.hits: Dict[str, int] = {}
+        self.misses: Dict[str, int] = {}
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        return f"{model}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+    def get(self, model: str, text: str) -> Optional[str]:
+        key = self.make_key(model, text)
+        entry = self._entries.get(key)
+        if entry is not None and entry["expires_at"] <= time.time():
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            self.misses[model] = self.misses.get(model, 0) + 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits[model] = self.hits.get(model, 0) + 1
+        return entry["value"]
+
+    def put(self, model: str, text: str, value: str):
+        key = self.make_key(model, text)
+        self._entries[key] = {"model": model, "value": value, "expires_at": time.time() + self.ttl}
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        self._schedule_save()
+
+    def clear(self, model: Optional[str] = None):
+        if model is None:
+            self._entries.clear()
+        else:
+            for key in [k for k, v in self._entries.items() if v["model"] == model]:
+                del self._entries[key]
+        self._schedule_save()
+
+    def _schedule_save(self):
+        # 写入合并：5秒内的多次修改只落盘一次
+        if not self.path or (self._save_task is not None and not self._save_task.done()):
+            return
+        try:
+            self._save_task = asyncio.get_running_loop().create_task(self._delayed_save())
+        except RuntimeError:
+            pass
+
+    async def _delayed_save(self):
+        await asyncio.sleep(5)
+        await self.save()
+
+    async def close(self):
+        if self._save_task is not None and not self._save_task.done():
+            self._save_task.cancel()
+        await self.save()
+
+    async def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+            now = time.time()
+            for key, entry in entries.items():
+                if entry["expires_at"] > now:
+                    self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            logger.info(f"从 {self.path} 加载了 {len(self._entries)} 条缓存")
+        except Exception as e:
+            logger.error(f"加载缓存文件 {self.path} 失败: {str(e)}")
+
+    async def save(self):
+        if not self.path:
+            return
+        snapshot = dict(self._entries)
+
+        def write():
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+
+        try:
+            await asyncio.to_thread(write)
+        except Exception as e:
+            logger.error(f"保存缓存文件 {self.path} 失败: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        namespaces: Dict[str, int] = {}
+        for entry in self._entries.values():
+            namespaces[entry["model"]] = namespaces.get(entry["model"], 0) + 1
+        hits = sum(self.hits.values())
+        misses = sum(self.misses.values())
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "persistent": bool(self.path),
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            "evictions": self.evictions,
+            "namespaces": {
+                model: {"entries": count, "hits": self.hits.get(model, 0), "misses": self.misses.get(model, 0)}
+                for model, count in namespaces.items()
+            },
+        }
+
+discrimination_cache = ResponseCache(DISCRIMINATION_CACHE_SIZE, DISCRIMINATION_CACHE_TTL, DISCRIMINATION_CACHE_PATH)
+
+class IntentService:
+    """本地话语类型分类的快速路径，并统计与LLM判别结果的一致率以便调整阈值"""
+
+    def __init__(self):
+        self.classifier: Optional[IntentClassifier] = None
+        self.local_answers = 0
+        self.llm_fallbacks = 0
+        self.shadow_checks = 0
+        self.parse_fallbacks = 0
+        self.unrouted_fallbacks = 0
+        # 按置信度分桶（每0.1一档）统计与LLM的一致情况
+        self.agreement: Dict[str, Dict[str, int]] = {}
+        self._shadow_tasks: set = set()
+
+    def load(self):
+        if not INTENT_CLASSIFIER_ENABLED:
+            return
+        try:
+            if os.path.exists(INTENT_MODEL_PATH):
+                self.classifier = IntentClassifier.load(INTENT_MODEL_PATH)
+                logger.info(f"已加载本地话语分类模型: {INTENT_MODEL_PATH}")
+            elif os.path.exists(INTENT_EXAMPLES_PATH):
+                examples = load_examples(INTENT_EXAMPLES_PATH)
+                self.classifier = IntentClassifier().fit(examples)
+                logger.info(f"已使用 {len(examples)} 条样本训练本地话语分类模型")
+            else:
+                logger.warning("未找到本地话语分类模型或标注数据，话语类型判别将全部使用LLM")
+        except Exception as e:
+            logger.error(f"加载本地话语分类模型失败: {str(e)}")
+
+    def predict(self, text: str) -> Optional[IntentPrediction]:
+        if self.classifier is None:
+            return None
+        return self.classifier.predict(text)
+
+    def is_confident(self, prediction: Optional[IntentPrediction], labels) -> bool:
+        return prediction is not None and prediction.confidence >= INTENT_CONFIDENCE_THRESHOLD and prediction.label in labels
+
+    def shadow_check(self, user_input: str, prompt: str, role: RoleType, prediction: IntentPrediction):
+        """在后台让LLM复核本地判别结果，保留任务引用直到完成"""
+        task = asyncio.create_task(shadow_check_discrimination(user_input, prompt, role, prediction))
+        self._shadow_tasks.add(task)
+        task.add_done_callback(self._shadow_tasks.discard)
+
+    async def stop(self):
+        for task in list(self._shadow_tasks):
+            task.cancel()
+        await asyncio.gather(*self._shadow_tasks, return_exceptions=True)
+
+    async def record_agreement(self, text: str, prediction: IntentPrediction, llm_label: str):
+        bucket = f"{min(int(prediction.confidence * 10), 9) / 10:.1f}"
+        stats = self.agreement.setdefault(bucket, {"compared": 0, "agreed": 0})
+        stats["compared"] += 1
+        stats["agreed"] += prediction.label == llm_label
+        if INTENT_FEEDBACK_PATH:
+            line = json.dumps({
+                "text": text,
+                "label": llm_label,
+                "local_label": prediction.label,
+                "confidence": prediction.confidence
+            }, ensure_ascii=False) + "\n"
+            try:
+                # 文件写入放到线程中，不阻塞事件循环
+                await asyncio.to_thread(self._append_feedback, INTENT_FEEDBACK_PATH, line)
             except Exception as e:
-                logger.error(f"初始化模型时发生错误: {str(e)}")
+                logger.error(f"写入话语分类反馈数据失败: {str(e)}")
+
+    @staticmethod
+    def _append_feedback(path: str, line: str):
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+    def stats(self) -> Dict[str, Any]:
+        compared = sum(b["compared"] for b in self.agreement.values())
+        agreed = sum(b["agreed"] for b in self.agreement.values())
+        return {
+            "enabled": self.classifier is not None,
+            "threshold": INTENT_CONFIDENCE_THRESHOLD,
+            "shadow_rate": INTENT_SHADOW_RATE,
+            "local_answers": self.local_answers,
+            "llm_fallbacks": self.llm_fallbacks,
+            "shadow_checks": self.shadow_checks,
+            "parse_fallbacks": self.parse_fallbacks,
+            "unrouted_fallbacks": self.unrouted_fallbacks,
+            "agreement_rate": agreed / compared if compared else None,
+            "agreement_by_confidence": {
+                bucket: {**stats, "rate": stats["agreed"] / stats["compared"]}
+                for bucket, stats in sorted(self.agreement.items())
+            },
+        }
+
+intent_service = IntentService()
+
+class EmbeddingIntentService:
+    """嵌入最近质心分类：每次判别只需一次/api/embed调用加一次向量点积"""
+
+    EMBED_BATCH_SIZE = 64
+
+    def __init__(self, model: str, path: str):
+        self.model = model
+        self.path = path
+        self.classifier: Optional[CentroidClassifier] = None
+        self.answers = 0
+        self.embed_calls = 0
+        self.embed_failures = 0
+        self.embed_seconds = 0.0
+        self.compared = 0
+        self.agreed = 0
+
+    async def load(self):
+        if not self.model:
+            return
+        try:
+            examples = load_examples(INTENT_EXAMPLES_PATH) if os.path.exists(INTENT_EXAMPLES_PATH) else []
+            digest = hashlib.sha256(json.dumps(examples, ensure_ascii=False).encode("utf-8")).hexdigest()
+            embeddings, meta = None, None
+            if os.path.exists(self.path) and os.path.exists(self.path + ".json"):
+                embeddings, meta = load_embeddings(self.path)
+                # 嵌入模型或样本变化后需要重新生成
+                if meta.get("model") != self.model or (examples and meta.get("examples_sha256") != digest):
+                    embeddings, meta = None, None
+
+            if embeddings is None:
+                if not examples:
+                    logger.warning("未找到样本嵌入文件或标注数据，嵌入分类器未启用")
+                    return
+                texts = [text for text, _ in examples]
+                vectors = [await self.embed(texts[i:i + self.EMBED_BATCH_SIZE])
+                           for i in range(0, len(texts), self.EMBED_BATCH_SIZE)]
+                save_embeddings(self.path, np.concatenate(vectors), {
+                    "model": self.model,
+                    "labels": [label for _, label in examples],
+                    "examples_sha256": digest,
+                })
+                embeddings, meta = load_embeddings(self.path)
+                logger.info(f"已生成 {len(examples)} 条样本的嵌入向量: {self.path}")
+
+            self.classifier = CentroidClassifier.from_embeddings(embeddings, meta["labels"], INTENT_EMBEDDING_TEMPERATURE)
+            logger.info(f"嵌入分类器已加载: 模型 {self.model}, {embeddings.shape[0]} 条样本, {len(self.classifier.labels)} 个类别")
+        except Exception as e:
+            logger.error(f"加载嵌入分类器失败: {str(e)}")
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        start_time = time.monotonic()
+        response = await ollama_backends.post(
+            "/api/embed",
+            model=self.model,
+            priority=RequestPriority.CLASSIFICATION,
+            json={"model": self.model, "input": texts, "keep_alive": keep_alive_value()}
+        )
+        if response.status_code != 200:
+            raise OllamaAPIError(f"Ollama嵌入接口调用失败: {response.status_code}")
+        self.embed_calls += 1
+        self.embed_seconds += time.monotonic() - start_time
+        return np.asarray(response.json()["embeddings"], dtype=np.float32)
+
+    async def predict(self, text: str) -> Optional[IntentPrediction]:
+        if self.classifier is None:
+            return None
+        try:
+            return self.classifier.predict((await self.embed([text]))[0])
+        except Exception as e:
+            self.embed_failures += 1
+            logger.warning(f"嵌入分类失败，回退到LLM判别: {str(e)}")
+            return None
+
+    def is_confident(self, prediction: Optional[IntentPrediction], labels) -> bool:
+        return prediction is not None and prediction.confidence >= INTENT_EMBEDDING_THRESHOLD and prediction.label in labels
+
+    def record_agreement(self, prediction: IntentPrediction, llm_label: str):
+        self.compared += 1
+        self.agreed += prediction.label == llm_label
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.classifier is not None,
+            "model": self.model,
+            "threshold": INTENT_EMBEDDING_THRESHOLD,
+            "answers": self.answers,
+            "embed_calls": self.embed_calls,
+            "embed_failures": self.embed_failures,
+            "avg_embed_seconds": self.embed_seconds / self.embed_calls if self.embed_calls else None,
+            "agreement_rate": self.agreed / self.compared if self.compared else None,
+        }
+
+embedding_intent = EmbeddingIntentService(INTENT_EMBEDDING_MODEL, INTENT_EMBEDDINGS_PATH)
+
+def keep_alive_value() -> Any:
+    """Ollama的keep_alive既接受时长字符串也接受秒数"""
+    try:
+        return int(OLLAMA_KEEP_ALIVE)
+    except ValueError:
+        return OLLAMA_KEEP_ALIVE
+
+class _ModelWarmState:
+    __slots__ = ("model", "status", "error", "warmed_at", "task")
+
+    def __init__(self, model: str):
+        self.model = model
+        self.status = "idle"  # idle / loading / ready / failed
+        self.error = ""
+        self.warmed_at: Optional[datetime] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "model": self.model,
+            "status": self.status,
+            "error": self.error,
+            "warmed_at": self.warmed_at.isoformat() if self.warmed_at else None,
+            "keep_alive": OLLAMA_KEEP_ALIVE,
+        }
+
+class ModelWarmer:
+    """模型预热与保活：按模型分别记录加载状态，会话选择模型后异步加载到所有提供该模型的主机，
+    并定期为常驻会话选中的模型和路由表中的模型续期keep_alive"""
+
+    def __init__(self):
+        self.models: Dict[str, _ModelWarmState] = {}
+        self._keepalive_task: Optional[asyncio.Task] = None
+        self.extra_models: set = set()  # 路由表中单独指定的模型
+        self._preload_tasks: set = set()
+
+    async def start(self):
+        if self._keepalive_task is None:
+            self._keepalive_task = asyncio.create_task(self._keepalive_loop())
+
+    async def stop(self):
+        tasks = [self._keepalive_task] + [entry.task for entry in self.models.values()]
+        for task in tasks:
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        for task in list(self._preload_tasks):
+            task.cancel()
+        self._keepalive_task = None
+
+    def warm(self, model: str):
+        """开始异步预热，立即返回；该模型正在加载或已经就绪时不重复加载"""
+        if not model:
+            return
+        entry = self.models.setdefault(model, _ModelWarmState(model))
+        if entry.status in ("loading", "ready"):
+            return
+        entry.status = "loading"
+        entry.error = ""
+        entry.task = asyncio.create_task(self._warm(entry))
+
+    def preload(self, models: set):
+        """后台加载路由表中的模型，并在之后的保活周期中一并续期"""
+        self.extra_models = set(models)
+        for model in self.extra_models:
+            entry = self.models.get(model)
+            if entry is not None and entry.status in ("loading", "ready"):
+                continue
+            task = asyncio.create_task(self._preload(model))
+            self._preload_tasks.add(task)
+            task.add_done_callback(self._preload_tasks.discard)
+
+    async def _preload(self, model: str):
+        errors = await self._load(model)
+        if errors:
+            logger.warning(f"路由模型加载失败: {model} - {'; '.join(errors)}")
+        else:
+            logger.info(f"路由模型已加载: {model}")
+
+    async def _load(self, model: str) -> List[str]:
+        """向所有提供该模型的健康主机发送空的generate请求，返回失败信息"""
+        backends = [b for b in ollama_backends.backends if b.healthy and b.serves(model)]
+        if not backends:
+            return [f"没有可用的Ollama主机提供模型: {model}"]
+
+        async def load_on(backend: OllamaBackend) -> Optional[str]:
+            try:
+                # 与其他请求一样经调度器准入，以最低优先级占用该主机的并发槽位
+                response = await ollama_backends.post(
+                    "/api/generate",
+                    model=model,
+                    priority=RequestPriority.BATCH,
+                    target=backend,
+                    json={"model": model, "keep_alive": keep_alive_value()},
+                    timeout=600.0
+                )
+                if response.status_code != 200:
+                    return f"{backend.url}: HTTP {response.status_code}"
+            except Exception as e:
+                return f"{backend.url}: {str(e) or type(e).__name__}"
+            return None
+
+        results = await asyncio.gather(*(load_on(b) for b in backends))
+        errors = [r for r in results if r]
+        # 只要有一台主机加载成功即可服务
+        return errors if len(errors) == len(backends) else []
+
+    async def _warm(self, entry: _ModelWarmState):
+        logger.info(f"开始预热模型: {entry.model}")
+        await broadcast_model_status(entry.model)
+        start_time = datetime.now()
+        errors = await self._load(entry.model)
+        self._record(entry, errors)
+        if not errors:
+            duration = (entry.warmed_at - start_time).total_seconds()
+            logger.info(f"模型预热完成: {entry.model} (耗时 {duration:.2f}秒)")
+        await broadcast_model_status(entry.model)
+
+    def _record(self, entry: _ModelWarmState, errors: List[str]):
+        if errors:
+            entry.status = "failed"
+            entry.error = "; ".join(errors)
+            logger.error(f"模型加载失败: {entry.model} - {entry.error}")
+        else:
+            entry.status = "ready"
+            entry.error = ""
+            entry.warmed_at = datetime.now()
+
+    def active_models(self) -> set:
+        """需要保持加载的模型：常驻会话选中的模型和路由表中的模型"""
+        models = {state.selected_model for state in session_registry.sessions() if state.selected_model}
+        return models | self.extra_models
+
+    async def _keepalive_loop(self):
+        while True:
+            await asyncio.sleep(OLLAMA_KEEP_ALIVE_INTERVAL)
+            active = self.active_models()
+            # 不再被任何会话使用的模型不再续期，由Ollama按keep_alive自行卸载
+            for model in [m for m, entry in self.models.items() if m not in active and entry.status != "loading"]:
+                del self.models[model]
+            for model in active:
+                entry = self.models.get(model)
+                if entry is not None and entry.status == "loading":
+                    continue
+                errors = await self._load(model)
+                if entry is None:
+                    if errors:
+                        logger.warning(f"模型保活失败: {model} - {'; '.join(errors)}")
+                    continue
+                previous = entry.status
+                self._record(entry, errors)
+                if entry.status != previous:
+                    await broadcast_model_status(model)
+
+    def snapshot(self, model: str) -> Dict[str, Any]:
+        entry = self.models.get(model)
+        return entry.snapshot() if entry is not None else _ModelWarmState(model).snapshot()
+
+    def event(self, model: str) -> Dict[str, Any]:
+        return {"type": "model_status", **self.snapshot(model)}
+
+model_warmer = ModelWarmer()
+
+class SessionDatabase:
+    """会话持久化：SQLite WAL模式。写入先进入内存队列，由后台任务每隔commit_interval（或积压到max_batch条）
+    在线程中合并为一个事务提交；SQL语句固定，由sqlite3的语句缓存复用预编译结果。
+    读取使用单独的连接，WAL模式下不会被写事务阻塞"""
+
+    INSERT_MESSAGE = "INSERT OR REPLACE INTO messages (session_id, seq, id, data) VALUES (?, ?, ?, ?)"
+    INSERT_SUMMARY = "INSERT OR REPLACE INTO summaries (session_id, covered, key, summary, created_at) VALUES (?, ?, ?, ?, ?)"
+    UPSERT_SESSION = ("INSERT INTO sessions (session_id, selected_model, snapshot, updated_at) VALUES (?, ?, ?, ?) "
+                      "ON CONFLICT(session_id) DO UPDATE SET selected_model = excluded.selected_model, "
+                      "snapshot = excluded.snapshot, updated_at = excluded.updated_at")
+
+    def __init__(self, path: str, commit_interval: float, max_batch: int):
+        self.path = path
+        self._temporary = not path
+        self.commit_interval = commit_interval
+        self.max_batch = max_batch
+        self._writer: Optional[sqlite3.Connection] = None
+        self._reader: Optional[sqlite3.Connection] = None
+        self._pending: List[Tuple[str, Tuple]] = []
+        self._wakeup = asyncio.Event()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+        self.committed: Dict[str, int] = {}  # 各会话已提交到磁盘的最大消息序号
+        self.commits = 0
+        self.rows_written = 0
+        self.max_commit_rows = 0
+        self.commit_seconds = 0.0
+        self.reads = 0
+
+    def open(self):
+        if self._writer is not None:
+            return
+        if self._temporary:
+            fd, self.path = tempfile.mkstemp(prefix="orchestra_sessions_", suffix=".db")
+            os.close(fd)
+        self._writer = sqlite3.connect(self.path, check_same_thread=False)
+        self._writer.execute("PRAGMA journal_mode=WAL")
+        # WAL模式下NORMAL只在检查点时fsync，进程崩溃不会丢已提交的事务
+        self._writer.execute("PRAGMA synchronous=NORMAL")
+        self._writer.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY, selected_model TEXT NOT NULL DEFAULT '',
+                snapshot TEXT NOT NULL DEFAULT '{}', updated_at TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS messages (
+                session_id TEXT NOT NULL, seq INTEGER NOT NULL, id TEXT NOT NULL, data TEXT NOT NULL,
+                PRIMARY KEY (session_id, seq)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS messages_id ON messages (session_id, id);
+            CREATE TABLE IF NOT EXISTS summaries (
+                session_id TEXT NOT NULL, covered INTEGER NOT NULL, key TEXT NOT NULL, summary TEXT NOT NULL,
+                created_at TEXT NOT NULL, PRIMARY KEY (session_id, covered)) WITHOUT ROWID;
+        """)
+        columns = {row[1] for row in self._writer.execute("PRAGMA table_info(sessions)")}
+        if "snapshot" not in columns:
+            self._writer.execute("ALTER TABLE sessions ADD COLUMN snapshot TEXT NOT NULL DEFAULT '{}'")
+        self._writer.commit()
+        self._reader = sqlite3.connect(self.path, check_same_thread=False)
+        logger.info(f"会话数据库: {self.path}")
+
+    async def start(self):
+        self.open()
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+        for connection in (self._writer, self._reader):
+            if connection is not None:
+                connection.close()
+        self._writer = self._reader = None
+        if self._temporary:
+            for suffix in ("", "-wal", "-shm"):
+                try:
+                    os.remove(self.path + suffix)
+                except OSError:
+                    pass
+
+    def _enqueue(self, sql: str, params: Tuple):
+        self._pending.append((sql, params))
+        if len(self._pending) >= self.max_batch:
+            self._wakeup.set()
+
+    def save_message(self, session_id: str, message: MessageRecord):
+        self._enqueue(self.INSERT_MESSAGE, (session_id, message.seq, message.id, message.to_json()))
+
+    def save_summary(self, session_id: str, checkpoint: "SummaryCheckpoint"):
+        self._enqueue(self.INSERT_SUMMARY, (session_id, checkpoint.covered, checkpoint.key, checkpoint.summary,
+                                            checkpoint.created_at.isoformat()))
+
+    def save_session(self, session_id: str, selected_model: str, snapshot: Dict[str, Any]):
+        self._enqueue(self.UPSERT_SESSION, (session_id, selected_model, json.dumps(snapshot, ensure_ascii=False),
+                                            datetime.now().isoformat()))
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.commit_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"会话数据写入失败: {str(e)}", exc_info=True)
+                await asyncio.sleep(1)
+
+    async def flush(self):
+        """把队列中的写入合并为一个事务提交"""
+        async with self._flush_lock:
+            if not self._pending or self._writer is None:
+                return
+            batch, self._pending = self._pending, []
+            start_time = time.monotonic()
+            try:
+                await asyncio.to_thread(self._write, batch)
+            except Exception:
+                # 放回队首，下次重试
+                self._pending[:0] = batch
+                raise
+            self.commits += 1
+            self.rows_written += len(batch)
+            self.max_commit_rows = max(self.max_commit_rows, len(batch))
+            self.commit_seconds += time.monotonic() - start_time
+            for sql, params in batch:
+                if sql == self.INSERT_MESSAGE:
+                    self.committed[params[0]] = max(self.committed.get(params[0], 0), params[1])
+
+    def _write(self, batch: List[Tuple[str, Tuple]]):
+        # 相邻的同一语句合并为executemany，保持写入顺序
+        with self._writer:
+            i = 0
+            while i < len(batch):
+                j = i
+                while j < len(batch) and batch[j][0] == batch[i][0]:
+                    j += 1
+                self._writer.executemany(batch[i][0], [params for _, params in batch[i:j]])
+                i = j
+
+    def read_messages(self, query: str, params: Tuple) -> List[MessageRecord]:
+        self.reads += 1
+        return [MessageRecord.from_json(data) for (data,) in self._reader.execute(query, params)]
+
+    def has_session(self, session_id: str) -> bool:
+        self.open()
+        self.reads += 1
+        return self._reader.execute(
+            "SELECT 1 FROM sessions WHERE session_id = ? UNION ALL SELECT 1 FROM messages WHERE session_id = ? LIMIT 1",
+            (session_id, session_id)).fetchone() is not None
+
+    def load_session(self, session_id: str) -> Dict[str, Any]:
+        """读取会话的元数据、消息序号范围和全部总结检查点"""
+        self.reads += 1
+        row = self._reader.execute("SELECT selected_model, snapshot FROM sessions WHERE session_id = ?",
+                                   (session_id,)).fetchone()
+        count, last_seq = self._reader.execute(
+            "SELECT COUNT(*), COALESCE(MAX(seq), 0) FROM messages WHERE session_id = ?", (session_id,)).fetchone()
+        summaries = self._reader.execute(
+            "SELECT key, summary, covered, created_at FROM summaries WHERE session_id = ? ORDER BY covered",
+            (session_id,)).fetchall()
+        return {
+            "exists": row is not None or count > 0,
+            "persisted": row is not None,
+            "selected_model": row[0] if row else "",
+            "snapshot": json.loads(row[1]) if row else {},
+            "count": count,
+            "last_seq": last_seq,
+            "summaries": [SummaryCheckpoint(key, summary, covered, datetime.fromisoformat(created_at))
+                          for key, summary, covered, created_at in summaries],
+        }
+
+    def count_sessions(self) -> int:
+        if self._reader is None:
+            return 0
+        self.reads += 1
+        return self._reader.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "path": self.path,
+            "pending": len(self._pending),
+            "commits": self.commits,
+            "rows_written": self.rows_written,
+            "avg_commit_rows": self.rows_written / self.commits if self.commits else None,
+            "max_commit_rows": self.max_commit_rows,
+            "avg_commit_seconds": self.commit_seconds / self.commits if self.commits else None,
+            "reads": self.reads,
+        }
+
+session_db = SessionDatabase(SESSION_DB_PATH, SESSION_DB_COMMIT_INTERVAL, SESSION_DB_MAX_BATCH)
+
+class MessageStore:
+    """消息存储：为每条消息分配单调递增的序号，每条消息都异步写入会话数据库，
+    内存中只保留最近hot_size条，已提交到磁盘的更早消息从内存移除，内存占用不随会话长度增长。
+    按序号的范围查询在热窗口中用二分查找，在磁盘上走(session_id, seq)主键索引"""
+
+    def __init__(self, session_id: str, db: SessionDatabase, hot_size: int, spill_batch: int):
+        self.session_id = session_id
+        self.db = db
+        self.hot_size = hot_size
+        self.spill_batch = max(1, spill_batch)
+        self._hot: List[MessageRecord] = []
+        self._hot_seqs: List[int] = []  # 与_hot一一对应，严格递增
+        self._hot_ids: Dict[str, int] = {}
+        self.count = 0
+        self.last_seq = 0
+        self.resident_bytes = 0  # 热窗口消息占用内存的粗略估算
+        self.spilled = 0
+        self.spill_batches = 0
+        self.disk_reads = 0
+
+    @staticmethod
+    def _estimate_bytes(message: MessageRecord) -> int:
+        # 中文字符在str中按2字节计，内容和缓存的JSON各一份，另加记录对象、id字符串等的固定开销
+        return 4 * len(message.content) + 450
+
+    def restore(self, count: int, last_seq: int):
+        """从数据库恢复：只把最近的热窗口读入内存"""
+        self.count = count
+        self.last_seq = last_seq
+        self._hot = self.db.read_messages(
+            "SELECT data FROM messages WHERE session_id = ? AND seq <= ? ORDER BY seq DESC LIMIT ?",
+            (self.session_id, last_seq, self.hot_size))[::-1]
+        self._hot_seqs = [message.seq for message in self._hot]
+        self._hot_ids = {message.id: message.seq for message in self._hot}
+        self.resident_bytes = sum(self._estimate_bytes(message) for message in self._hot)
+        self.db.committed[self.session_id] = max(self.db.committed.get(self.session_id, 0), last_seq)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def append(self, message: MessageRecord):
+        self.last_seq += 1
+        message.assign_seq(self.last_seq)
+        self._hot.append(message)
+        self._hot_seqs.append(message.seq)
+        self._hot_ids[message.id] = message.seq
+        self.resident_bytes += self._estimate_bytes(message)
+        self.count += 1
+        self.db.save_message(self.session_id, message)
+        # 攒够一批再整理内存，避免每条消息都移动列表
+        if len(self._hot) >= self.hot_size + self.spill_batch:
+            self._spill()
+
+    def _spill(self):
+        # 只移除已经提交到磁盘的消息，写入滞后时暂时多留在内存中
+        committed = self.db.committed.get(self.session_id, 0)
+        count = min(len(self._hot) - self.hot_size, bisect_left(self._hot_seqs, committed + 1))
+        if count <= 0:
+            return
+        for message in self._hot[:count]:
+            del self._hot_ids[message.id]
+            self.resident_bytes -= self._estimate_bytes(message)
+        del self._hot[:count]
+        del self._hot_seqs[:count]
+        self.spilled += count
+        self.spill_batches += 1
+
+    def _first_hot_seq(self) -> int:
+        return self._hot_seqs[0] if self._hot_seqs else self.last_seq + 1
+
+    def _read(self, query: str, params: Tuple) -> List[MessageRecord]:
+        self.disk_reads += 1
+        return self.db.read_messages(query, (self.session_id,) + params)
+
+    def get(self, seq: int) -> Optional[MessageRecord]:
+        if seq >= self._first_hot_seq():
+            i = bisect_left(self._hot_seqs, seq)
+            return self._hot[i] if i < len(self._hot_seqs) and self._hot_seqs[i] == seq else None
+        messages = self._read("SELECT data FROM messages WHERE session_id = ? AND seq = ?", (seq,))
+        return messages[0] if messages else None
+
+    def get_by_id(self, message_id: str) -> Optional[MessageRecord]:
+        seq = self._hot_ids.get(message_id)
+        if seq is not None:
+            return self.get(seq)
+        messages = self._read("SELECT data FROM messages WHERE session_id = ? AND id = ? AND seq < ?",
+                              (message_id, self._first_hot_seq()))
+        return messages[0] if messages else None
+
+    def range(self, start_seq: int, stop_seq: Optional[int] = None, limit: Optional[int] = None) -> List[MessageRecord]:
+        """返回序号在[start_seq, stop_seq)内的消息（最多limit条），stop_seq为空时直到最新"""
+        first_hot = self._first_hot_seq()
+        stop = self.last_seq + 1 if stop_seq is None else stop_seq
+        limit = -1 if limit is None else limit
+        messages: List[MessageRecord] = []
+        if start_seq < min(stop, first_hot):
+            messages.extend(self._read(
+                "SELECT data FROM messages WHERE session_id = ? AND seq >= ? AND seq < ? ORDER BY seq LIMIT ?",
+                (start_seq, min(stop, first_hot), limit)))
+        if stop > first_hot and (limit < 0 or len(messages) < limit):
+            i = bisect_left(self._hot_seqs, start_seq)
+            j = bisect_left(self._hot_seqs, stop)
+            if limit >= 0:
+                j = min(j, i + limit - len(messages))
+            messages.extend(self._hot[i:j])
+        return messages
+
+    def since(self, seq: int) -> List[MessageRecord]:
+        """序号大于seq的全部消息"""
+        return self.range(seq + 1)
+
+    def before(self, seq: int, count: int) -> List[MessageRecord]:
+        """序号小于seq的最近count条消息，按序号升序返回"""
+        if count <= 0:
+            return []
+        j = bisect_left(self._hot_seqs, seq)
+        hot = self._hot[max(0, j - count):j]
+        if len(hot) == count:
+            return hot
+        older = self._read("SELECT data FROM messages WHERE session_id = ? AND seq < ? ORDER BY seq DESC LIMIT ?",
+                           (min(seq, self._first_hot_seq()), count - len(hot)))
+        return older[::-1] + hot
+
+    def last(self, count: int) -> List[MessageRecord]:
+        return self.before(self.last_seq + 1, count)
+
+    def page(self, before_seq: int, limit: int, types: Optional[set] = None,
+             scan_limit: int = 1000) -> Tuple[List[MessageRecord], int]:
+        """序号小于before_seq的最近limit条消息，可按消息类型过滤，按序号升序返回。
+        过滤时最多向前扫描scan_limit条；同时返回下一页的before_seq，序号从1开始，不大于1表示已到最早的消息"""
+        found: List[MessageRecord] = []
+        cursor = before_seq
+        scanned = 0
+        while len(found) < limit and cursor > 1 and scanned < scan_limit:
+            need = limit - len(found)
+            batch = self.before(cursor, min(max(need, 50) if types else need, scan_limit - scanned))
+            if not batch:
+                cursor = 1
+                break
+            scanned += len(batch)
+            matched = batch if types is None else [message for message in batch if message.message_type in types]
+            if len(matched) > need:
+                matched = matched[-need:]
+                cursor = matched[0].seq
+            else:
+                cursor = batch[0].seq
+            found = matched + found
+        return found, cursor
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "total": self.count,
+            "last_seq": self.last_seq,
+            "resident": len(self._hot),
+            "resident_bytes": self.resident_bytes,
+            "spilled": self.spilled,
+            "spill_batches": self.spill_batches,
+            "disk_reads": self.disk_reads,
+            "hot_window": self.hot_size,
+        }
+
+class SummaryCheckpoint:
+    """对话总结检查点：covered是总结覆盖到的最后一条消息的序号，之后的消息即"自上次总结后"的消息"""
+    __slots__ = ("key", "summary", "covered", "created_at")
+
+    def __init__(self, key: str, summary: str, covered: int, created_at: Optional[datetime] = None):
+        self.key = key
+        self.summary = summary
+        self.covered = covered
+        self.created_at = created_at or datetime.now()
+
+class OrchestraState:
+    """单个会话的状态：消息、连接、选中的模型和总结链"""
+
+    def __init__(self, session_id: str, selected_model: str = ""):
+        self.session_id = session_id
+        self.restored = False
+        self.messages = MessageStore(session_id, session_db, MESSAGE_HOT_WINDOW, MESSAGE_SPILL_BATCH)
+        self.websocket_connections: List[WebSocket] = []
+        self.selected_model = selected_model
+        self.turn_lock = asyncio.Lock()  # 同一会话的对话轮次依次处理，不同会话互不阻塞
+        self.last_access = time.monotonic()
+        self.persisted = False  # sessions表中是否已有该会话的记录
+        self.summary_checkpoints: List[SummaryCheckpoint] = []  # 各阶段的对话总结，按覆盖位置递增
+        self.summary_task: Optional[asyncio.Task] = None
+        self.summary_attempted = 0  # 最近一次尝试总结时的最新序号，失败后等累计足够的新消息再重试
+        self.last_discrimination: Optional[str] = None  # 最近一次判别结果，用于推测执行
+        
+    def ensure_restored(self) -> bool:
+        """首次访问时从会话数据库恢复：消息序号与最近的热窗口、总结检查点、选中的模型和运行时快照。
+        返回磁盘上是否已有该会话"""
+        if self.restored:
+            return False
+        self.restored = True
+        session_db.open()
+        try:
+            data = session_db.load_session(self.session_id)
+        except Exception as e:
+            logger.error(f"恢复会话 {self.session_id} 失败: {str(e)}", exc_info=True)
+            return False
+        if not data["exists"]:
+            return False
+        self.persisted = data["persisted"]
+        if data["count"]:
+            self.messages.restore(data["count"], data["last_seq"])
+        self.summary_checkpoints = data["summaries"]
+        snapshot = data["snapshot"]
+        self.summary_attempted = max(self.summary_covered(), snapshot.get("summary_attempted", 0))
+        self.last_discrimination = snapshot.get("last_discrimination")
+        # 始终恢复用户选择的模型：主机暂时不可用时回退到默认模型，下次保存会永久覆盖用户的选择；
+        # 模型是否可用由调用时的调度器判断
+        if data["selected_model"]:
+            self.selected_model = data["selected_model"]
+        if not self.persisted:
+            self.save()
+        logger.info(f"已恢复会话 {self.session_id}: {data['count']} 条消息, {len(self.summary_checkpoints)} 个总结, 模型 {self.selected_model}")
+        return True
+
+    def save(self):
+        session_db.save_session(self.session_id, self.selected_model, self.snapshot())
+        self.persisted = True
+
+    def snapshot(self) -> Dict[str, Any]:
+        """消息和总结已逐条写入数据库，快照只需保存其余的运行时状态"""
+        return {"summary_attempted": self.summary_attempted, "last_discrimination": self.last_discrimination}
+
+    def is_empty(self) -> bool:
+        return not self.persisted and len(self.messages) == 0
+
+    def is_idle(self) -> bool:
+        return (not self.websocket_connections and not self.turn_lock.locked()
+                and (self.summary_task is None or self.summary_task.done()))
+
+    def latest_summary(self) -> Optional[SummaryCheckpoint]:
+        return self.summary_checkpoints[-1] if self.summary_checkpoints else None
+
+    def summary_covered(self) -> int:
+        """最近一次总结覆盖到的消息序号，没有总结时为0"""
+        return self.summary_checkpoints[-1].covered if self.summary_checkpoints else 0
 
     def get_context_for_role(self, role: RoleType, max_messages: Optional[int] = None) -> str:
         """获取特定角色的对话上下文（只使用总结）"""
         # 如果有总结，直接返回最新的总结
-        if self.conversation_summaries:
-            latest_summary = list(self.conversation_summaries.values())[-1]
+        if self.summary_checkpoints:
+            latest_summary = self.summary_checkpoints[-1].summary
             logger.info(f"为角色 {role.value} 提供总结上下文，总结长度: {len(latest_summary)}")
             return latest_summary
         else:
@@ -114,7 +1862,239 @@ def get_role_display_name(role: RoleType) -> str:
     }
     return role_names.get(role, role.value)
 
-orchestra_state = OrchestraState()
+DEFAULT_SESSION_ID = "default"
+SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+class SessionRegistry:
+    """会话表：按会话id的哈希分片保存各会话的OrchestraState，首次访问时创建并从数据库懒加载。
+    每个分片按最近访问顺序排列，后台定期把空闲超时或超出内存预算的会话写入快照后移出内存"""
+
+    def __init__(self, shard_count: int):
+        self.shards: List[OrderedDict] = [OrderedDict() for _ in range(max(1, shard_count))]
+        self.default_model = ""
+        self.evictions = 0
+        self.rehydrations = 0
+        self._sweep_task: Optional[asyncio.Task] = None
+
+    def _shard(self, session_id: str) -> OrderedDict:
+        return self.shards[zlib.crc32(session_id.encode("utf-8")) % len(self.shards)]
+
+    def get(self, session_id: str) -> OrchestraState:
+        shard = self._shard(session_id)
+        state = shard.get(session_id)
+        if state is None:
+            state = OrchestraState(session_id, self.default_model)
+            shard[session_id] = state
+            if state.ensure_restored():
+                self.rehydrations += 1
+        else:
+            shard.move_to_end(session_id)
+        state.last_access = time.monotonic()
+        return state
+
+    def find(self, session_id: str) -> Optional[OrchestraState]:
+        """只读查询用：返回常驻或磁盘上已有的会话，不为未知的id创建会话"""
+        if session_id in self._shard(session_id) or session_db.has_session(session_id):
+            return self.get(session_id)
+        return None
+
+    def touch(self, state: OrchestraState):
+        shard = self._shard(state.session_id)
+        if shard.get(state.session_id) is state:
+            shard.move_to_end(state.session_id)
+        state.last_access = time.monotonic()
+
+    async def start(self):
+        if self._sweep_task is None:
+            self._sweep_task = asyncio.create_task(self._sweep_loop())
+
+    async def stop(self):
+        if self._sweep_task is not None:
+            self._sweep_task.cancel()
+            try:
+                await self._sweep_task
+            except asyncio.CancelledError:
+                pass
+            self._sweep_task = None
+        # 关闭前保存所有常驻会话的快照，重启后可以完整恢复
+        for state in self.sessions():
+            if not state.is_empty():
+                state.save()
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"淘汰空闲会话时发生错误: {str(e)}", exc_info=True)
+
+    def resident_bytes(self) -> int:
+        return sum(state.messages.resident_bytes for state in self.sessions())
+
+    async def sweep(self):
+        """按最近最少使用的顺序淘汰空闲会话：空闲超时的全部淘汰，超出内存预算时继续淘汰较早访问的空闲会话"""
+        now = time.monotonic()
+        over_budget = self.resident_bytes() - SESSION_MEMORY_BUDGET_MB * 1024 * 1024
+        # 各分片内已按访问时间排序，归并得到全局的LRU顺序
+        for state in list(heapq.merge(*(list(shard.values()) for shard in self.shards), key=lambda s: s.last_access)):
+            if now - state.last_access < SESSION_IDLE_SECONDS and over_budget <= 0:
+                break
+            if not state.is_idle():
+                continue
+            freed = state.messages.resident_bytes
+            if await self.evict(state):
+                over_budget -= freed
+
+    async def evict(self, state: OrchestraState) -> bool:
+        """写入快照并等待提交后移出内存；提交期间会话被重新使用则放弃淘汰。
+        从未写入过数据的空会话直接丢弃，不留下sessions记录"""
+        if not state.is_empty():
+            state.save()
+            await session_db.flush()
+        shard = self._shard(state.session_id)
+        if not state.is_idle() or shard.get(state.session_id) is not state:
+            return False
+        del shard[state.session_id]
+        self.evictions += 1
+        logger.info(f"已淘汰空闲会话 {state.session_id}（{len(state.messages)} 条消息）")
+        return True
+
+    def sessions(self) -> List[OrchestraState]:
+        return [state for shard in self.shards for state in shard.values()]
+
+    async def initialize_default_model(self):
+        """初始化选择第一个可用模型，作为新会话的默认模型"""
+        if self.default_model:
+            return
+        try:
+            models = ollama_backends.list_models()
+            if models:
+                self.default_model = models[0]
+                logger.info(f"自动选择第一个可用模型: {self.default_model}")
+                for state in self.sessions():
+                    if not state.selected_model:
+                        state.selected_model = self.default_model
+                model_warmer.warm(self.default_model)
+            else:
+                logger.warning("未找到可用的模型")
+        except Exception as e:
+            logger.error(f"初始化模型时发生错误: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        sessions = self.sessions()
+        persisted = session_db.count_sessions()
+        return {
+            "resident": len(sessions),
+            # 已写入磁盘但不在内存中的会话
+            "evicted": max(0, persisted - sum(1 for state in sessions if state.persisted)),
+            "idle": sum(1 for state in sessions if state.is_idle()),
+            "shards": len(self.shards),
+            "connections": sum(len(state.websocket_connections) for state in sessions),
+            "resident_messages": sum(len(state.messages._hot) for state in sessions),
+            "resident_bytes": sum(state.messages.resident_bytes for state in sessions),
+            "memory_budget_bytes": int(SESSION_MEMORY_BUDGET_MB * 1024 * 1024),
+            "idle_seconds": SESSION_IDLE_SECONDS,
+            "evictions": self.evictions,
+            "rehydrations": self.rehydrations,
+            "default_model": self.default_model,
+        }
+
+session_registry = SessionRegistry(SESSION_SHARDS)
+
+_current_session: contextvars.ContextVar[Optional[OrchestraState]] = contextvars.ContextVar("current_session", default=None)
+
+def current_state() -> OrchestraState:
+    """当前协程所属会话的状态（由WebSocket连接设置，创建的任务会继承）；不属于任何会话时使用默认会话"""
+    state = _current_session.get()
+    return state if state is not None else session_registry.get(DEFAULT_SESSION_ID)
+
+ROUTE_DISCRIMINATION = "discrimination"
+ROUTE_SUMMARY = "summary"
+
+class ModelRoute(BaseModel):
+    model: str = ""  # 为空时跟随当前选中的模型
+    options: Dict[str, Any] = {}
+
+class ModelRouter:
+    """按调用类型（话语判别、各角色、总结）选择模型和Ollama options，未配置的类型使用当前选中的模型"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.routes: Dict[str, ModelRoute] = {}
+
+    @staticmethod
+    def tasks() -> List[str]:
+        return [ROUTE_DISCRIMINATION, ROUTE_SUMMARY] + [role.value for role in RoleType]
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            for task, route in data.items():
+                if task not in self.tasks():
+                    logger.warning(f"忽略未知的模型路由: {task}")
+                    continue
+                self.routes[task] = ModelRoute(**route)
+            logger.info(f"已加载模型路由表: {self.path}")
+        except Exception as e:
+            logger.error(f"加载模型路由表失败: {str(e)}")
+            return
+
+        available = ollama_backends.list_models()
+        for task, route in self.routes.items():
+            if route.model and route.model not in available:
+                logger.warning(f"模型路由 {task} 指定的模型当前不可用: {route.model}")
+        model_warmer.preload(self.models())
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump({task: route.model_dump() for task, route in self.routes.items()}, f, ensure_ascii=False, indent=2)
+        except Exception as e:
+            logger.error(f"保存模型路由表失败: {str(e)}")
+
+    def set(self, task: str, route: ModelRoute):
+        self.routes[task] = route
+        self.save()
+        model_warmer.preload(self.models())
+
+    def reset(self, task: str):
+        self.routes.pop(task, None)
+        self.save()
+        model_warmer.preload(self.models())
+
+    def models(self) -> set:
+        return {route.model for route in self.routes.values() if route.model}
+
+    def model_for(self, task: str) -> str:
+        route = self.routes.get(task)
+        return route.model if route and route.model else current_state().selected_model
+
+    def payload(self, task: str, extra_payload: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """合并路由配置的options与调用方的参数，调用方的约束（如判别的num_predict）优先"""
+        route = self.routes.get(task)
+        payload = dict(extra_payload or {})
+        options = {**(route.options if route else {}), **payload.get("options", {})}
+        if options:
+            payload["options"] = options
+        return payload
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            task: {
+                "model": self.routes[task].model if task in self.routes else "",
+                "options": self.routes[task].options if task in self.routes else {},
+                "resolved_model": self.model_for(task),
+            }
+            for task in self.tasks()
+        }
+
+model_router = ModelRouter(MODEL_ROUTES_PATH)
 
 class TalkAbout(str, Enum):
     ASK_WHY = 'ask_why'
@@ -161,7 +2141,9 @@ AI_PROMPTS = {
             '4': TalkAbout.ABOUT_WHAT,
             '5': TalkAbout.ABOUT_REFLECT,
             '6': TalkAbout.JUDGE,
-        }
+        },
+        # 判别结果无法解析或没有对应分支（如选项7）时使用的选项
+        'discrimination_fallback': '1'
     },
     # 你是产品AI，负责需求分析和产品设计。你的职责包括：
     #
@@ -226,72 +2208,576 @@ AI_PROMPTS = {
 """
 }
 
+# 同一会话中尚未完成的相同输入（如同一会话的两个标签页同时发送）合并为一轮。
+# 会话内的轮次依次处理，不合并时后一轮的历史已包含前一轮的回复，无法再共享上游生成
+turn_singleflight = SingleFlight()
+
+def turn_key(state: "OrchestraState", content: str) -> str:
+    return SingleFlight.make_key(state.session_id, content)
+
+class TurnTracker:
+    """跟踪每个连接正在进行的对话轮次，支持断开连接、新输入覆盖和手动停止时取消"""
+
+    def __init__(self):
+        self.turns: Dict[str, asyncio.Task] = {}
+        self.keys: Dict[str, str] = {}
+        self.cancelled: Dict[str, int] = {}
+
+    def start(self, connection_id: str, content: str):
+        task = asyncio.create_task(handle_human_input(content))
+        self.turns[connection_id] = task
+        self.keys[connection_id] = turn_key(current_state(), content)
+        task.add_done_callback(lambda t: self._done(connection_id, t))
+
+    def _done(self, connection_id: str, task: asyncio.Task):
+        if self.turns.get(connection_id) is task:
+            del self.turns[connection_id]
+            del self.keys[connection_id]
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("处理人类输入时发生错误", exc_info=task.exception())
+
+    async def cancel(self, connection_id: str, reason: str) -> bool:
+        """取消该连接正在进行的轮次，等待上游请求真正中止后返回"""
+        task = self.turns.pop(connection_id, None)
+        key = self.keys.pop(connection_id, None)
+        if task is None or task.done():
+            return False
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            pass
+        self.cancelled[reason] = self.cancelled.get(reason, 0) + 1
+        if key is not None and turn_singleflight.waiting(key):
+            # 合并的一轮仍有其他连接在等待，继续生成，只有本连接离开
+            logger.info(f"连接 {connection_id[:8]} 离开了合并的轮次: {reason}")
+            return True
+        logger.info(f"已取消连接 {connection_id[:8]} 的生成: {reason}")
+        await broadcast_event({"type": "generation_cancelled", "reason": reason})
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {"active": len(self.turns), "cancelled": self.cancelled, "coalesced": turn_singleflight.shared}
+
+turn_tracker = TurnTracker()
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
+    session_id = websocket.query_params.get("session") or DEFAULT_SESSION_ID
+    if not SESSION_ID_PATTERN.match(session_id):
+        await websocket.close(code=1008)
+        return
     await websocket.accept()
-    orchestra_state.websocket_connections.append(websocket)
+    state = session_registry.get(session_id)
+    # 本连接处理的轮次都属于该会话
+    _current_session.set(state)
+    model_warmer.warm(state.selected_model)
+    state.websocket_connections.append(websocket)
+    connection_id = str(uuid.uuid4())
 
     try:
-        await websocket.send_text(json.dumps({
+        # 重连的客户端带上已收到的最大序号，只补发之后的消息；落后太多时重新发送最近的消息
+        since = websocket.query_params.get("since")
+        store = state.messages
+        cursor = None
+        # since为0表示客户端还没有任何消息，按新连接处理；
+        # since大于last_seq说明服务端数据已重置（如临时数据库重启），客户端必须整体刷新
+        if since is not None and since.isdigit() and int(since) > 0 and 0 <= store.last_seq - int(since) <= WS_REPLAY_LIMIT:
+            replay, reset = store.since(int(since)), False
+        else:
+            replay, next_seq = store.page(store.last_seq + 1, WS_INITIAL_SNAPSHOT)
+            reset = True
+            cursor = encode_history_cursor(session_id, next_seq)
+        await websocket.send_text(dumps_with_messages({
             "type": "connection_established",
-            "messages": [msg.model_dump(mode="json") for msg in orchestra_state.messages[-50:]]
-        }))
+            "reset": reset,
+            "cursor": cursor,
+            "last_seq": store.last_seq,
+            "model_status": model_warmer.snapshot(state.selected_model)
+        }, replay))
 
         while True:
             data = await websocket.receive_text()
-            message_data = json.loads(data)
-            await handle_human_input(message_data["content"])
+            try:
+                message_data = json.loads(data)
+            except ValueError:
+                message_data = None
+            if not isinstance(message_data, dict):
+                await websocket.send_text(json.dumps({"type": "error", "detail": "无效的消息格式"}, ensure_ascii=False))
+                continue
+            if message_data.get("type") == "stop":
+                await turn_tracker.cancel(connection_id, "用户停止")
+                continue
+            content = message_data.get("content")
+            if not isinstance(content, str) or not content.strip():
+                await websocket.send_text(json.dumps({"type": "error", "detail": "消息内容为空"}, ensure_ascii=False))
+                continue
+
+            # 新的输入（包括紧急打断）覆盖尚未完成的上一轮
+            await turn_tracker.cancel(connection_id, "新输入覆盖")
+            turn_tracker.start(connection_id, content)
 
     except WebSocketDisconnect:
-        orchestra_state.websocket_connections.remove(websocket)
+        pass
+    finally:
+        # 任何原因退出都要移除连接并取消本连接的轮次，否则会话永远不会被视为空闲
+        if websocket in state.websocket_connections:
+            state.websocket_connections.remove(websocket)
+        await turn_tracker.cancel(connection_id, "连接断开")
 
-async def broadcast_message(message: Message):
-    orchestra_state.messages.append(message)
+class BroadcastGate:
+    """推测执行期间暂存广播（包括写入消息历史），确认后按原顺序放行，放弃时直接丢弃"""
 
+    def __init__(self):
+        self.opened = False
+        self.pending: List[Any] = []
+
+    async def open(self):
+        # 放行过程中产生的新广播继续排在队尾，全部发送完才切换为直通，保证顺序
+        while self.pending:
+            item = self.pending.pop(0)
+            if isinstance(item, MessageRecord):
+                await _deliver_message(item)
+            else:
+                await _deliver_event(item)
+        self.opened = True
+
+_broadcast_gate: contextvars.ContextVar[Optional[BroadcastGate]] = contextvars.ContextVar("broadcast_gate", default=None)
+
+async def broadcast_message(message: MessageRecord):
+    gate = _broadcast_gate.get()
+    if gate is not None and not gate.opened:
+        gate.pending.append(message)
+        return
+    await _deliver_message(message)
+
+async def _deliver_message(message: MessageRecord):
+    state = current_state()
+    state.messages.append(message)
+    if not state.persisted:
+        state.save()
+    session_registry.touch(state)
+    schedule_summary_if_needed()
+
+    await _send_frame(message.frame(), state)
+
+async def broadcast_event(payload: Dict[str, Any]):
+    """向所有客户端推送不进入消息历史的事件（如流式增量）"""
+    gate = _broadcast_gate.get()
+    if gate is not None and not gate.opened:
+        gate.pending.append(payload)
+        return
+    await _deliver_event(payload)
+
+async def _deliver_event(payload: Dict[str, Any], state: Optional[OrchestraState] = None):
+    await _send_frame(json.dumps(payload, ensure_ascii=False), state or current_state())
+
+async def _send_frame(frame: str, state: OrchestraState):
+    """同一帧只序列化一次，发送给会话的所有客户端"""
     disconnected = []
-    for websocket in orchestra_state.websocket_connections:
+    for websocket in state.websocket_connections:
         try:
-            await websocket.send_text(json.dumps({
-                "type": "new_message",
-                "message": message.model_dump(mode="json")
-            }))
+            await websocket.send_text(frame)
         except:
             disconnected.append(websocket)
 
     for ws in disconnected:
-        orchestra_state.websocket_connections.remove(ws)
+        if ws in state.websocket_connections:
+            state.websocket_connections.remove(ws)
+
+async def broadcast_message_all(role: RoleType, message_type: MessageType, content: str):
+    """向所有有连接或有进行中轮次的会话各写入一条消息（如主机熔断），这些会话排队中的请求随后会快速失败"""
+    for state in session_registry.sessions():
+        if state.websocket_connections or state.turn_lock.locked():
+            # 以目标会话为当前会话写入，消息序号、总结等都归属该会话
+            token = _current_session.set(state)
+            try:
+                await _deliver_message(MessageRecord(role, message_type, content))
+            finally:
+                _current_session.reset(token)
+
+async def broadcast_model_status(model: str):
+    """只向选中该模型的会话推送模型状态"""
+    payload = model_warmer.event(model)
+    for state in session_registry.sessions():
+        if state.websocket_connections and state.selected_model == model:
+            await _deliver_event(payload, state)
 
 async def handle_human_input(content: str):
+    """在取得会话的轮次锁之前合并相同的输入：后到的等待者共享排队中或进行中的那一轮，
+    所有等待者都取消时该轮才会被取消"""
+    await turn_singleflight.do(turn_key(current_state(), content), lambda subscribers: _run_turn(content))
+
+async def _run_turn(content: str):
+    async with current_state().turn_lock:
+        await _handle_human_input(content)
+
+async def _handle_human_input(content: str):
     logger.info(f"收到人类输入: {content}")  # 完整记录
 
-    message = Message(
-        id=str(uuid.uuid4()),
-        role=RoleType.HUMAN,
-        message_type=MessageType.USER_INPUT,
-        content=content,
-        timestamp=datetime.now()
-    )
+    message = MessageRecord(RoleType.HUMAN, MessageType.USER_INPUT, content)
 
     await broadcast_message(message)
 
+    if SPECULATIVE_PRODUCT_AI:
+        await run_speculative_product_turn(content)
+        return
+
     discrimination = await trigger_discrimination_ai(content, RoleType.PRODUCT_AI)
+    await broadcast_discrimination(discrimination)
 
-    message = Message(
-        id=str(uuid.uuid4()),
-        role=RoleType.ETHER,
-        message_type=MessageType.AI_RESPONSE,
-        content=discrimination + ' ' + AI_PROMPTS[RoleType.PRODUCT_AI]['discrimination_map'][discrimination],
-        timestamp=datetime.now()
-    )
+    await trigger_product_ai(content, AI_PROMPTS[RoleType.PRODUCT_AI]['discrimination_map'][discrimination])
+
+async def broadcast_discrimination(discrimination: str):
+    # trigger_discrimination_ai保证返回有对应提示词的选项
+    current_state().last_discrimination = discrimination
+    message = MessageRecord(RoleType.ETHER, MessageType.AI_RESPONSE,
+                            discrimination + ' ' + AI_PROMPTS[RoleType.PRODUCT_AI]['discrimination_map'][discrimination])
 
     await broadcast_message(message)
 
-    await trigger_product_ai(content, AI_PROMPTS[RoleType.PRODUCT_AI]['discrimination_map'][discrimination])
+class SpeculationStats:
+    """推测执行的命中率与节省/浪费的时间"""
+
+    def __init__(self):
+        self.attempts = 0
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self.saved_seconds = 0.0
+        self.wasted_seconds = 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": SPECULATIVE_PRODUCT_AI,
+            "attempts": self.attempts,
+            "hits": self.hits,
+            "misses": self.misses,
+            "skipped": self.skipped,
+            "hit_rate": self.hits / self.attempts if self.attempts else None,
+            "saved_seconds": self.saved_seconds,
+            "wasted_seconds": self.wasted_seconds,
+        }
+
+speculation_stats = SpeculationStats()
+
+def predict_discrimination(user_input: str, role: RoleType) -> Optional[str]:
+    """推测最可能的分支：优先使用本地分类器的首选结果，其次沿用最近一次的判别结果"""
+    discrimination_map = discrimination_routes(role)
+    prediction = intent_service.predict(user_input)
+    if prediction is not None and prediction.label in discrimination_map:
+        return prediction.label
+    last_discrimination = current_state().last_discrimination
+    if last_discrimination in discrimination_map:
+        return last_discrimination
+    return None
+
+async def _run_gated(gate: BroadcastGate, coro):
+    # 在独立任务的上下文中设置，不影响其他协程
+    _broadcast_gate.set(gate)
+    return await coro
+
+async def run_speculative_product_turn(content: str):
+    """判别话语类型的同时按预测分支推测生成产品AI回复；预测正确则放行，错误则取消并按实际分支重新生成"""
+    role = RoleType.PRODUCT_AI
+    discrimination_map = AI_PROMPTS[role]['discrimination_map']
+    predicted = predict_discrimination(content, role)
+    start_time = time.monotonic()
+    discrimination_task = asyncio.create_task(trigger_discrimination_ai(content, role))
+    # 命中缓存或本地分类器时判别会立即完成，此时无需推测
+    await asyncio.sleep(0)
+
+    # 只有一个空闲槽位时推测生成会挡住判别请求，反而更慢
+    if discrimination_task.done() or predicted is None or \
+            ollama_backends.scheduler.free_slots(model_router.model_for(role.value)) < 2:
+        speculation_stats.skipped += 1
+        discrimination = await discrimination_task
+        await broadcast_discrimination(discrimination)
+        await trigger_product_ai(content, discrimination_map[discrimination])
+        return
+
+    speculation_stats.attempts += 1
+    gate = BroadcastGate()
+    speculative_task = asyncio.create_task(_run_gated(gate, trigger_product_ai(content, discrimination_map[predicted])))
+    try:
+        discrimination = await discrimination_task
+        discrimination_time = time.monotonic() - start_time
+        await broadcast_discrimination(discrimination)
+
+        if discrimination == predicted:
+            speculation_stats.hits += 1
+            speculation_stats.saved_seconds += discrimination_time
+            logger.info(f"推测执行命中: {predicted}，节省 {discrimination_time:.2f}秒")
+            await gate.open()
+            await speculative_task
+            return
+
+        speculation_stats.misses += 1
+        speculation_stats.wasted_seconds += time.monotonic() - start_time
+        logger.info(f"推测执行未命中: 预测 {predicted}，实际 {discrimination}，重新生成")
+        speculative_task.cancel()
+        try:
+            await speculative_task
+        except asyncio.CancelledError:
+            pass
+    except BaseException:
+        speculative_task.cancel()
+        discrimination_task.cancel()
+        raise
+
+    await trigger_product_ai(content, discrimination_map[discrimination])
+
+def discrimination_labels(role: RoleType) -> List[str]:
+    """判别提示词中列出的全部选项数字"""
+    return re.findall(r"^- (\d+)\.", AI_PROMPTS[role][TalkAbout.ABOUT_DISCRIMINATION], re.M)
+
+def discrimination_routes(role: RoleType) -> Dict[str, TalkAbout]:
+    """discrimination_map中有对应提示词、可以继续生成回复的选项"""
+    prompts = AI_PROMPTS[role]
+    return {label: about for label, about in prompts['discrimination_map'].items() if about in prompts}
+
+def discrimination_payload(role: RoleType) -> Dict[str, Any]:
+    """分类模式的请求参数：确定性解码、单步生成，并用JSON schema约束为选项数字之一"""
+    payload: Dict[str, Any] = {
+        "options": {
+            "num_predict": DISCRIMINATION_NUM_PREDICT,
+            "temperature": 0,
+            "stop": ["\n"]
+        }
+    }
+    if DISCRIMINATION_USE_FORMAT:
+        payload["format"] = {"type": "integer", "enum": [int(label) for label in discrimination_labels(role)]}
+    return payload
+
+_CHINESE_DIGITS = {"一": "1", "二": "2", "三": "3", "四": "4", "五": "5", "六": "6", "七": "7", "八": "8", "九": "9"}
 
-async def trigger_discrimination_ai(user_input: str, role: RoleType):
+def parse_discrimination(response: Optional[str], role: RoleType) -> Optional[str]:
+    """从模型输出中解析选项数字，容忍空白、引号、JSON、全角数字、中文数字和多余说明文字"""
+    if not response:
+        return None
+    text = response.strip().translate(str.maketrans("０１２３４５６７８９", "0123456789"))
+    try:
+        value = json.loads(text)
+        if isinstance(value, dict):
+            value = next(iter(value.values()), "")
+        text = str(value)
+    except (ValueError, TypeError):
+        pass
+
+    labels = discrimination_labels(role)
+    if text in labels:
+        return text
+    match = re.search(r"\d+", text)
+    if match and match.group() in labels:
+        return match.group()
+    for char in text:
+        if _CHINESE_DIGITS.get(char) in labels:
+            return _CHINESE_DIGITS[char]
+    return None
+
+_RUN_SINGLE = object()  # 批处理结果的哨兵值：由调用方自行发起单条判别
+
+class DiscriminationBatcher:
+    """把等待窗口内到达的判别请求按(模型, 角色)合并成一次LLM调用，
+    用JSON schema约束输出为与消息一一对应的选项数组，再把结果分发回各等待方"""
+
+    def __init__(self, max_size: int, max_wait: float):
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self._pending: Dict[Tuple[str, RoleType], List[Tuple[str, asyncio.Future]]] = {}
+        self._timers: Dict[Tuple[str, RoleType], asyncio.TimerHandle] = {}
+        self._tasks: set = set()
+        self.batches = 0
+        self.batched_requests = 0
+        self.single_requests = 0
+        self.batch_failures = 0
+        self.max_batch = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 1 and self.max_wait > 0
+
+    async def classify(self, user_input: str, prompt: str, role: RoleType) -> Tuple[Optional[str], bool]:
+        """返回模型的原始判别输出（由parse_discrimination解析）以及是否来自批量调用。
+        批量调用只发送各条消息本身，不带对话历史，结果可能与单条判别不同"""
+        # 两种方式都在调用方的会话中回显提示词，界面上的过程一致
+        await broadcast_message(MessageRecord(RoleType.ETHER, MessageType.SYSTEM_INFO, prompt))
+        if self.enabled:
+            key = (model_router.model_for(ROUTE_DISCRIMINATION), role)
+            future = asyncio.get_running_loop().create_future()
+            batch = self._pending.setdefault(key, [])
+            batch.append((user_input, future))
+            if len(batch) >= self.max_size:
+                self._flush(key)
+            elif len(batch) == 1:
+                self._timers[key] = asyncio.get_running_loop().call_later(self.max_wait, self._flush, key)
+            result = await future
+            if result is not _RUN_SINGLE:
+                return result, True
+
+        # 窗口内只有这一条请求，或批量调用失败：在调用方协程中发起，取消时可以中止上游请求
+        self.single_requests += 1
+        response = await call_ollama_api(prompt, RoleType.PRODUCT_AI, priority=RequestPriority.CLASSIFICATION,
+                                         extra_payload=discrimination_payload(role), route=ROUTE_DISCRIMINATION,
+                                         echo=False)
+        return response, False
+
+    def _flush(self, key: Tuple[str, RoleType]):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = [item for item in self._pending.pop(key, []) if not item[1].done()]
+        if len(batch) == 1:
+            batch[0][1].set_result(_RUN_SINGLE)
+        elif batch:
+            task = asyncio.create_task(self._run_batch(key, batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+            def cancel_if_abandoned(_):
+                if all(future.cancelled() for _, future in batch):
+                    task.cancel()
+            for _, future in batch:
+                future.add_done_callback(cancel_if_abandoned)
+
+    async def _run_batch(self, key: Tuple[str, RoleType], batch: List[Tuple[str, asyncio.Future]]):
+        model, role = key
+        request_id = str(uuid.uuid4())[:8]
+        self.batches += 1
+        self.batched_requests += len(batch)
+        self.max_batch = max(self.max_batch, len(batch))
+        logger.info(f"[{request_id}] 批量判别话语类型: {len(batch)}条, 模型: {model}")
+        try:
+            answers = await self._request(request_id, model, role, [text for text, _ in batch])
+        except Exception as e:
+            self.batch_failures += 1
+            logger.warning(f"[{request_id}] 批量判别失败，改为逐条判别: {str(e)}")
+            answers = [_RUN_SINGLE] * len(batch)
+
+        for (_, future), answer in zip(batch, answers):
+            if not future.done():
+                future.set_result(answer)
+
+    async def _request(self, request_id: str, model: str, role: RoleType, texts: List[str]) -> List[str]:
+        labels = discrimination_labels(role)
+        options = "\n".join(re.findall(r"^- \d+\..*$", AI_PROMPTS[role][TalkAbout.ABOUT_DISCRIMINATION], re.M))
+        items = "\n".join(f"- [{i}] {json.dumps(text, ensure_ascii=False)}" for i, text in enumerate(texts, 1))
+        messages = [
+            {"role": "system", "content": f"""# 判断话语类型
+你会收到多条人类输入的消息，请分别判断每条消息属于以下哪种类型的消息：
+{options}
+
+按消息顺序为每条消息给出一个选项数字，以JSON返回，形如 {{"answers": [1, 3]}}，不要返回其他任何内容"""},
+            {"role": "user", "content": f"以下{len(texts)}条消息需要批量判断：\n{items}"},
+        ]
+        extra_payload = model_router.payload(ROUTE_DISCRIMINATION, {
+            "options": {"temperature": 0, "num_predict": 16 + 4 * len(texts)},
+            "format": {
+                "type": "object",
+                "properties": {
+                    "answers": {
+                        "type": "array",
+                        "items": {"type": "integer", "enum": [int(label) for label in labels]},
+                        "minItems": len(texts),
+                        "maxItems": len(texts),
+                    }
+                },
+                "required": ["answers"],
+            },
+        })
+        result = await request_ollama_chat(request_id, messages, role, model,
+                                           priority=RequestPriority.CLASSIFICATION, extra_payload=extra_payload)
+        content = result.get("message", {}).get("content", "")
+        answers = json.loads(content).get("answers")
+        if not isinstance(answers, list) or len(answers) != len(texts):
+            raise ValueError(f"批量判别结果数量不匹配: {content!r}")
+        logger.info(f"[{request_id}] 批量判别结果: {answers}")
+        return [str(answer) for answer in answers]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "max_size": self.max_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "batches": self.batches,
+            "batched_requests": self.batched_requests,
+            "single_requests": self.single_requests,
+            "batch_failures": self.batch_failures,
+            "max_batch": self.max_batch,
+            "avg_batch": self.batched_requests / self.batches if self.batches else None,
+        }
+
+discrimination_batcher = DiscriminationBatcher(DISCRIMINATION_BATCH_MAX_SIZE, DISCRIMINATION_BATCH_MAX_WAIT_MS / 1000)
+
+async def trigger_discrimination_ai(user_input: str, role: RoleType) -> str:
+    """判别话语类型，始终返回有对应提示词的选项（见discrimination_routes）"""
+    label = await _discriminate(user_input, role)
+    if label in discrimination_routes(role):
+        return label
+    fallback = AI_PROMPTS[role]['discrimination_fallback']
+    intent_service.unrouted_fallbacks += 1
+    logger.warning(f"判别结果 {label} 没有对应的提示词，使用默认选项 {fallback}")
+    return fallback
+
+async def _discriminate(user_input: str, role: RoleType) -> str:
+    """依次尝试缓存、本地分类器、嵌入分类器和LLM，返回discrimination_map中存在的选项"""
     prompt = f"""{AI_PROMPTS[role][TalkAbout.ABOUT_DISCRIMINATION]}\n{user_input}"""
-    response = await call_ollama_api(prompt, RoleType.PRODUCT_AI)
-    return response
+    model = model_router.model_for(ROUTE_DISCRIMINATION)
+
+    cached = discrimination_cache.get(model, prompt)
+    if cached is not None:
+        logger.info(f"话语类型判别命中缓存: {cached}")
+        return cached
+
+    discrimination_map = AI_PROMPTS[role]['discrimination_map']
+    prediction = intent_service.predict(user_input)
+    if intent_service.is_confident(prediction, discrimination_map):
+        intent_service.local_answers += 1
+        logger.info(f"本地分类器判别话语类型: {prediction.label} (置信度 {prediction.confidence:.3f})")
+        if random.random() < INTENT_SHADOW_RATE:
+            intent_service.shadow_check(user_input, prompt, role, prediction)
+        return prediction.label
+
+    embedding_prediction = await embedding_intent.predict(user_input)
+    if embedding_intent.is_confident(embedding_prediction, discrimination_map):
+        embedding_intent.answers += 1
+        logger.info(f"嵌入分类器判别话语类型: {embedding_prediction.label} (置信度 {embedding_prediction.confidence:.3f})")
+        return embedding_prediction.label
+
+    intent_service.llm_fallbacks += 1
+    response, batched = await discrimination_batcher.classify(user_input, prompt, role)
+    label = parse_discrimination(response, role)
+    if label is not None and prediction is not None:
+        await intent_service.record_agreement(user_input, prediction, label)
+    if label is not None and embedding_prediction is not None:
+        embedding_intent.record_agreement(embedding_prediction, label)
+    if label in discrimination_map:
+        # 只缓存带完整对话历史的单条判别的有效结果；批量判别不带历史，不写入共享缓存
+        if not batched:
+            discrimination_cache.put(model, prompt, label)
+        return label
+
+    fallback = AI_PROMPTS[role]['discrimination_fallback']
+    intent_service.parse_fallbacks += 1
+    logger.warning(f"无法从判别结果中得到有效分支: {response!r}，使用默认选项 {fallback}")
+    return fallback
+
+async def shadow_check_discrimination(user_input: str, prompt: str, role: RoleType, prediction: IntentPrediction):
+    """后台以批处理优先级让LLM复核本地判别结果，不向客户端广播"""
+    request_id = str(uuid.uuid4())[:8]
+    try:
+        messages = build_chat_messages(prompt, role, get_chat_messages_since_last_summary())
+        result = await request_ollama_chat(request_id, messages, role, model_router.model_for(ROUTE_DISCRIMINATION),
+                                           priority=RequestPriority.BATCH,
+                                           extra_payload=model_router.payload(ROUTE_DISCRIMINATION, discrimination_payload(role)))
+        llm_label = parse_discrimination(result.get("message", {}).get("content", ""), role)
+        if llm_label is not None:
+            intent_service.shadow_checks += 1
+            await intent_service.record_agreement(user_input, prediction, llm_label)
+    except Exception as e:
+        logger.warning(f"[{request_id}] 本地判别复核失败: {str(e)}")
 
 
 async def trigger_product_ai(user_input: str, about: TalkAbout):
@@ -301,16 +2787,11 @@ async def trigger_product_ai(user_input: str, about: TalkAbout):
 # 用户输入  \n{user_input}
 """
 
-    response = await call_ollama_api(prompt, RoleType.PRODUCT_AI)
+    message_id = str(uuid.uuid4())
+    response = await call_ollama_api(prompt, RoleType.PRODUCT_AI, stream_message_id=message_id)
     if response:
         logger.info(f"产品AI响应生成成功，长度: {len(response)}字符")
-        message = Message(
-            id=str(uuid.uuid4()),
-            role=RoleType.PRODUCT_AI,
-            message_type=MessageType.AI_RESPONSE,
-            content=response,
-            timestamp=datetime.now()
-        )
+        message = MessageRecord(RoleType.PRODUCT_AI, MessageType.AI_RESPONSE, response, id=message_id)
         await broadcast_message(message)
     else:
         logger.error("产品AI响应生成失败")
@@ -330,25 +2811,24 @@ async def trigger_architect_ai(requirement: str):
 4. 制定开发计划
 """
 
-    response = await call_ollama_api(prompt, RoleType.ARCHITECT_AI)
+    message_id = str(uuid.uuid4())
+    response = await call_ollama_api(prompt, RoleType.ARCHITECT_AI, stream_message_id=message_id)
     if response:
         logger.info(f"架构AI方案设计成功，长度: {len(response)}字符")
-        message = Message(
-            id=str(uuid.uuid4()),
-            role=RoleType.ARCHITECT_AI,
-            message_type=MessageType.AI_RESPONSE,
-            content=response,
-            timestamp=datetime.now()
-        )
+        message = MessageRecord(RoleType.ARCHITECT_AI, MessageType.AI_RESPONSE, response, id=message_id)
         await broadcast_message(message)
     else:
         logger.error("架构AI方案设计失败")
 
 def get_chat_messages_since_last_summary() -> List[Dict[str, str]]:
-    """获取自上次总结后的所有消息，格式化为chat格式"""
+    """获取最近一次总结和之后的所有消息，格式化为chat格式"""
     messages_since_summary = get_messages_since_last_summary()
     
     chat_messages = []
+    checkpoint = current_state().latest_summary()
+    if checkpoint is not None:
+        # 总结只在生成新检查点时变化，放在历史最前面不会破坏提示词前缀缓存
+        chat_messages.append({"role": "system", "content": f"之前的对话总结：\n{checkpoint.summary}"})
     for msg in messages_since_summary:
         # 跳过系统消息(ETHER)
         if msg.role == RoleType.ETHER:
@@ -367,151 +2847,273 @@ def get_chat_messages_since_last_summary() -> List[Dict[str, str]]:
     
     return chat_messages
 
-async def call_ollama_api(prompt: str, role: RoleType) -> Optional[str]:
+def build_chat_messages(prompt: str, role: RoleType, chat_messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """按PROMPT_LAYOUT组装chat消息"""
+    if PROMPT_LAYOUT == "system_first":
+        return [{"role": "system", "content": prompt}] + chat_messages
+
+    # 前缀（角色前言+历史）在各轮之间保持不变，变化的指令追加在末尾
+    preamble = f"你是OrchestraAI多AI协作平台中的{get_role_display_name(role)}。以下是对话历史，请按照最后一条指令完成任务。"
+    return [{"role": "system", "content": preamble}] + chat_messages + [{"role": "user", "content": prompt}]
+
+class PromptCacheStats:
+    """记录prompt_eval_count与提示词规模，用于验证Ollama前缀缓存的复用情况"""
+
+    def __init__(self, max_records: int = 200):
+        self.records: deque = deque(maxlen=max_records)
+
+    def record(self, messages: List[Dict[str, str]], history_messages: int, result: Dict[str, Any]):
+        if "prompt_eval_count" not in result:
+            return
+        prompt_chars = sum(len(m["content"]) for m in messages)
+        history_chars = sum(len(m["content"]) for m in messages[1:1 + history_messages])
+        self.records.append({
+            "layout": PROMPT_LAYOUT,
+            "history_messages": history_messages,
+            "history_chars": history_chars,
+            "prompt_chars": prompt_chars,
+            "prompt_eval_count": result.get("prompt_eval_count", 0),
+            "prompt_eval_duration": result.get("prompt_eval_duration", 0) / 1e9,
+        })
+
+    def stats(self) -> Dict[str, Any]:
+        layouts: Dict[str, Dict[str, Any]] = {}
+        for record in self.records:
+            layout = layouts.setdefault(record["layout"], {
+                "calls": 0, "history_chars": 0, "prompt_chars": 0, "prompt_eval_count": 0, "prompt_eval_duration": 0.0
+            })
+            layout["calls"] += 1
+            for field in ("history_chars", "prompt_chars", "prompt_eval_count", "prompt_eval_duration"):
+                layout[field] += record[field]
+        summary = {
+            name: {
+                "calls": data["calls"],
+                "avg_history_chars": data["history_chars"] / data["calls"],
+                "avg_prompt_chars": data["prompt_chars"] / data["calls"],
+                "avg_prompt_eval_count": data["prompt_eval_count"] / data["calls"],
+                "avg_prompt_eval_duration": data["prompt_eval_duration"] / data["calls"],
+                # 前缀缓存命中时，实际评估的token数远小于提示词规模
+                "eval_count_per_prompt_char": data["prompt_eval_count"] / data["prompt_chars"] if data["prompt_chars"] else 0.0,
+            }
+            for name, data in layouts.items()
+        }
+        return {"layout": PROMPT_LAYOUT, "layouts": summary, "recent": list(self.records)[-20:]}
+
+prompt_cache_stats = PromptCacheStats()
+
+class DeltaSubscriber:
+    """共享的流式生成的一个接收方：记录发起调用时的会话和推测执行闸门，增量按各自的消息id推送"""
+
+    __slots__ = ("message_id", "state", "gate")
+
+    def __init__(self, message_id: str):
+        self.message_id = message_id
+        self.state = current_state()
+        self.gate = _broadcast_gate.get()
+
+    async def send(self, role: RoleType, delta: str):
+        payload = {"type": "message_delta", "message_id": self.message_id, "role": role.value, "delta": delta}
+        if self.gate is not None and not self.gate.opened:
+            self.gate.pending.append(payload)
+            return
+        await _deliver_event(payload, self.state)
+
+async def call_ollama_api(prompt: str, role: RoleType, stream_message_id: Optional[str] = None,
+                          priority: RequestPriority = RequestPriority.INTERACTIVE,
+                          extra_payload: Optional[Dict[str, Any]] = None,
+                          route: Optional[str] = None, echo: bool = True) -> Optional[str]:
+    """调用Ollama chat接口；传入stream_message_id时以流式读取并推送message_delta增量，
+    extra_payload（如options、format）会合并到请求体中；route指定路由表中的调用类型，默认按角色路由；
+    echo为False时不再回显提示词（调用方已回显）"""
     request_id = str(uuid.uuid4())[:8]
-    logger.info(f"[{request_id}] 开始Ollama API调用 - 角色: {role.value}, 模型: {orchestra_state.selected_model}")
+    route = route or role.value
+    model = model_router.model_for(route)
+    payload = model_router.payload(route, extra_payload)
+    logger.info(f"[{request_id}] 开始Ollama API调用 - 角色: {role.value}, 模型: {model}")
 
     try:
-        ether_message = Message(
-            id=str(uuid.uuid4()),
-            role=RoleType.ETHER,
-            message_type=MessageType.SYSTEM_INFO,
-            content=prompt,
-            timestamp=datetime.now()
-        )
-        await broadcast_message(ether_message)
+        if echo:
+            ether_message = MessageRecord(RoleType.ETHER, MessageType.SYSTEM_INFO, prompt)
+            await broadcast_message(ether_message)
 
         # 获取对话历史
         chat_messages = get_chat_messages_since_last_summary()
         
         # 构建chat格式的消息
-        messages = [
-            {"role": "system", "content": prompt}
-        ]
-        messages.extend(chat_messages)
+        messages = build_chat_messages(prompt, role, chat_messages)
 
         # 记录Ollama输入
         logger.info(f"[{request_id}] ===== OLLAMA输入 =============================")
-        logger.info(f"[{request_id}] 模型: {orchestra_state.selected_model}")
+        logger.info(f"[{request_id}] 模型: {model}")
         logger.info(f"[{request_id}] 系统Prompt: {prompt}")
         logger.info(f"[{request_id}] 对话历史消息数: {len(chat_messages)}")
+        logger.info(f"[{request_id}] 提示词布局: {PROMPT_LAYOUT}")
         logger.info(f"[{request_id}] ================================================")
 
         start_time = datetime.now()
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "http://localhost:11434/api/chat",
-                json={
-                    "model": orchestra_state.selected_model,
-                    "messages": messages,
-                    "stream": False
-                },
-                timeout=1000.0
-            )
+        # 相同模型、接口和完整消息列表的并发调用共享同一次上游生成，流式增量推送给每个等待者各自的会话
+        key = ollama_singleflight.make_key(model, "/api/chat", messages, payload)
+        result = await ollama_singleflight.do(
+            key,
+            lambda subscribers: request_ollama_chat(request_id, messages, role, model,
+                                                    subscribers if stream_message_id else None, priority, payload),
+            DeltaSubscriber(stream_message_id) if stream_message_id else None
+        )
 
-            duration = (datetime.now() - start_time).total_seconds()
-            logger.info(f"[{request_id}] API调用耗时: {duration:.2f}秒")
+        duration = (datetime.now() - start_time).total_seconds()
+        logger.info(f"[{request_id}] API调用耗时: {duration:.2f}秒")
 
-            if response.status_code == 200:
-                result = response.json()
-                response_text = result.get("message", {}).get("content", "")
-
-                # 记录响应详情（完整版本）
-                logger.info(f"[{request_id}] ===== OLLAMA输出 =============================")
-                logger.info(f"[{request_id}] 响应长度: {len(response_text)}字符")
-                logger.info(f"[{request_id}] 输出内容: {response_text}")
-                logger.info(f"[{request_id}] ================================================")
-
-                # 记录额外的响应信息
-                if 'eval_count' in result:
-                    logger.info(f"[{request_id}] Token统计 - 输出: {result.get('eval_count', 0)}, 输入: {result.get('prompt_eval_count', 0)}")
-                if 'total_duration' in result:
-                    total_duration_sec = result['total_duration'] / 1e9
-                    logger.info(f"[{request_id}] 总处理时间: {total_duration_sec:.2f}秒")
-
-                return response_text
-            else:
-                error_msg = f"Ollama API调用失败: {response.status_code}"
-                logger.error(f"[{request_id}] {error_msg} - 响应内容: {response.text}")
-
-                error_message = Message(
-                    id=str(uuid.uuid4()),
-                    role=RoleType.ETHER,
-                    message_type=MessageType.ERROR,
-                    content=error_msg,
-                    timestamp=datetime.now()
-                )
-                await broadcast_message(error_message)
-                return None
+        response_text = result.get("message", {}).get("content", "")
+
+        # 记录响应详情（完整版本）
+        logger.info(f"[{request_id}] ===== OLLAMA输出 =============================")
+        logger.info(f"[{request_id}] 响应长度: {len(response_text)}字符")
+        logger.info(f"[{request_id}] 输出内容: {response_text}")
+        logger.info(f"[{request_id}] ================================================")
+
+        # 记录额外的响应信息
+        if 'eval_count' in result:
+            logger.info(f"[{request_id}] Token统计 - 输出: {result.get('eval_count', 0)}, 输入: {result.get('prompt_eval_count', 0)}")
+        prompt_cache_stats.record(messages, len(chat_messages), result)
+        if 'total_duration' in result:
+            total_duration_sec = result['total_duration'] / 1e9
+            logger.info(f"[{request_id}] 总处理时间: {total_duration_sec:.2f}秒")
+
+        return response_text
+
+    except OllamaCircuitOpenError as e:
+        # 熔断时已统一广播过一次错误，这里只记录日志
+        logger.warning(f"[{request_id}] 请求被熔断器拒绝: {str(e)}")
+        return None
 
     except Exception as e:
-        error_msg = f"调用Ollama API时发生错误: {str(e)}"
+        if isinstance(e, OllamaAPIError):
+            error_msg = str(e)
+        else:
+            error_msg = f"调用Ollama API时发生错误: {str(e)}"
         logger.error(f"[{request_id}] {error_msg}", exc_info=True)
 
-        error_message = Message(
-            id=str(uuid.uuid4()),
-            role=RoleType.ETHER,
-            message_type=MessageType.ERROR,
-            content=error_msg,
-            timestamp=datetime.now()
-        )
+        error_message = MessageRecord(RoleType.ETHER, MessageType.ERROR, error_msg)
         await broadcast_message(error_message)
         return None
 
+async def request_ollama_chat(request_id: str, messages: List[Dict[str, str]], role: RoleType, model: str,
+                              stream_to: Optional[List[DeltaSubscriber]] = None,
+                              priority: RequestPriority = RequestPriority.INTERACTIVE,
+                              extra_payload: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """向Ollama发起一次chat请求，返回原始结果；非200状态码抛出OllamaAPIError。
+    传入stream_to时以流式读取，增量推送给列表中（随时可能增减）的订阅者"""
+    if stream_to is not None and OLLAMA_STREAMING:
+        return await stream_ollama_chat(request_id, messages, role, model, stream_to, priority, extra_payload)
+
+    response = await ollama_backends.post(
+        "/api/chat",
+        model=model,
+        priority=priority,
+        json={
+            "model": model,
+            "messages": messages,
+            "stream": False,
+            "keep_alive": keep_alive_value(),
+            **(extra_payload or {})
+        }
+    )
+    if response.status_code != 200:
+        logger.error(f"[{request_id}] Ollama API调用失败: {response.status_code} - 响应内容: {response.text}")
+        raise OllamaAPIError(f"Ollama API调用失败: {response.status_code}")
+    return response.json()
+
+async def stream_ollama_chat(request_id: str, messages: List[Dict[str, str]], role: RoleType, model: str,
+                             subscribers: List[DeltaSubscriber],
+                             priority: RequestPriority = RequestPriority.INTERACTIVE,
+                             extra_payload: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """读取Ollama的NDJSON流，逐块推送message_delta，返回与非流式接口同构的结果"""
+    start_time = datetime.now()
+    first_token_time = None
+    parts: List[str] = []
+    result: Dict[str, Any] = {}
+
+    async with ollama_backends.stream(
+        "POST",
+        "/api/chat",
+        model=model,
+        priority=priority,
+        json={
+            "model": model,
+            "messages": messages,
+            "stream": True,
+            "keep_alive": keep_alive_value(),
+            **(extra_payload or {})
+        }
+    ) as response:
+        if response.status_code != 200:
+            body = await response.aread()
+            logger.error(f"[{request_id}] Ollama API调用失败: {response.status_code} - 响应内容: {body.decode(errors='replace')}")
+            raise OllamaAPIError(f"Ollama API调用失败: {response.status_code}")
+
+        async for line in response.aiter_lines():
+            if not line.strip():
+                continue
+            chunk = json.loads(line)
+            if "error" in chunk:
+                raise RuntimeError(f"Ollama流式响应错误: {chunk['error']}")
+
+            delta = chunk.get("message", {}).get("content", "")
+            if delta:
+                if first_token_time is None:
+                    first_token_time = datetime.now()
+                    ttft = (first_token_time - start_time).total_seconds()
+                    logger.info(f"[{request_id}] 首个token耗时: {ttft:.2f}秒")
+                parts.append(delta)
+                for subscriber in list(subscribers):
+                    # 推送过程中可能有订阅者离开
+                    if subscriber in subscribers:
+                        await subscriber.send(role, delta)
+
+            if chunk.get("done"):
+                result = chunk
+                break
+
+    result["message"] = {"role": "assistant", "content": "".join(parts)}
+    return result
+
 async def ensure_summary_updated():
     """确保总结是最新的，如果需要则生成新总结"""
-    messages_since_last_summary = get_messages_since_last_summary()
-
+    state = current_state()
     # 如果没有总结，或自上次总结后有新消息，则生成新总结
-    if not orchestra_state.conversation_summaries or len(messages_since_last_summary) > 0:
+    if not state.summary_checkpoints or state.messages.last_seq > state.summary_covered():
         logger.info("检测到需要更新总结，开始生成...")
         await generate_conversation_summary()
 
-def get_messages_since_last_summary() -> List[Message]:
+def schedule_summary_if_needed():
+    """自上次总结（或上次失败的尝试）后累计的消息足够多时，在后台生成新总结"""
+    if SUMMARY_TRIGGER_MESSAGES <= 0:
+        return
+    state = current_state()
+    if state.summary_task is not None and not state.summary_task.done():
+        return
+    since = max(state.summary_covered(), state.summary_attempted)
+    if state.messages.last_seq - since >= SUMMARY_TRIGGER_MESSAGES:
+        state.summary_task = asyncio.create_task(generate_conversation_summary())
+
+def get_messages_since_last_summary() -> List[MessageRecord]:
     """获取自上次总结后的所有消息"""
-    if not orchestra_state.conversation_summaries:
-        return orchestra_state.messages
-
-    # 找到最后一次总结的时间标记
-    last_summary_time = None
-    for msg in reversed(orchestra_state.messages):
-        if (msg.role == RoleType.ETHER and
-            msg.message_type == MessageType.SYSTEM_INFO and
-            "已生成对话总结" in msg.content):
-            last_summary_time = msg.timestamp
-            break
-
-    if last_summary_time:
-        return [msg for msg in orchestra_state.messages if msg.timestamp > last_summary_time]
-    else:
-        return orchestra_state.messages
+    state = current_state()
+    return state.messages.since(state.summary_covered())
 
 async def generate_conversation_summary():
     """生成对话总结"""
+    state = current_state()
     try:
-        if len(orchestra_state.messages) < 4:  # 消息太少不需要总结
+        if len(state.messages) < 4:  # 消息太少不需要总结
             return
 
         logger.info("开始生成对话总结")
 
-        # 获取当前对话段落的所有消息（自上次总结后的所有消息）
-        if orchestra_state.conversation_summaries:
-            # 找到最后一次总结后的所有消息
-            last_summary_time = None
-            for msg in reversed(orchestra_state.messages):
-                if (msg.role == RoleType.ETHER and
-                    msg.message_type == MessageType.SYSTEM_INFO and
-                    "已生成对话总结" in msg.content):
-                    last_summary_time = msg.timestamp
-                    break
-
-            if last_summary_time:
-                current_conversation = [msg for msg in orchestra_state.messages if msg.timestamp > last_summary_time]
-            else:
-                current_conversation = orchestra_state.messages[-20:]  # 如果找不到标记，使用最近20条
-        else:
-            # 第一次总结，使用所有消息
-            current_conversation = orchestra_state.messages
+        # 获取当前对话段落的所有消息（自上次总结后的所有消息），生成期间新到的消息留给下一次总结
+        covered = state.messages.last_seq
+        state.summary_attempted = covered
+        current_conversation = state.messages.range(state.summary_covered() + 1, covered + 1)
 
         # 如果消息太少，不生成总结
         if len(current_conversation) < 3:
@@ -527,13 +3129,13 @@ async def generate_conversation_summary():
             if msg.role == RoleType.ETHER:
                 continue
             role_name = get_role_display_name(msg.role)
-            timestamp = msg.timestamp.strftime("%H:%M:%S")
+            timestamp = datetime.fromtimestamp(msg.timestamp).strftime("%H:%M:%S")
             messages_text.append(f"[{timestamp}] {role_name}: {msg.content}")
 
         # 检查是否有之前的总结，如果有，则生成增量总结
         previous_summary = ""
-        if orchestra_state.conversation_summaries:
-            latest_summary = list(orchestra_state.conversation_summaries.values())[-1]
+        if state.summary_checkpoints:
+            latest_summary = state.summary_checkpoints[-1].summary
             previous_summary = f"""
 之前的对话总结：
 {latest_summary}
@@ -571,32 +3173,21 @@ async def generate_conversation_summary():
 
         if summary:
             # 保存总结
-            summary_key = f"summary_{len(orchestra_state.messages)}"
-            orchestra_state.conversation_summaries[summary_key] = summary
+            summary_key = f"summary_{covered}"
+            checkpoint = SummaryCheckpoint(summary_key, summary, covered)
+            state.summary_checkpoints.append(checkpoint)
+            session_db.save_summary(state.session_id, checkpoint)
 
             logger.info(f"对话总结生成成功，保存为 {summary_key}")
             logger.info(f"总结内容: {summary}")
 
             # 将总结内容作为ETHER消息展示在界面上
-            summary_display_message = Message(
-                id=str(uuid.uuid4()),
-                role=RoleType.ETHER,
-                message_type=MessageType.SYSTEM_INFO,
-                content=f"📋 **对话总结**\n\n{summary}",
-                timestamp=datetime.now()
-            )
+            summary_display_message = MessageRecord(RoleType.ETHER, MessageType.SYSTEM_INFO, f"📋 **对话总结**\n\n{summary}")
             # 注意：这里不能调用broadcast_message，会导致递归
-            orchestra_state.messages.append(summary_display_message)
+            state.messages.append(summary_display_message)
 
             # 直接发送给客户端展示总结内容
-            for websocket in orchestra_state.websocket_connections:
-                try:
-                    await websocket.send_text(json.dumps({
-                        "type": "new_message",
-                        "message": summary_display_message.model_dump(mode="json")
-                    }))
-                except:
-                    pass
+            await _send_frame(summary_display_message.frame(), state)
 
         else:
             logger.error("对话总结生成失败")
@@ -607,77 +3198,240 @@ async def generate_conversation_summary():
 async def call_ollama_api_for_summary(prompt: str) -> Optional[str]:
     """专门用于调用总结AI的函数，不触发总结更新"""
     request_id = str(uuid.uuid4())[:8]
-    logger.info(f"[{request_id}] 开始调用总结AI - 模型: {orchestra_state.selected_model}")
+    model = model_router.model_for(ROUTE_SUMMARY)
+    logger.info(f"[{request_id}] 开始调用总结AI - 模型: {model}")
 
     try:
         start_time = datetime.now()
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "http://localhost:11434/api/generate",
-                json={
-                    "model": orchestra_state.selected_model,
-                    "prompt": prompt,
-                    "stream": False
-                },
-                timeout=1000.0
-            )
+        response = await ollama_backends.post(
+            "/api/generate",
+            model=model,
+            priority=RequestPriority.SUMMARY,
+            json={
+                "model": model,
+                "prompt": prompt,
+                "stream": False,
+                "keep_alive": keep_alive_value(),
+                **model_router.payload(ROUTE_SUMMARY)
+            }
+        )
 
-            duration = (datetime.now() - start_time).total_seconds()
-            logger.info(f"[{request_id}] 总结API调用耗时: {duration:.2f}秒")
+        duration = (datetime.now() - start_time).total_seconds()
+        logger.info(f"[{request_id}] 总结API调用耗时: {duration:.2f}秒")
 
-            if response.status_code == 200:
-                result = response.json()
-                response_text = result.get("response", "")
+        if response.status_code == 200:
+            result = response.json()
+            response_text = result.get("response", "")
 
-                logger.info(f"[{request_id}] 总结生成成功，长度: {len(response_text)}字符")
-                return response_text
-            else:
-                error_msg = f"总结AI调用失败: {response.status_code}"
-                logger.error(f"[{request_id}] {error_msg}")
-                return None
+            logger.info(f"[{request_id}] 总结生成成功，长度: {len(response_text)}字符")
+            return response_text
+        else:
+            error_msg = f"总结AI调用失败: {response.status_code}"
+            logger.error(f"[{request_id}] {error_msg}")
+            return None
 
     except Exception as e:
         error_msg = f"调用总结AI时发生错误: {str(e)}"
         logger.error(f"[{request_id}] {error_msg}", exc_info=True)
         return None
 
+def get_session_state(session_id: str) -> OrchestraState:
+    if not SESSION_ID_PATTERN.match(session_id):
+        raise HTTPException(status_code=400, detail=f"无效的会话id: {session_id}")
+    return session_registry.get(session_id)
+
+def find_session_state(session_id: str) -> Optional[OrchestraState]:
+    """只读接口使用，未知的会话返回None而不创建"""
+    if not SESSION_ID_PATTERN.match(session_id):
+        raise HTTPException(status_code=400, detail=f"无效的会话id: {session_id}")
+    return session_registry.find(session_id)
+
+def encode_history_cursor(session_id: str, before_seq: int) -> Optional[str]:
+    """历史分页游标：对客户端不透明，内部为会话id和下一页的序号上界"""
+    if before_seq <= 1:
+        return None
+    return base64.urlsafe_b64encode(f"{session_id}:{before_seq}".encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_history_cursor(session_id: str, cursor: str) -> int:
+    try:
+        decoded = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        owner, before_seq = decoded.rsplit(":", 1)
+        if owner == session_id:
+            return int(before_seq)
+    except (ValueError, UnicodeDecodeError):
+        pass
+    raise HTTPException(status_code=400, detail=f"无效的游标: {cursor}")
+
 @app.get("/api/models")
-async def get_available_models():
+async def get_available_models(session: str = DEFAULT_SESSION_ID):
     logger.info("正在获取可用的Ollama模型列表")
+    state = find_session_state(session)
+    # 尚未创建的会话显示它创建后将使用的默认模型
+    selected_model = state.selected_model if state is not None else session_registry.default_model
     try:
         start_time = datetime.now()
-        async with httpx.AsyncClient() as client:
-            response = await client.get("http://localhost:11434/api/tags", timeout=1000.0)
-            duration = (datetime.now() - start_time).total_seconds()
-
-            if response.status_code == 200:
-                data = response.json()
-                models = [model["name"] for model in data.get("models", [])]
-                logger.info(f"成功获取模型列表 (耗时 {duration:.2f}秒): {models}")
-                logger.info(f"当前选中模型: {orchestra_state.selected_model}")
-                return {"models": models, "selected": orchestra_state.selected_model}
-            else:
-                logger.error(f"获取模型列表失败 - HTTP {response.status_code}: {response.text}")
-                return {"models": [""], "selected": orchestra_state.selected_model, "error": "Failed to fetch models"}
+        await ollama_backends.refresh()
+        duration = (datetime.now() - start_time).total_seconds()
+
+        models = ollama_backends.list_models()
+        if models:
+            logger.info(f"成功获取模型列表 (耗时 {duration:.2f}秒): {models}")
+            logger.info(f"当前选中模型: {selected_model}")
+            return {"models": models, "selected": selected_model, "model_status": model_warmer.snapshot(selected_model)}
+        else:
+            errors = [f"{b.url}: {b.last_error}" for b in ollama_backends.backends if not b.healthy]
+            logger.error(f"获取模型列表失败 - {errors}")
+            return {"models": [""], "selected": selected_model, "error": "Failed to fetch models"}
     except Exception as e:
         logger.error(f"获取模型列表时发生错误: {str(e)}", exc_info=True)
-        return {"models": [""], "selected": orchestra_state.selected_model, "error": str(e)}
+        return {"models": [""], "selected": selected_model, "error": str(e)}
+
+@app.get("/api/ollama/pool")
+async def get_ollama_pool_stats():
+    return ollama_client.stats()
+
+@app.get("/api/ollama/backends")
+async def get_ollama_backends():
+    return ollama_backends.stats()
+
+@app.get("/api/messages", response_model=MessagePage)
+async def get_messages(since: Optional[int] = None, before: Optional[int] = None, last: int = 50,
+                       session: str = DEFAULT_SESSION_ID):
+    """按序号查询消息：since/before限定范围(since, before)，否则返回最近last条"""
+    state = find_session_state(session)
+    if state is None:
+        return {"messages": [], "last_seq": 0}
+    store = state.messages
+    if since is not None:
+        messages = store.range(since + 1, before, limit=max(0, last))
+    else:
+        messages = store.before(before if before is not None else store.last_seq + 1, last)
+    # 直接拼接缓存的消息JSON；response_model仅用于接口文档
+    return Response(dumps_with_messages({"last_seq": store.last_seq}, messages), media_type="application/json")
+
+@app.get("/api/sessions/{session_id}/messages", response_model=HistoryPage)
+async def get_session_history(session_id: str, before: Optional[str] = None, limit: int = HISTORY_PAGE_LIMIT,
+                              types: Optional[str] = None):
+    """按游标向前分页加载历史消息：before为上一页返回的next_cursor，types为逗号分隔的消息类型"""
+    state = find_session_state(session_id)
+    cursor_seq = decode_history_cursor(session_id, before) if before else None
+    type_filter = None
+    if types:
+        try:
+            type_filter = {MessageType(value.strip()) for value in types.split(",") if value.strip()}
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"无效的消息类型: {types}")
+    if state is None:
+        return {"messages": [], "last_seq": 0, "next_cursor": None}
+    store = state.messages
+    before_seq = cursor_seq if cursor_seq is not None else store.last_seq + 1
+    messages, next_seq = store.page(before_seq, max(1, min(limit, HISTORY_PAGE_MAX)), type_filter, HISTORY_SCAN_LIMIT)
+    payload = {"last_seq": store.last_seq, "next_cursor": encode_history_cursor(session_id, next_seq)}
+    return Response(dumps_with_messages(payload, messages), media_type="application/json")
+
+@app.get("/api/messages/stats")
+async def get_message_store_stats(session: str = DEFAULT_SESSION_ID):
+    state = find_session_state(session)
+    if state is None:
+        raise HTTPException(status_code=404, detail=f"会话不存在: {session}")
+    return {**state.messages.stats(), "database": session_db.stats()}
+
+@app.get("/api/sessions")
+async def get_session_stats():
+    return session_registry.stats()
+
+@app.get("/api/speculation/stats")
+async def get_speculation_stats():
+    return speculation_stats.stats()
+
+@app.get("/api/intent/batching")
+async def get_discrimination_batching_stats():
+    return discrimination_batcher.stats()
+
+@app.get("/api/intent/stats")
+async def get_intent_stats():
+    return {**intent_service.stats(), "embedding": embedding_intent.stats()}
+
+@app.get("/api/ollama/resilience")
+async def get_ollama_resilience_stats():
+    return ollama_backends.resilience_stats()
+
+@app.get("/api/ollama/scheduler")
+async def get_ollama_scheduler_stats():
+    return ollama_backends.scheduler.stats()
+
+@app.get("/api/generations")
+async def get_generation_stats():
+    return turn_tracker.stats()
+
+@app.get("/api/ollama/prompt_cache")
+async def get_prompt_cache_stats():
+    return prompt_cache_stats.stats()
+
+@app.get("/api/ollama/singleflight")
+async def get_ollama_singleflight_stats():
+    return ollama_singleflight.stats()
+
+@app.get("/api/cache/discrimination")
+async def get_discrimination_cache_stats():
+    return discrimination_cache.stats()
+
+@app.delete("/api/cache/discrimination")
+async def clear_discrimination_cache(model: Optional[str] = None):
+    discrimination_cache.clear(model)
+    logger.info(f"已清空话语类型判别缓存: {model or '全部模型'}")
+    return {"status": "success", "stats": discrimination_cache.stats()}
 
 class ModelSelection(BaseModel):
     model_name: str
+    session: str = DEFAULT_SESSION_ID
 
 @app.post("/api/select_model")
 async def select_model(model_data: ModelSelection):
-    old_model = orchestra_state.selected_model
+    state = get_session_state(model_data.session)
+    old_model = state.selected_model
     new_model = model_data.model_name
 
     logger.info(f"模型切换请求: {old_model} -> {new_model}")
 
-    orchestra_state.selected_model = new_model
+    state.selected_model = new_model
+    state.save()
+    model_warmer.warm(new_model)
 
     logger.info(f"模型已成功切换为: {new_model}")
 
-    return {"status": "success", "selected_model": new_model}
+    return {"status": "success", "selected_model": new_model, "model_status": model_warmer.snapshot(new_model)}
+
+@app.get("/api/model_routes")
+async def get_model_routes():
+    return {"tasks": ModelRouter.tasks(), "routes": model_router.stats()}
+
+@app.put("/api/model_routes/{task}")
+async def update_model_route(task: str, route: ModelRoute):
+    if task not in ModelRouter.tasks():
+        raise HTTPException(status_code=404, detail=f"未知的调用类型: {task}")
+    if route.model:
+        await ollama_backends.refresh()
+        models = ollama_backends.list_models()
+        if route.model not in models:
+            raise HTTPException(status_code=400, detail=f"模型不存在: {route.model}，可用模型: {models}")
+
+    model_router.set(task, route)
+    logger.info(f"模型路由已更新: {task} -> {route.model or '跟随选中模型'} {route.options}")
+    return {"status": "success", "routes": model_router.stats()}
+
+@app.delete("/api/model_routes/{task}")
+async def reset_model_route(task: str):
+    if task not in ModelRouter.tasks():
+        raise HTTPException(status_code=404, detail=f"未知的调用类型: {task}")
+    model_router.reset(task)
+    logger.info(f"模型路由已重置: {task}")
+    return {"status": "success", "routes": model_router.stats()}
+
+@app.get("/api/model_status")
+async def get_model_status(session: str = DEFAULT_SESSION_ID):
+    state = find_session_state(session)
+    return model_warmer.snapshot(state.selected_model if state is not None else session_registry.default_model)
 
 @app.get("/")
 async def serve_frontend():
@@ -714,7 +3468,7 @@ def find_available_port(start_port: int = 8000, max_attempts: int = 100) -> int:
 if __name__ == "__main__":
     import uvicorn
     logger.info("启动OrchestraAI多AI协作平台")
-    logger.info(f"默认选择模型: {orchestra_state.selected_model}")
+    logger.info(f"默认选择模型: {session_registry.default_model}")
     
     port = find_available_port()
     logger.info(f"找到可用端口: {port}")
@@ -1,7 +1,12 @@
 class OrchestraAI {
     constructor() {
         this.ws = null;
+        // 会话id取自页面地址的?session=参数，不同会话互不影响
+        this.sessionId = new URLSearchParams(window.location.search).get('session') || 'default';
         this.messages = [];
+        this.lastSeq = 0; // 已收到消息的最大序号，重连时只补发之后的消息
+        this.historyCursor = null; // 更早历史消息的分页游标，为空表示已加载到最早
+        this.isLoadingHistory = false;
         this.isConnected = false;
         this.messageCounts = {
             human: 0,
@@ -27,7 +32,10 @@ class OrchestraAI {
     
     setupWebSocket() {
         const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-        const wsUrl = `${protocol}//${window.location.host}/ws`;
+        const session = encodeURIComponent(this.sessionId);
+        // 还没有收到过消息时不带since，由服务端发送最近的消息和更早历史的游标
+        const since = this.lastSeq > 0 ? `&since=${this.lastSeq}` : '';
+        const wsUrl = `${protocol}//${window.location.host}/ws?session=${session}${since}`;
         
         this.ws = new WebSocket(wsUrl);
         
@@ -99,6 +107,11 @@ class OrchestraAI {
             }
         });
         
+        // 停止生成按钮
+        document.getElementById('stop-btn').addEventListener('click', () => {
+            this.stopGeneration();
+        });
+        
         // 紧急打断按钮
         document.getElementById('interrupt-btn').addEventListener('click', () => {
             this.showInterruptModal();
@@ -140,6 +153,20 @@ class OrchestraAI {
             this.selectModel(e.target.value);
         });
         
+        // 滚动到列顶部时加载更早的历史消息；内容不足一屏时没有滚动事件，用向上滚轮触发
+        document.querySelectorAll('.messages-container').forEach(container => {
+            container.addEventListener('scroll', () => {
+                if (container.scrollTop < 50) {
+                    this.loadOlderMessages(container);
+                }
+            });
+            container.addEventListener('wheel', (e) => {
+                if (e.deltaY < 0 && container.scrollTop === 0) {
+                    this.loadOlderMessages(container);
+                }
+            });
+        });
+        
         // 列点击事件 - 手动设置活跃列
         document.querySelectorAll('.column').forEach(column => {
             column.addEventListener('click', (e) => {
@@ -160,19 +187,94 @@ class OrchestraAI {
     handleWebSocketMessage(data) {
         switch (data.type) {
             case 'connection_established':
+                if (data.reset) {
+                    this.clearMessages();
+                    this.historyCursor = data.cursor;
+                }
                 if (data.messages && data.messages.length > 0) {
                     data.messages.forEach(msg => this.addMessage(msg));
                 }
+                if (data.model_status) {
+                    this.updateModelStatus(data.model_status);
+                }
+                break;
+            case 'model_status':
+                this.updateModelStatus(data);
                 break;
             case 'new_message':
                 this.addMessage(data.message);
                 break;
+            case 'message_delta':
+                this.appendMessageDelta(data);
+                break;
+            case 'generation_cancelled':
+                this.markStreamingCancelled(data.reason);
+                break;
+            case 'error':
+                console.error('服务端拒绝了消息:', data.detail);
+                break;
             default:
                 console.log('未知消息类型:', data.type);
         }
     }
     
+    appendMessageDelta(data) {
+        const container = document.getElementById(`messages-${data.role}`);
+        if (!container) return;
+        
+        // 流式消息先渲染为纯文本，完整消息到达后替换
+        let messageElement = container.querySelector(`[data-message-id="${data.message_id}"]`);
+        if (!messageElement) {
+            messageElement = this.createMessageElement({
+                id: data.message_id,
+                role: data.role,
+                message_type: 'ai_response streaming',
+                content: '',
+                timestamp: new Date().toISOString()
+            });
+            container.appendChild(messageElement);
+            this.setLastMessageColumn(data.role);
+        }
+        
+        const contentDiv = messageElement.querySelector('.message-content');
+        contentDiv.textContent += data.delta;
+        container.scrollTop = container.scrollHeight;
+    }
+    
+    markStreamingCancelled(reason) {
+        // 已中止的流式消息保留已生成的部分，并标记为已取消
+        document.querySelectorAll('.message.streaming').forEach(element => {
+            element.classList.remove('streaming');
+            element.classList.add('cancelled');
+            element.querySelector('.message-timestamp').textContent += ` · 已取消（${reason}）`;
+        });
+    }
+    
+    clearMessages() {
+        this.messages = [];
+        this.lastSeq = 0;
+        Object.keys(this.messageCounts).forEach(role => {
+            this.messageCounts[role] = 0;
+            this.updateMessageCount(role);
+        });
+        document.querySelectorAll('.messages-container').forEach(container => {
+            container.innerHTML = '';
+        });
+    }
+    
     addMessage(messageData) {
+        // 重连补发时跳过已经收到的消息
+        if (messageData.seq && messageData.seq <= this.lastSeq) {
+            return;
+        }
+        this.lastSeq = Math.max(this.lastSeq, messageData.seq || 0);
+        
+        // 移除同一消息的流式占位元素
+        const streamingElement = document.querySelector(`.streaming[data-message-id="${messageData.id}"]`);
+        if (streamingElement) {
+            streamingElement.remove();
+        }
+        
         this.messages.push(messageData);
         this.messageCounts[messageData.role]++;
         
@@ -194,6 +296,49 @@ class OrchestraAI {
         this.playNotificationSound();
     }
     
+    async loadOlderMessages(scrolledContainer) {
+        if (!this.historyCursor || this.isLoadingHistory) return;
+        this.isLoadingHistory = true;
+        try {
+            const session = encodeURIComponent(this.sessionId);
+            const cursor = encodeURIComponent(this.historyCursor);
+            const response = await fetch(`/api/sessions/${session}/messages?before=${cursor}`);
+            if (!response.ok) {
+                throw new Error(`HTTP ${response.status}`);
+            }
+            const data = await response.json();
+            
+            // 插入到各列顶部，保持正在浏览的列的可见位置不变
+            const previousHeight = scrolledContainer.scrollHeight;
+            this.prependMessages(data.messages);
+            scrolledContainer.scrollTop += scrolledContainer.scrollHeight - previousHeight;
+            this.historyCursor = data.next_cursor;
+        } catch (error) {
+            console.error('加载历史消息失败:', error);
+        } finally {
+            this.isLoadingHistory = false;
+        }
+    }
+    
+    prependMessages(messages) {
+        const knownIds = new Set(this.messages.map(msg => msg.id));
+        const older = messages.filter(msg => !knownIds.has(msg.id));
+        
+        // 按序号从新到旧依次插入列顶部，最终每列仍按时间顺序排列
+        [...older].reverse().forEach(messageData => {
+            const container = document.getElementById(`messages-${messageData.role}`);
+            if (!container) return;
+            container.insertBefore(this.createMessageElement(messageData), container.firstChild);
+            this.messageCounts[messageData.role]++;
+        });
+        this.messages = older.concat(this.messages);
+        
+        Object.keys(this.messageCounts).forEach(role => this.updateMessageCount(role));
+        if (!document.getElementById('timeline-view').classList.contains('hidden')) {
+            this.renderTimelineView();
+        }
+    }
+    
     renderMessageInColumn(messageData) {
         const container = document.getElementById(`messages-${messageData.role}`);
         if (!container) return;
@@ -215,6 +360,7 @@ class OrchestraAI {
     createMessageElement(messageData) {
         const messageDiv = document.createElement('div');
         messageDiv.className = `message ${messageData.message_type}`;
+        messageDiv.dataset.messageId = messageData.id;
         
         const contentDiv = document.createElement('div');
         contentDiv.className = 'message-content';
@@ -281,6 +427,14 @@ class OrchestraAI {
         input.value = '';
     }
     
+    stopGeneration() {
+        if (!this.isConnected) return;
+        
+        this.ws.send(JSON.stringify({
+            type: 'stop'
+        }));
+    }
+    
     showInterruptModal() {
         document.getElementById('interrupt-modal').classList.remove('hidden');
         document.getElementById('interrupt-input').focus();
@@ -324,10 +478,8 @@ class OrchestraAI {
         const container = document.getElementById('timeline-messages');
         container.innerHTML = '';
         
-        // 按时间排序所有消息
-        const sortedMessages = [...this.messages].sort((a, b) => 
-            new Date(a.timestamp) - new Date(b.timestamp)
-        );
+        // 按序号排序所有消息
+        const sortedMessages = [...this.messages].sort((a, b) => a.seq - b.seq);
         
         sortedMessages.forEach(messageData => {
             const messageElement = this.createTimelineMessageElement(messageData);
@@ -398,12 +550,14 @@ class OrchestraAI {
     
     enableControls() {
         document.getElementById('send-btn').disabled = false;
+        document.getElementById('stop-btn').disabled = false;
         document.getElementById('interrupt-btn').disabled = false;
         document.getElementById('human-input').disabled = false;
     }
     
     disableControls() {
         document.getElementById('send-btn').disabled = true;
+        document.getElementById('stop-btn').disabled = true;
         document.getElementById('interrupt-btn').disabled = true;
         document.getElementById('human-input').disabled = true;
     }
@@ -442,7 +596,7 @@ class OrchestraAI {
     
     async loadAvailableModels() {
         try {
-            const response = await fetch('/api/models');
+            const response = await fetch(`/api/models?session=${encodeURIComponent(this.sessionId)}`);
             const data = await response.json();
             
             const modelSelect = document.getElementById('model-select');
@@ -469,6 +623,10 @@ class OrchestraAI {
                 modelSelect.appendChild(option);
             }
             
+            if (data.model_status) {
+                this.updateModelStatus(data.model_status);
+            }
+            
             if (data.error) {
                 console.warn('获取模型列表时出现警告:', data.error);
             }
@@ -485,12 +643,15 @@ class OrchestraAI {
                 headers: {
                     'Content-Type': 'application/json',
                 },
-                body: JSON.stringify({ model_name: modelName })
+                body: JSON.stringify({ model_name: modelName, session: this.sessionId })
             });
             
             if (response.ok) {
                 const data = await response.json();
                 console.log('模型已切换为:', data.selected_model);
+                if (data.model_status) {
+                    this.updateModelStatus(data.model_status);
+                }
                 
                 // 可以添加一个提示消息
                 this.showModelChangedNotification(modelName);
@@ -502,6 +663,21 @@ class OrchestraAI {
         }
     }
     
+    updateModelStatus(status) {
+        const statusElement = document.getElementById('model-status');
+        if (!statusElement) return;
+        
+        const labels = {
+            idle: '',
+            loading: '⏳ 加载中',
+            ready: '✅ 就绪',
+            failed: '❌ 加载失败'
+        };
+        statusElement.textContent = labels[status.status] || '';
+        statusElement.className = `model-status ${status.status}`;
+        statusElement.title = status.error || '';
+    }
+    
     showModelChangedNotification(modelName) {
         // 创建一个临时通知
         const notification = document.createElement('div');
@@ -652,6 +828,15 @@ style.textContent = `
         transition: all 0.3s ease;
     }
     
+    .message.streaming .message-content,
+    .message.cancelled .message-content {
+        white-space: pre-wrap;
+    }
+    
+    .message.cancelled {
+        opacity: 0.6;
+    }
+    
     .message:hover {
         transform: translateX(5px);
         box-shadow: 0 4px 15px rgba(0, 0, 0, 0.1);
@@ -678,6 +863,15 @@ style.textContent = `
         min-width: 120px;
     }
     
+    .model-status {
+        font-size: 12px;
+        white-space: nowrap;
+    }
+    
+    .model-status.failed {
+        color: #dc2626;
+    }
+    
     .model-selector select:focus {
         outline: none;
         border-color: #4f46e5;
@@ -0,0 +1,36 @@
+import asyncio
+import os
+import sys
+
+import httpx
+import pytest
+
+# 会话数据库使用临时文件，测试之间互不影响
+os.environ.setdefault("SESSION_DB_PATH", "")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def fake_ollama(monkeypatch):
+    """把共享HTTP客户端替换为httpx.MockTransport，handler按请求的主机和路径模拟各台Ollama"""
+    monkeypatch.setattr(main, "OLLAMA_RETRY_BACKOFF", 0.0)
+
+    def install(handler):
+        monkeypatch.setattr(main.ollama_client, "client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+
+    yield install
+    monkeypatch.setattr(main.ollama_client, "client", None)
+
+
+@pytest.fixture
+def sessions(tmp_path, monkeypatch):
+    """独立的会话数据库和会话表，测试结束后关闭"""
+    db = main.SessionDatabase(str(tmp_path / "sessions.db"), 0.01, 100)
+    db.open()
+    registry = main.SessionRegistry(4)
+    monkeypatch.setattr(main, "session_db", db)
+    monkeypatch.setattr(main, "session_registry", registry)
+    yield registry
+    asyncio.run(db.close())
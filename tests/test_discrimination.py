@@ -0,0 +1,49 @@
+"""话语类型判别结果的解析与分支选择"""
+import asyncio
+
+import pytest
+
+import main
+from main import RoleType
+
+
+@pytest.mark.parametrize("response, expected", [
+    ("3", "3"),
+    ("  3\n", "3"),
+    ('"4"', "4"),
+    ("5.", "5"),
+    ('{"answer": 2}', "2"),
+    ("３", "3"),
+    ("选项三", "3"),
+    ("我认为是1，因为用户表达了愿望", "1"),
+    ("", None),
+    (None, None),
+    ("9", None),
+    ("无法判断", None),
+])
+def test_parse_discrimination(response, expected):
+    assert main.parse_discrimination(response, RoleType.PRODUCT_AI) == expected
+
+
+def test_labels_follow_prompt_options():
+    assert main.discrimination_labels(RoleType.PRODUCT_AI) == ["1", "2", "3", "4", "5", "6", "7"]
+
+
+def test_routes_only_include_labels_with_prompts():
+    routes = main.discrimination_routes(RoleType.PRODUCT_AI)
+    prompts = main.AI_PROMPTS[RoleType.PRODUCT_AI]
+    assert "1" in routes
+    assert all(about in prompts for about in routes.values())
+    # 6对应的JUDGE没有提示词
+    assert "6" not in routes
+
+
+def test_unrouted_label_falls_back(monkeypatch):
+    async def judge(user_input, role):
+        return "6"
+
+    monkeypatch.setattr(main, "_discriminate", judge)
+    before = main.intent_service.unrouted_fallbacks
+    label = asyncio.run(main.trigger_discrimination_ai("我觉得可能要改", RoleType.PRODUCT_AI))
+    assert label == main.AI_PROMPTS[RoleType.PRODUCT_AI]["discrimination_fallback"]
+    assert main.intent_service.unrouted_fallbacks == before + 1
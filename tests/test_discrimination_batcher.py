@@ -0,0 +1,151 @@
+"""判别请求微批处理：合并、分发、失败回退和取消"""
+import asyncio
+import json
+import re
+
+import pytest
+
+import main
+from main import RoleType
+
+LABELS = {"我想做一个记账应用": 1, "为什么要用数据库": 3, "好的": 5}
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    """批量调用按消息文本返回LABELS中的选项，单条调用返回"single:"加文本，echoes记录回显的提示词"""
+    calls = {"batches": [], "singles": [], "echoes": [], "fail": False, "block": None}
+
+    async def chat(request_id, messages, role, model, stream_to=None, priority=None, extra_payload=None):
+        texts = [json.loads(item) for item in re.findall(r"^- \[\d+\] (.*)$", messages[-1]["content"], re.M)]
+        calls["batches"].append(texts)
+        if calls["block"] is not None:
+            await calls["block"].wait()
+        if calls["fail"]:
+            raise main.OllamaAPIError("Ollama API调用失败: 500")
+        return {"message": {"content": json.dumps({"answers": [LABELS[text] for text in texts]})}}
+
+    async def single(prompt, role, **kwargs):
+        assert kwargs["echo"] is False
+        text = prompt.rsplit("\n", 1)[-1]
+        calls["singles"].append(text)
+        return f"single:{text}"
+
+    async def broadcast(message):
+        assert message.role == RoleType.ETHER
+        calls["echoes"].append(message.content.rsplit("\n", 1)[-1])
+
+    monkeypatch.setattr(main, "request_ollama_chat", chat)
+    monkeypatch.setattr(main, "call_ollama_api", single)
+    monkeypatch.setattr(main, "broadcast_message", broadcast)
+    monkeypatch.setattr(main.model_router, "model_for", lambda task: "m")
+    return calls
+
+
+def classify(batcher, text):
+    return batcher.classify(text, f"判别提示词\n{text}", RoleType.PRODUCT_AI)
+
+
+def test_concurrent_requests_share_one_call(upstream):
+    batcher = main.DiscriminationBatcher(8, 0.01)
+
+    async def scenario():
+        return await asyncio.gather(*(classify(batcher, text) for text in LABELS))
+
+    assert asyncio.run(scenario()) == [("1", True), ("3", True), ("5", True)]
+    assert upstream["batches"] == [list(LABELS)]
+    assert upstream["singles"] == []
+    # 批量调用同样为每条请求回显提示词
+    assert upstream["echoes"] == list(LABELS)
+    assert (batcher.batches, batcher.batched_requests, batcher.max_batch) == (1, 3, 3)
+
+
+def test_full_batch_is_sent_without_waiting(upstream):
+    batcher = main.DiscriminationBatcher(2, 10)
+
+    async def scenario():
+        return await asyncio.wait_for(asyncio.gather(*(classify(batcher, text) for text in list(LABELS)[:2])), 1)
+
+    assert asyncio.run(scenario()) == [("1", True), ("3", True)]
+
+
+def test_lone_request_is_sent_on_its_own(upstream):
+    batcher = main.DiscriminationBatcher(8, 0.01)
+    assert asyncio.run(classify(batcher, "好的")) == ("single:好的", False)
+    assert upstream["batches"] == []
+    assert upstream["echoes"] == ["好的"]
+    assert batcher.single_requests == 1
+
+
+def test_disabled_batcher_sends_directly(upstream):
+    batcher = main.DiscriminationBatcher(8, 0)
+    assert not batcher.enabled
+    assert asyncio.run(classify(batcher, "好的")) == ("single:好的", False)
+    assert upstream["echoes"] == ["好的"]
+
+
+def test_failed_batch_falls_back_to_single_requests(upstream):
+    upstream["fail"] = True
+    batcher = main.DiscriminationBatcher(8, 0.01)
+
+    async def scenario():
+        return await asyncio.gather(*(classify(batcher, text) for text in LABELS))
+
+    assert asyncio.run(scenario()) == [(f"single:{text}", False) for text in LABELS]
+    assert batcher.batch_failures == 1
+    assert sorted(upstream["singles"]) == sorted(LABELS)
+    # 回退到单条调用时不重复回显
+    assert upstream["echoes"] == list(LABELS)
+
+
+def test_cancelled_waiter_does_not_affect_others(upstream):
+    batcher = main.DiscriminationBatcher(8, 0.01)
+
+    async def scenario():
+        upstream["block"] = asyncio.Event()
+        tasks = [asyncio.create_task(classify(batcher, text)) for text in LABELS]
+        while not upstream["batches"]:
+            await asyncio.sleep(0.005)
+        tasks[0].cancel()
+        upstream["block"].set()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        assert isinstance(results[0], asyncio.CancelledError)
+        assert results[1:] == [("3", True), ("5", True)]
+
+    asyncio.run(scenario())
+
+
+def test_batch_is_cancelled_when_every_waiter_leaves(upstream):
+    batcher = main.DiscriminationBatcher(8, 0.01)
+
+    async def scenario():
+        upstream["block"] = asyncio.Event()
+        tasks = [asyncio.create_task(classify(batcher, text)) for text in LABELS]
+        while not upstream["batches"]:
+            await asyncio.sleep(0.005)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.sleep(0)
+        assert all(task.cancelled() for task in tasks)
+        assert batcher._tasks == set()
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("batched", [True, False])
+def test_only_single_results_are_cached(monkeypatch, batched):
+    cache = main.ResponseCache(10, 60)
+    monkeypatch.setattr(main, "discrimination_cache", cache)
+    # 没有本地和嵌入分类器，直接走LLM判别
+    monkeypatch.setattr(main, "intent_service", main.IntentService())
+    monkeypatch.setattr(main, "embedding_intent", main.EmbeddingIntentService("", ""))
+    monkeypatch.setattr(main.model_router, "model_for", lambda task: "m")
+
+    async def classify_once(user_input, prompt, role):
+        return "1", batched
+
+    monkeypatch.setattr(main.discrimination_batcher, "classify", classify_once)
+    assert asyncio.run(main._discriminate("我想做一个记账应用", RoleType.PRODUCT_AI)) == "1"
+    # 批量判别不带对话历史，结果不进入共享缓存
+    assert len(cache._entries) == (0 if batched else 1)
@@ -0,0 +1,23 @@
+"""历史分页游标"""
+import pytest
+from fastapi import HTTPException
+
+import main
+
+
+def test_cursor_round_trip():
+    cursor = main.encode_history_cursor("default", 81)
+    assert "81" not in cursor
+    assert main.decode_history_cursor("default", cursor) == 81
+
+
+def test_no_cursor_at_start_of_history():
+    assert main.encode_history_cursor("default", 1) is None
+    assert main.encode_history_cursor("default", 0) is None
+
+
+@pytest.mark.parametrize("cursor", ["not-a-cursor", "", "@@@", main.encode_history_cursor("other", 5)])
+def test_rejects_invalid_or_foreign_cursor(cursor):
+    with pytest.raises(HTTPException) as error:
+        main.decode_history_cursor("default", cursor)
+    assert error.value.status_code == 400
@@ -0,0 +1,146 @@
+"""本地话语类型分类器与判别快速路径"""
+import asyncio
+import json
+import os
+
+import pytest
+
+import main
+from intent_classifier import IntentClassifier, evaluate, load_examples
+from main import RoleType
+
+EXAMPLES_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "intent_examples.jsonl")
+
+
+@pytest.fixture(scope="module")
+def examples():
+    return load_examples(EXAMPLES_PATH)
+
+
+@pytest.fixture(scope="module")
+def classifier(examples):
+    return IntentClassifier().fit(examples)
+
+
+def test_predicts_training_examples(examples, classifier):
+    correct = sum(classifier.predict(text).label == label for text, label in examples)
+    assert correct / len(examples) > 0.9
+
+
+def test_prediction_is_a_distribution(classifier):
+    prediction = classifier.predict("为什么要这样设计")
+    assert prediction.label in classifier.class_counts
+    assert sum(prediction.scores.values()) == pytest.approx(1.0)
+    assert prediction.confidence == max(prediction.scores.values())
+
+
+def test_untrained_classifier_predicts_nothing():
+    assert IntentClassifier().predict("你好") is None
+
+
+def test_save_and_load_round_trip(tmp_path, classifier):
+    path = str(tmp_path / "intent_model.json")
+    classifier.save(path)
+    loaded = IntentClassifier.load(path)
+    for text in ("我想做一个记账应用", "为什么要这样设计", "好的"):
+        assert loaded.predict(text).scores == pytest.approx(classifier.predict(text).scores)
+
+
+def test_leave_one_out_evaluation(examples):
+    report = evaluate(examples[:20], threshold=0.5)
+    assert report["examples"] == 20
+    assert 0.0 <= report["coverage"] <= 1.0
+
+
+def test_confidence_threshold_and_known_labels(monkeypatch, classifier):
+    service = main.IntentService()
+    service.classifier = classifier
+    prediction = service.predict("我想做一个记账应用")
+    labels = main.AI_PROMPTS[RoleType.PRODUCT_AI]["discrimination_map"]
+
+    monkeypatch.setattr(main, "INTENT_CONFIDENCE_THRESHOLD", 0.0)
+    assert service.is_confident(prediction, labels)
+    assert not service.is_confident(prediction, {})
+    assert not service.is_confident(None, labels)
+    monkeypatch.setattr(main, "INTENT_CONFIDENCE_THRESHOLD", 1.01)
+    assert not service.is_confident(prediction, labels)
+
+
+def test_agreement_is_bucketed_by_confidence(classifier):
+    service = main.IntentService()
+    prediction = classifier.predict("我想做一个记账应用")
+
+    async def scenario():
+        await service.record_agreement("我想做一个记账应用", prediction, prediction.label)
+        await service.record_agreement("我想做一个记账应用", prediction, "7" if prediction.label != "7" else "1")
+
+    asyncio.run(scenario())
+    assert service.stats()["agreement_rate"] == 0.5
+
+
+def test_shadow_check_is_tracked_and_records_feedback(tmp_path, monkeypatch, classifier):
+    path = tmp_path / "feedback.jsonl"
+    monkeypatch.setattr(main, "INTENT_FEEDBACK_PATH", str(path))
+    monkeypatch.setattr(main, "get_chat_messages_since_last_summary", lambda: [])
+    monkeypatch.setattr(main.model_router, "model_for", lambda task: "m")
+    service = main.IntentService()
+    monkeypatch.setattr(main, "intent_service", service)
+    prediction = classifier.predict("我想做一个记账应用")
+    release = asyncio.Event()
+
+    async def chat(*args, **kwargs):
+        await release.wait()
+        return {"message": {"content": prediction.label}}
+
+    monkeypatch.setattr(main, "request_ollama_chat", chat)
+
+    async def scenario():
+        service.shadow_check("我想做一个记账应用", "判别提示词", RoleType.PRODUCT_AI, prediction)
+        # 复核进行中时保留任务引用，完成后移除
+        assert len(service._shadow_tasks) == 1
+        release.set()
+        await asyncio.gather(*service._shadow_tasks)
+        assert service._shadow_tasks == set()
+
+    asyncio.run(scenario())
+    assert service.shadow_checks == 1
+    record = json.loads(path.read_text(encoding="utf-8"))
+    assert (record["text"], record["label"], record["local_label"]) == ("我想做一个记账应用", prediction.label, prediction.label)
+
+
+def test_stop_cancels_pending_shadow_checks(monkeypatch, classifier):
+    monkeypatch.setattr(main, "get_chat_messages_since_last_summary", lambda: [])
+    monkeypatch.setattr(main.model_router, "model_for", lambda task: "m")
+
+    async def chat(*args, **kwargs):
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(main, "request_ollama_chat", chat)
+    service = main.IntentService()
+    prediction = classifier.predict("好的")
+
+    async def scenario():
+        service.shadow_check("好的", "判别提示词", RoleType.PRODUCT_AI, prediction)
+        await asyncio.sleep(0)
+        await service.stop()
+        assert service._shadow_tasks == set()
+
+    asyncio.run(scenario())
+
+
+def test_confident_local_prediction_skips_llm(monkeypatch, classifier):
+    service = main.IntentService()
+    service.classifier = classifier
+    monkeypatch.setattr(main, "intent_service", service)
+    monkeypatch.setattr(main, "discrimination_cache", main.ResponseCache(10, 60))
+    monkeypatch.setattr(main, "INTENT_CONFIDENCE_THRESHOLD", 0.0)
+    monkeypatch.setattr(main, "INTENT_SHADOW_RATE", 0.0)
+    monkeypatch.setattr(main.model_router, "model_for", lambda task: "m")
+
+    async def no_llm(*args, **kwargs):
+        raise AssertionError("置信度足够时不应调用LLM")
+
+    monkeypatch.setattr(main.discrimination_batcher, "classify", no_llm)
+    label = asyncio.run(main._discriminate("我想做一个记账应用", RoleType.PRODUCT_AI))
+    assert label == classifier.predict("我想做一个记账应用").label
+    assert (service.local_answers, service.llm_fallbacks) == (1, 0)
@@ -0,0 +1,111 @@
+"""消息存储：热窗口与磁盘之间的范围查询和分页"""
+import asyncio
+
+import pytest
+
+import main
+from main import MessageRecord, MessageType, RoleType
+
+
+def message_type(seq):
+    return MessageType.USER_INPUT if seq % 3 == 0 else MessageType.AI_RESPONSE
+
+
+def seqs(messages):
+    return [message.seq for message in messages]
+
+
+@pytest.fixture
+def store_factory(tmp_path):
+    databases = []
+
+    async def create(count, hot_size=5, spill_batch=5, flush=True):
+        db = main.SessionDatabase(str(tmp_path / "sessions.db"), 0.01, 100)
+        db.open()
+        databases.append(db)
+        store = main.MessageStore("s", db, hot_size, spill_batch)
+        for seq in range(1, count + 1):
+            store.append(MessageRecord(RoleType.HUMAN, message_type(seq), f"m{seq}", id=f"id-{seq}"))
+            # 只有已提交的消息才会移出内存
+            if flush:
+                await db.flush()
+        return store
+
+    yield create
+    for db in databases:
+        asyncio.run(db.close())
+
+
+def test_spills_committed_messages_out_of_memory(store_factory):
+    async def scenario():
+        store = await store_factory(30)
+        stats = store.stats()
+        assert store.last_seq == 30
+        assert stats["spilled"] > 0
+        assert stats["resident"] < 10
+        assert store._hot_seqs[-1] == 30
+
+    asyncio.run(scenario())
+
+
+def test_keeps_uncommitted_messages_in_memory(store_factory):
+    async def scenario():
+        store = await store_factory(30, flush=False)
+        assert store.stats()["spilled"] == 0
+        assert store.stats()["resident"] == 30
+        assert seqs(store.range(1, limit=3)) == [1, 2, 3]
+
+    asyncio.run(scenario())
+
+
+def test_range_spans_disk_and_hot_window(store_factory):
+    async def scenario():
+        store = await store_factory(30)
+        first_hot = store._first_hot_seq()
+        assert first_hot > 10
+
+        assert seqs(store.range(8, first_hot + 3)) == list(range(8, first_hot + 3))
+        assert seqs(store.range(8, limit=4)) == [8, 9, 10, 11]
+        assert seqs(store.range(first_hot - 2, limit=4)) == list(range(first_hot - 2, first_hot + 2))
+        assert seqs(store.since(27)) == [28, 29, 30]
+        assert seqs(store.before(first_hot + 1, 3)) == [first_hot - 2, first_hot - 1, first_hot]
+        assert store.get(3).content == "m3"
+        assert store.get_by_id("id-2").seq == 2
+        assert store.get_by_id("id-30").seq == 30
+        assert store.disk_reads > 0
+
+    asyncio.run(scenario())
+
+
+def test_page_walks_back_across_the_boundary(store_factory):
+    async def scenario():
+        store = await store_factory(30)
+        collected = []
+        before = store.last_seq + 1
+        while before > 1:
+            page, before = store.page(before, 7)
+            assert len(page) <= 7
+            collected = seqs(page) + collected
+        assert collected == list(range(1, 31))
+
+    asyncio.run(scenario())
+
+
+def test_page_filters_by_type(store_factory):
+    async def scenario():
+        store = await store_factory(30)
+        types = {MessageType.USER_INPUT}
+        page, before = store.page(31, 4, types)
+        assert seqs(page) == [18, 21, 24, 27, 30][-4:]
+        assert before == 21
+
+        page, before = store.page(before, 10, types)
+        assert seqs(page) == [3, 6, 9, 12, 15, 18]
+        assert before == 1
+
+        # 扫描上限内没有足够的匹配时返回已有结果和继续翻页的位置
+        page, before = store.page(31, 10, types, scan_limit=6)
+        assert seqs(page) == [27, 30]
+        assert before == 25
+
+    asyncio.run(scenario())
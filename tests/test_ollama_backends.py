@@ -0,0 +1,94 @@
+"""多主机后端池：负载最低优先、按模型选择主机、剔除不可达主机"""
+import asyncio
+
+import httpx
+import pytest
+
+import main
+
+
+def tags(models):
+    return httpx.Response(200, json={"models": [{"name": name} for name in models]})
+
+
+def test_routes_to_least_outstanding_host(fake_ollama):
+    async def scenario():
+        release = asyncio.Event()
+        hosts = []
+
+        async def handler(request):
+            hosts.append(request.url.host)
+            await release.wait()
+            return httpx.Response(200, json={"done": True})
+
+        fake_ollama(handler)
+        pool = main.OllamaBackendPool(["http://a:11434|2", "http://b:11434|2"])
+        requests = [asyncio.create_task(pool.post("/api/chat", json={})) for _ in range(2)]
+        while len(hosts) < 2:
+            await asyncio.sleep(0.01)
+        # 第一台已有一个在途请求，第二个请求应分配给空闲的主机
+        assert sorted(hosts) == ["a", "b"]
+        assert [b.outstanding for b in pool.backends] == [1, 1]
+
+        release.set()
+        responses = await asyncio.gather(*requests)
+        assert all(response.status_code == 200 for response in responses)
+        assert [b.outstanding for b in pool.backends] == [0, 0]
+
+    asyncio.run(scenario())
+
+
+def test_places_requests_on_hosts_serving_the_model(fake_ollama):
+    async def scenario():
+        models = {"a": ["small:latest"], "b": ["big:latest"]}
+        chats = []
+
+        def handler(request):
+            if request.url.path == "/api/tags":
+                return tags(models[request.url.host])
+            chats.append(request.url.host)
+            return httpx.Response(200, json={"done": True})
+
+        fake_ollama(handler)
+        pool = main.OllamaBackendPool(["http://a:11434", "http://b:11434"])
+        await pool.refresh()
+        assert pool.list_models() == ["small:latest", "big:latest"]
+
+        for _ in range(3):
+            await pool.post("/api/chat", model="big:latest", json={})
+        assert chats == ["b", "b", "b"]
+
+        with pytest.raises(main.OllamaBackendUnavailable):
+            await pool.post("/api/chat", model="missing:latest", json={})
+
+    asyncio.run(scenario())
+
+
+def test_ejects_unreachable_host_and_retries_elsewhere(fake_ollama):
+    async def scenario():
+        def handler(request):
+            if request.url.host == "a":
+                raise httpx.ConnectError("connection refused", request=request)
+            if request.url.path == "/api/tags":
+                return tags(["small:latest"])
+            return httpx.Response(200, json={"host": request.url.host})
+
+        fake_ollama(handler)
+        pool = main.OllamaBackendPool(["http://a:11434", "http://b:11434"])
+        response = await pool.post("/api/chat", json={})
+        assert response.json() == {"host": "b"}
+
+        dead, alive = pool.backends
+        assert not dead.healthy
+        assert dead.failures_total == 1
+        assert alive.healthy
+
+        # 健康检查仍失败时保持剔除状态，模型列表只来自健康的主机
+        await pool.refresh()
+        assert not dead.healthy
+        assert pool.list_models() == ["small:latest"]
+        for _ in range(3):
+            assert (await pool.post("/api/chat", json={})).json() == {"host": "b"}
+        assert dead.requests_total == 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,52 @@
+"""共享HTTP客户端：生命周期与连接池统计"""
+import asyncio
+
+import httpx
+import pytest
+
+import main
+
+
+def test_closed_client_is_not_recreated():
+    client = main.OllamaHTTPClient()
+
+    async def scenario():
+        # lifespan之外按需创建
+        created = client.get_client()
+        assert client.get_client() is created
+        await client.close()
+        with pytest.raises(RuntimeError):
+            client.get_client()
+        with pytest.raises(RuntimeError):
+            await client.request("GET", "http://ollama/api/tags")
+        assert client.client is None
+
+        # 重新start后恢复可用
+        await client.start()
+        assert client.get_client() is not created
+        await client.close()
+
+    asyncio.run(scenario())
+
+
+def test_stats_reads_the_connection_pool():
+    client = main.OllamaHTTPClient()
+
+    async def scenario():
+        await client.start()
+        stats = client.stats()
+        await client.close()
+        return stats
+
+    stats = asyncio.run(scenario())
+    assert stats["started"]
+    assert stats["connections"] == {"total": 0, "idle": 0, "active": 0}
+
+
+def test_stats_falls_back_without_a_pool():
+    client = main.OllamaHTTPClient()
+    client.client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200)))
+    stats = client.stats()
+    assert stats["connections"] == {"total": None, "idle": None, "active": None}
+    assert stats["requests"]["total"] == 0
+    asyncio.run(client.client.aclose())
@@ -0,0 +1,175 @@
+"""熔断器与重试"""
+import asyncio
+
+import httpx
+import pytest
+
+import main
+from main import MessageType, RoleType
+
+
+def test_breaker_opens_after_threshold_and_probes_after_cooldown(monkeypatch):
+    monkeypatch.setattr(main, "OLLAMA_BREAKER_THRESHOLD", 2)
+    breaker = main.CircuitBreaker()
+
+    assert not breaker.record_failure()
+    assert breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.available()
+
+    # 冷却结束后只放行一个探测请求
+    monkeypatch.setattr(main, "OLLAMA_BREAKER_COOLDOWN", 0.0)
+    assert breaker.available()
+    breaker.on_admit()
+    assert breaker.state == "half_open"
+    assert not breaker.available()
+
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.available()
+
+
+def test_failed_probe_reopens_breaker(monkeypatch):
+    monkeypatch.setattr(main, "OLLAMA_BREAKER_THRESHOLD", 1)
+    monkeypatch.setattr(main, "OLLAMA_BREAKER_COOLDOWN", 0.0)
+    breaker = main.CircuitBreaker()
+    breaker.record_failure()
+    breaker.on_admit()
+    assert breaker.record_failure()
+    assert breaker.state == "open"
+    assert breaker.opens_total == 2
+
+
+def test_cancelled_probe_allows_next_probe(monkeypatch):
+    monkeypatch.setattr(main, "OLLAMA_BREAKER_THRESHOLD", 1)
+    monkeypatch.setattr(main, "OLLAMA_BREAKER_COOLDOWN", 0.0)
+    breaker = main.CircuitBreaker()
+    breaker.record_failure()
+    breaker.on_admit()
+    breaker.on_release()
+    assert breaker.state == "open"
+    assert breaker.available()
+
+
+def test_retries_server_errors_then_succeeds(fake_ollama):
+    async def scenario():
+        calls = []
+
+        def handler(request):
+            calls.append(request.url.path)
+            if len(calls) == 1:
+                return httpx.Response(503)
+            return httpx.Response(200, json={"done": True})
+
+        fake_ollama(handler)
+        pool = main.OllamaBackendPool(["http://a:11434"])
+        response = await pool.post("/api/chat", json={})
+        assert response.status_code == 200
+        assert len(calls) == 2
+        assert pool.retries_total == 1
+        assert pool.backends[0].breaker.state == "closed"
+
+    asyncio.run(scenario())
+
+
+def test_does_not_retry_errors_after_request_was_sent(fake_ollama):
+    async def scenario():
+        calls = []
+
+        def handler(request):
+            calls.append(request.url.path)
+            raise httpx.ReadTimeout("read timed out", request=request)
+
+        fake_ollama(handler)
+        pool = main.OllamaBackendPool(["http://a:11434"])
+        with pytest.raises(httpx.ReadTimeout):
+            await pool.post("/api/chat", json={})
+        assert len(calls) == 1
+        # 读超时不代表主机不可达，不剔除
+        assert pool.backends[0].healthy
+
+    asyncio.run(scenario())
+
+
+def test_retryable_errors_are_connection_level_only():
+    request = httpx.Request("POST", "http://a:11434/api/chat")
+    assert main.is_retryable_error(httpx.ConnectError("refused", request=request))
+    assert main.is_retryable_error(httpx.ConnectTimeout("timeout", request=request))
+    assert not main.is_retryable_error(httpx.ReadTimeout("timeout", request=request))
+    assert not main.is_retryable_error(ValueError("bad json"))
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.frames = []
+
+    async def send_text(self, frame):
+        self.frames.append(frame)
+
+
+def test_unreachable_host_reports_one_error_for_all_queued_calls(fake_ollama, sessions, monkeypatch):
+    def handler(request):
+        raise httpx.ConnectError("connection refused", request=request)
+
+    fake_ollama(handler)
+    pool = main.OllamaBackendPool(["http://a:11434|2"])
+    monkeypatch.setattr(main, "ollama_backends", pool)
+    monkeypatch.setattr(main, "SUMMARY_TRIGGER_MESSAGES", 0)
+    monkeypatch.setattr(main.model_router, "model_for", lambda task: "m")
+
+    async def scenario():
+        state = sessions.get("s")
+        state.websocket_connections.append(FakeWebSocket())
+        main._current_session.set(state)
+        results = await asyncio.gather(*(main.call_ollama_api(f"提示词{i}", RoleType.PRODUCT_AI) for i in range(10)))
+        assert results == [None] * 10
+
+        errors = [message for message in state.messages.range(1) if message.message_type == MessageType.ERROR]
+        assert len(errors) == 1
+        assert "http://a:11434" in errors[0].content
+        assert not pool.backends[0].healthy
+
+        # 主机被剔除期间的新请求同样静默地快速失败
+        with pytest.raises(main.OllamaCircuitOpenError):
+            await pool.post("/api/chat", model="m", json={})
+
+    asyncio.run(scenario())
+
+
+def test_model_missing_everywhere_is_not_reported_as_outage(fake_ollama):
+    async def scenario():
+        def handler(request):
+            return httpx.Response(200, json={"models": [{"name": "small:latest"}]})
+
+        fake_ollama(handler)
+        pool = main.OllamaBackendPool(["http://a:11434"])
+        await pool.refresh()
+        with pytest.raises(main.OllamaBackendUnavailable) as error:
+            await pool.post("/api/chat", model="missing:latest", json={})
+        assert not isinstance(error.value, main.OllamaCircuitOpenError)
+
+    asyncio.run(scenario())
+
+
+def test_ejected_host_returns_after_health_check(fake_ollama):
+    async def scenario():
+        down = [True]
+
+        def handler(request):
+            if down[0]:
+                raise httpx.ConnectError("connection refused", request=request)
+            if request.url.path == "/api/tags":
+                return httpx.Response(200, json={"models": []})
+            return httpx.Response(200, json={"done": True})
+
+        fake_ollama(handler)
+        pool = main.OllamaBackendPool(["http://a:11434"])
+        with pytest.raises(main.OllamaCircuitOpenError):
+            await pool.post("/api/chat", json={})
+
+        down[0] = False
+        await pool.refresh()
+        assert pool.backends[0].healthy
+        assert (await pool.post("/api/chat", json={})).status_code == 200
+
+    asyncio.run(scenario())
@@ -0,0 +1,69 @@
+"""判别结果缓存：LRU淘汰、TTL过期、按模型划分命名空间和持久化"""
+import asyncio
+
+import main
+
+
+def test_evicts_least_recently_used_entry():
+    cache = main.ResponseCache(2, 60)
+    cache.put("m", "a", "1")
+    cache.put("m", "b", "2")
+    assert cache.get("m", "a") == "1"
+    cache.put("m", "c", "3")
+
+    assert cache.get("m", "b") is None
+    assert cache.get("m", "a") == "1"
+    assert cache.get("m", "c") == "3"
+    assert cache.evictions == 1
+
+
+def test_expired_entries_are_misses(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "time", lambda: now[0])
+    cache = main.ResponseCache(10, 60)
+    cache.put("m", "a", "1")
+    now[0] += 59
+    assert cache.get("m", "a") == "1"
+    now[0] += 1
+    assert cache.get("m", "a") is None
+    assert cache.stats()["entries"] == 0
+    assert (cache.hits["m"], cache.misses["m"]) == (1, 1)
+
+
+def test_models_have_separate_namespaces():
+    cache = main.ResponseCache(10, 60)
+    cache.put("small", "a", "1")
+    cache.put("big", "a", "2")
+    assert cache.get("small", "a") == "1"
+    assert cache.get("big", "a") == "2"
+
+    cache.clear("small")
+    assert cache.get("small", "a") is None
+    assert cache.get("big", "a") == "2"
+    assert set(cache.stats()["namespaces"]) == {"big"}
+
+
+def test_persists_unexpired_entries(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache.json")
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "time", lambda: now[0])
+
+    async def scenario():
+        cache = main.ResponseCache(10, 60, path)
+        cache.put("m", "old", "1")
+        now[0] += 30
+        cache.put("m", "new", "2")
+        # close取消延迟写入并立即保存
+        await cache.close()
+
+        now[0] += 40
+        restored = main.ResponseCache(10, 60, path)
+        await restored.load()
+        assert restored.get("m", "new") == "2"
+        assert restored.get("m", "old") is None
+
+        smaller = main.ResponseCache(1, 60, path)
+        await smaller.load()
+        assert smaller.stats()["entries"] == 1
+
+    asyncio.run(scenario())
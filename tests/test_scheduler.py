@@ -0,0 +1,89 @@
+"""优先级调度：优先级准入、老化和指定主机"""
+import asyncio
+
+import main
+from main import RequestPriority
+
+
+def make_pool(*hosts):
+    return main.OllamaBackendPool(list(hosts) or ["http://a:11434|1"])
+
+
+def test_higher_priority_is_admitted_first():
+    async def scenario():
+        scheduler = make_pool().scheduler
+        held = await scheduler.acquire(None, RequestPriority.INTERACTIVE)
+        batch = asyncio.create_task(scheduler.acquire(None, RequestPriority.BATCH))
+        interactive = asyncio.create_task(scheduler.acquire(None, RequestPriority.INTERACTIVE))
+        await asyncio.sleep(0)
+
+        scheduler.release(held)
+        await asyncio.sleep(0)
+        assert interactive.done() and not batch.done()
+
+        scheduler.release(interactive.result())
+        await asyncio.sleep(0)
+        assert batch.done()
+        scheduler.release(batch.result())
+
+    asyncio.run(scenario())
+
+
+def test_aged_low_priority_request_overtakes_new_interactive():
+    async def scenario():
+        scheduler = make_pool().scheduler
+        held = await scheduler.acquire(None, RequestPriority.INTERACTIVE)
+        batch = asyncio.create_task(scheduler.acquire(None, RequestPriority.BATCH))
+        await asyncio.sleep(0)
+        # 排队时间足够长后，有效优先级超过刚到达的交互请求
+        scheduler._waiters[0].enqueued_at -= main.OLLAMA_PRIORITY_AGING_SECONDS * (RequestPriority.BATCH + 1)
+        interactive = asyncio.create_task(scheduler.acquire(None, RequestPriority.INTERACTIVE))
+        await asyncio.sleep(0)
+
+        scheduler.release(held)
+        await asyncio.sleep(0)
+        assert batch.done() and not interactive.done()
+        assert scheduler.admitted["batch"] == 1
+
+        scheduler.release(batch.result())
+        await asyncio.sleep(0)
+        assert interactive.done()
+        scheduler.release(interactive.result())
+
+    asyncio.run(scenario())
+
+
+def test_targeted_request_waits_for_its_host():
+    async def scenario():
+        pool = make_pool("http://a:11434|1", "http://b:11434|1")
+        scheduler = pool.scheduler
+        a, b = pool.backends
+        held = await scheduler.acquire(None, RequestPriority.INTERACTIVE, target=a)
+        assert held is a
+
+        warmup = asyncio.create_task(scheduler.acquire(None, RequestPriority.BATCH, target=a))
+        await asyncio.sleep(0)
+        # b空闲也不会被使用
+        assert not warmup.done() and b.outstanding == 0
+
+        scheduler.release(held)
+        await asyncio.sleep(0)
+        assert warmup.result() is a
+        scheduler.release(a)
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_is_removed_from_queue():
+    async def scenario():
+        scheduler = make_pool().scheduler
+        held = await scheduler.acquire(None, RequestPriority.INTERACTIVE)
+        waiting = asyncio.create_task(scheduler.acquire(None, RequestPriority.SUMMARY))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert scheduler._waiters == []
+        scheduler.release(held)
+        assert held.outstanding == 0
+
+    asyncio.run(scenario())
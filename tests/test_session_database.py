@@ -0,0 +1,86 @@
+"""会话数据库：合并提交、后台写入和会话恢复数据"""
+import asyncio
+import os
+
+import main
+from main import MessageRecord, MessageType, RoleType
+
+
+def record(seq):
+    return MessageRecord(RoleType.HUMAN, MessageType.USER_INPUT, f"m{seq}", id=f"id-{seq}", seq=seq)
+
+
+def test_pending_writes_commit_in_one_transaction(tmp_path):
+    async def scenario():
+        db = main.SessionDatabase(str(tmp_path / "sessions.db"), 10, 1000)
+        db.open()
+        for seq in range(1, 51):
+            db.save_message("s", record(seq))
+        db.save_session("s", "m", {"summary_attempted": 0})
+        assert db.committed == {}
+
+        await db.flush()
+        assert (db.commits, db.rows_written, db.max_commit_rows) == (1, 51, 51)
+        assert db.committed == {"s": 50}
+        messages = db.read_messages("SELECT data FROM messages WHERE session_id = ? ORDER BY seq", ("s",))
+        assert [message.content for message in messages] == [f"m{seq}" for seq in range(1, 51)]
+        await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_background_writer_flushes_on_interval_and_full_batch(tmp_path):
+    async def scenario():
+        db = main.SessionDatabase(str(tmp_path / "sessions.db"), 0.01, 1000)
+        await db.start()
+        db.save_message("s", record(1))
+        await asyncio.sleep(0.1)
+        assert db.committed == {"s": 1}
+        await db.close()
+
+        # 积压达到max_batch时不等提交间隔
+        db = main.SessionDatabase(str(tmp_path / "sessions.db"), 60, 10)
+        await db.start()
+        for seq in range(2, 12):
+            db.save_message("s", record(seq))
+        await asyncio.sleep(0.1)
+        assert db.committed == {"s": 11}
+        await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_load_session_returns_metadata_and_checkpoints(tmp_path):
+    async def scenario():
+        db = main.SessionDatabase(str(tmp_path / "sessions.db"), 10, 1000)
+        db.open()
+        for seq in range(1, 4):
+            db.save_message("s", record(seq))
+        db.save_summary("s", main.SummaryCheckpoint("k", "总结", 2))
+        db.save_session("s", "qwen:7b", {"summary_attempted": 2, "last_discrimination": "3"})
+        await db.flush()
+
+        data = db.load_session("s")
+        assert (data["exists"], data["persisted"], data["count"], data["last_seq"]) == (True, True, 3, 3)
+        assert data["selected_model"] == "qwen:7b"
+        assert data["snapshot"] == {"summary_attempted": 2, "last_discrimination": "3"}
+        assert [(c.summary, c.covered) for c in data["summaries"]] == [("总结", 2)]
+
+        assert db.has_session("s")
+        assert not db.has_session("other")
+        assert not db.load_session("other")["exists"]
+        await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_temporary_database_is_removed_on_close():
+    async def scenario():
+        db = main.SessionDatabase("", 10, 1000)
+        db.open()
+        path = db.path
+        assert os.path.exists(path)
+        await db.close()
+        assert not os.path.exists(path)
+
+    asyncio.run(scenario())
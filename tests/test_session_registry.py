@@ -0,0 +1,130 @@
+"""会话表：空闲淘汰、内存预算和从磁盘恢复"""
+import asyncio
+
+import main
+from main import MessageRecord, MessageType, RoleType
+
+
+def add_messages(state, count):
+    for i in range(count):
+        state.messages.append(MessageRecord(RoleType.HUMAN, MessageType.USER_INPUT, f"{state.session_id}-{i}"))
+
+
+def test_evicted_session_is_rehydrated_from_disk(sessions):
+    async def scenario():
+        state = sessions.get("a")
+        state.selected_model = "qwen:7b"
+        state.last_discrimination = "3"
+        add_messages(state, 5)
+
+        assert await sessions.evict(state)
+        assert sessions.sessions() == []
+        assert main.session_db.has_session("a")
+
+        restored = sessions.get("a")
+        assert restored is not state
+        assert sessions.rehydrations == 1
+        assert (len(restored.messages), restored.messages.last_seq) == (5, 5)
+        assert restored.messages.get(5).content == "a-4"
+        assert restored.last_discrimination == "3"
+        assert restored.persisted
+
+        # 恢复后继续编号
+        add_messages(restored, 1)
+        assert restored.messages.last_seq == 6
+
+    asyncio.run(scenario())
+
+
+def test_empty_session_is_dropped_without_a_row(sessions):
+    async def scenario():
+        state = sessions.get("empty")
+        assert state.is_empty()
+        assert await sessions.evict(state)
+        await main.session_db.flush()
+        assert not main.session_db.has_session("empty")
+        assert main.session_db.count_sessions() == 0
+
+    asyncio.run(scenario())
+
+
+def test_find_does_not_create_sessions(sessions):
+    assert sessions.find("unknown") is None
+    assert sessions.sessions() == []
+
+    async def scenario():
+        state = sessions.get("known")
+        add_messages(state, 1)
+        await sessions.evict(state)
+
+    asyncio.run(scenario())
+    assert sessions.find("known").messages.last_seq == 1
+
+
+def test_sweep_skips_busy_sessions(sessions, monkeypatch):
+    monkeypatch.setattr(main, "SESSION_IDLE_SECONDS", 0.0)
+
+    async def scenario():
+        connected = sessions.get("connected")
+        connected.websocket_connections.append(object())
+        running = sessions.get("running")
+        idle = sessions.get("idle")
+        for state in (connected, running, idle):
+            add_messages(state, 1)
+
+        async with running.turn_lock:
+            await sessions.sweep()
+        assert {state.session_id for state in sessions.sessions()} == {"connected", "running"}
+        assert sessions.evictions == 1
+
+    asyncio.run(scenario())
+
+
+def test_memory_budget_evicts_least_recently_used_first(sessions, monkeypatch):
+    async def scenario():
+        old, recent = sessions.get("old"), sessions.get("recent")
+        add_messages(old, 10)
+        add_messages(recent, 10)
+        sessions.touch(recent)
+        # 预算只容得下一个会话
+        budget = old.messages.resident_bytes + recent.messages.resident_bytes - 1
+        monkeypatch.setattr(main, "SESSION_MEMORY_BUDGET_MB", budget / 1024 / 1024)
+        await sessions.sweep()
+        assert [state.session_id for state in sessions.sessions()] == ["recent"]
+
+    asyncio.run(scenario())
+
+
+def test_session_reused_during_eviction_stays_resident(sessions):
+    async def scenario():
+        state = sessions.get("a")
+        add_messages(state, 1)
+        flush = main.session_db.flush
+
+        async def flush_and_reconnect():
+            await flush()
+            state.websocket_connections.append(object())
+
+        main.session_db.flush = flush_and_reconnect
+        assert not await sessions.evict(state)
+        assert sessions.sessions() == [state]
+
+    asyncio.run(scenario())
+
+
+def test_selected_model_survives_while_it_is_unavailable(sessions):
+    async def scenario():
+        sessions.default_model = "default:latest"
+        state = sessions.get("a")
+        state.selected_model = "qwen:7b"
+        add_messages(state, 1)
+        await sessions.evict(state)
+
+        # 没有健康主机列出该模型时也恢复用户的选择，再次淘汰时不会被默认模型覆盖
+        assert "qwen:7b" not in main.ollama_backends.list_models()
+        restored = sessions.get("a")
+        assert restored.selected_model == "qwen:7b"
+        await sessions.evict(restored)
+        assert main.session_db.load_session("a")["selected_model"] == "qwen:7b"
+
+    asyncio.run(scenario())
@@ -0,0 +1,118 @@
+"""合并相同的在途请求：共享结果、订阅者和取消"""
+import asyncio
+
+import pytest
+
+import main
+
+
+def test_concurrent_callers_share_one_upstream_call():
+    async def scenario():
+        flight = main.SingleFlight()
+        release = asyncio.Event()
+        calls = []
+
+        async def fn(subscribers):
+            calls.append(subscribers)
+            await release.wait()
+            return {"answer": 42}
+
+        waiters = [asyncio.create_task(flight.do("k", fn)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        assert len(calls) == 1
+        assert flight.stats()["in_flight"] == 1
+
+        release.set()
+        assert await asyncio.gather(*waiters) == [{"answer": 42}] * 3
+        assert (flight.leaders, flight.shared) == (1, 2)
+        assert flight.stats()["in_flight"] == 0
+
+        # 完成后不再合并，新的调用重新发起
+        release.set()
+        await flight.do("k", fn)
+        assert len(calls) == 2
+
+    asyncio.run(scenario())
+
+
+def test_different_keys_are_not_merged():
+    async def scenario():
+        flight = main.SingleFlight()
+
+        async def fn(subscribers):
+            await asyncio.sleep(0)
+            return object()
+
+        first, second = await asyncio.gather(flight.do("a", fn), flight.do("b", fn))
+        assert first is not second
+        assert flight.leaders == 2
+
+    asyncio.run(scenario())
+
+
+def test_errors_reach_every_waiter():
+    async def scenario():
+        flight = main.SingleFlight()
+
+        async def fn(subscribers):
+            await asyncio.sleep(0)
+            raise main.OllamaAPIError("Ollama API调用失败: 500")
+
+        results = await asyncio.gather(flight.do("k", fn), flight.do("k", fn), return_exceptions=True)
+        assert all(isinstance(result, main.OllamaAPIError) for result in results)
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_leaves_shared_call_running():
+    async def scenario():
+        flight = main.SingleFlight()
+        release = asyncio.Event()
+
+        async def fn(subscribers):
+            await release.wait()
+            return "done"
+
+        first = asyncio.create_task(flight.do("k", fn, subscriber="a"))
+        second = asyncio.create_task(flight.do("k", fn, subscriber="b"))
+        await asyncio.sleep(0)
+        task, subscribers = flight._inflight["k"]
+        assert subscribers == ["a", "b"]
+
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        # 离开的等待者不再接收推送，上游请求继续为其余等待者服务
+        assert subscribers == ["b"]
+        assert not task.cancelled()
+
+        release.set()
+        assert await second == "done"
+        assert subscribers == []
+        assert flight.cancelled == 0
+
+    asyncio.run(scenario())
+
+
+def test_last_waiter_leaving_cancels_upstream_call():
+    async def scenario():
+        flight = main.SingleFlight()
+        upstream_cancelled = asyncio.Event()
+
+        async def fn(subscribers):
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                upstream_cancelled.set()
+                raise
+
+        waiters = [asyncio.create_task(flight.do("k", fn)) for _ in range(2)]
+        await asyncio.sleep(0)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.wait_for(upstream_cancelled.wait(), 1)
+        assert flight.cancelled == 1
+        assert flight._refs == {}
+
+    asyncio.run(scenario())
@@ -0,0 +1,115 @@
+"""推测执行：广播闸门、命中时放行、未命中时丢弃并重新生成"""
+import asyncio
+
+import pytest
+
+import main
+from main import RoleType
+
+DISCRIMINATION_MAP = main.AI_PROMPTS[RoleType.PRODUCT_AI]["discrimination_map"]
+
+
+def test_gate_holds_broadcasts_until_opened(monkeypatch):
+    delivered = []
+
+    async def deliver_event(payload, state=None):
+        delivered.append(payload["n"])
+
+    monkeypatch.setattr(main, "_deliver_event", deliver_event)
+
+    async def scenario():
+        gate = main.BroadcastGate()
+
+        async def speculative():
+            await main.broadcast_event({"n": 1})
+            await main.broadcast_event({"n": 2})
+
+        await main._run_gated(gate, speculative())
+        assert delivered == []
+        assert [item["n"] for item in gate.pending] == [1, 2]
+
+        await gate.open()
+        assert delivered == [1, 2]
+        # 放行后直通
+        await main._run_gated(gate, main.broadcast_event({"n": 3}))
+        assert delivered == [1, 2, 3]
+
+        # 不在推测任务中的广播不受闸门影响
+        await main.broadcast_event({"n": 4})
+        assert delivered == [1, 2, 3, 4]
+
+    asyncio.run(scenario())
+
+
+@pytest.fixture
+def speculative_turn(monkeypatch):
+    """判别结果可控、产品AI只推送事件的推测执行环境，log按实际发出的顺序记录"""
+    log = []
+    setup = {"predicted": "1", "actual": "1"}
+
+    async def discriminate(content, role):
+        await asyncio.sleep(0.02)
+        return setup["actual"]
+
+    async def broadcast_discrimination(discrimination):
+        log.append(("discrimination", discrimination))
+
+    async def product_ai(content, about):
+        await main.broadcast_event({"about": about.value, "part": "start"})
+        await asyncio.sleep(0.05)
+        await main.broadcast_event({"about": about.value, "part": "end"})
+
+    async def deliver_event(payload, state=None):
+        log.append((payload["about"], payload["part"]))
+
+    monkeypatch.setattr(main, "trigger_discrimination_ai", discriminate)
+    monkeypatch.setattr(main, "broadcast_discrimination", broadcast_discrimination)
+    monkeypatch.setattr(main, "trigger_product_ai", product_ai)
+    monkeypatch.setattr(main, "_deliver_event", deliver_event)
+    monkeypatch.setattr(main, "predict_discrimination", lambda content, role: setup["predicted"])
+    monkeypatch.setattr(main.model_router, "model_for", lambda task: "m")
+    monkeypatch.setattr(main.ollama_backends.scheduler, "free_slots", lambda model: 4)
+    stats = main.SpeculationStats()
+    monkeypatch.setattr(main, "speculation_stats", stats)
+    return setup, log, stats
+
+
+def test_hit_releases_speculative_reply_after_discrimination(speculative_turn):
+    setup, log, stats = speculative_turn
+    about = DISCRIMINATION_MAP["1"].value
+    asyncio.run(main.run_speculative_product_turn("我想做一个记账应用"))
+    assert log == [("discrimination", "1"), (about, "start"), (about, "end")]
+    assert (stats.attempts, stats.hits, stats.misses) == (1, 1, 0)
+
+
+def test_miss_discards_speculative_reply_and_regenerates(speculative_turn):
+    setup, log, stats = speculative_turn
+    setup["actual"] = "3"
+    about = DISCRIMINATION_MAP["3"].value
+    asyncio.run(main.run_speculative_product_turn("为什么要用数据库"))
+    # 预测分支的输出一条都没有发出
+    assert log == [("discrimination", "3"), (about, "start"), (about, "end")]
+    assert (stats.attempts, stats.hits, stats.misses) == (1, 0, 1)
+
+
+def test_skips_speculation_without_spare_capacity(speculative_turn, monkeypatch):
+    setup, log, stats = speculative_turn
+    monkeypatch.setattr(main.ollama_backends.scheduler, "free_slots", lambda model: 1)
+    asyncio.run(main.run_speculative_product_turn("我想做一个记账应用"))
+    assert log[0] == ("discrimination", "1")
+    assert (stats.attempts, stats.skipped) == (0, 1)
+
+
+def test_cancelled_turn_cancels_speculation(speculative_turn):
+    setup, log, stats = speculative_turn
+
+    async def scenario():
+        turn = asyncio.create_task(main.run_speculative_product_turn("我想做一个记账应用"))
+        await asyncio.sleep(0.01)
+        turn.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await turn
+        await asyncio.sleep(0.1)
+
+    asyncio.run(scenario())
+    assert log == []
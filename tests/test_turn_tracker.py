@@ -0,0 +1,175 @@
+"""对话轮次的取消：停止、新输入覆盖和断开连接"""
+import asyncio
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def turns(sessions, monkeypatch):
+    """handle_human_input替换为一直等待的轮次，记录开始、取消和推送的事件"""
+    log = []
+
+    async def handle(content):
+        log.append(("start", content))
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            log.append(("cancelled", content))
+            raise
+
+    async def broadcast(payload):
+        log.append(("event", payload["type"], payload["reason"]))
+
+    monkeypatch.setattr(main, "handle_human_input", handle)
+    monkeypatch.setattr(main, "broadcast_event", broadcast)
+    return main.TurnTracker(), log
+
+
+def test_cancel_stops_the_running_turn(turns):
+    tracker, log = turns
+
+    async def scenario():
+        tracker.start("c1", "你好")
+        await asyncio.sleep(0)
+        assert await tracker.cancel("c1", "用户停止")
+        assert log == [("start", "你好"), ("cancelled", "你好"), ("event", "generation_cancelled", "用户停止")]
+        assert tracker.stats()["active"] == 0
+        assert tracker.stats()["cancelled"] == {"用户停止": 1}
+        # 没有进行中的轮次时不推送事件
+        assert not await tracker.cancel("c1", "用户停止")
+        assert len(log) == 3
+
+    asyncio.run(scenario())
+
+
+def test_new_input_supersedes_previous_turn(turns):
+    tracker, log = turns
+
+    async def scenario():
+        tracker.start("c1", "第一条")
+        await asyncio.sleep(0)
+        await tracker.cancel("c1", "新输入覆盖")
+        tracker.start("c1", "第二条")
+        await asyncio.sleep(0)
+        assert ("cancelled", "第一条") in log
+        assert log[-1] == ("start", "第二条")
+        assert tracker.stats()["active"] == 1
+        await tracker.cancel("c1", "连接断开")
+
+    asyncio.run(scenario())
+
+
+def test_connections_are_cancelled_independently(turns):
+    tracker, log = turns
+
+    async def scenario():
+        tracker.start("c1", "一")
+        tracker.start("c2", "二")
+        await asyncio.sleep(0)
+        await tracker.cancel("c1", "连接断开")
+        assert ("cancelled", "二") not in log
+        assert not tracker.turns["c2"].done()
+        await tracker.cancel("c2", "连接断开")
+        assert tracker.stats()["cancelled"] == {"连接断开": 2}
+
+    asyncio.run(scenario())
+
+
+def test_finished_turn_is_forgotten(sessions, monkeypatch):
+    async def handle(content):
+        return None
+
+    monkeypatch.setattr(main, "handle_human_input", handle)
+    tracker = main.TurnTracker()
+
+    async def scenario():
+        tracker.start("c1", "你好")
+        await asyncio.sleep(0.01)
+        assert tracker.turns == {}
+        assert not await tracker.cancel("c1", "用户停止")
+
+    asyncio.run(scenario())
+
+
+@pytest.fixture
+def shared_turns(sessions, monkeypatch):
+    """使用真实的handle_human_input，只把一轮的处理替换为一直等待，log记录实际开始的轮次和推送的事件"""
+    log = []
+
+    async def handle(content):
+        log.append(("start", main.current_state().session_id, content))
+        await asyncio.Event().wait()
+
+    async def broadcast(payload):
+        log.append(("event", payload["type"], payload["reason"]))
+
+    monkeypatch.setattr(main, "_handle_human_input", handle)
+    monkeypatch.setattr(main, "broadcast_event", broadcast)
+    monkeypatch.setattr(main, "turn_singleflight", main.SingleFlight())
+    return sessions, main.TurnTracker(), log
+
+
+def start_in(session, tracker, connection_id, content):
+    """在会话的上下文中开始一轮，与WebSocket处理函数中一样"""
+    main._current_session.set(session)
+    tracker.start(connection_id, content)
+
+
+def test_identical_input_from_two_tabs_runs_one_turn(shared_turns):
+    sessions, tracker, log = shared_turns
+
+    async def scenario():
+        session = sessions.get("s")
+        start_in(session, tracker, "tab1", "你好")
+        start_in(session, tracker, "tab2", "你好")
+        await asyncio.sleep(0.01)
+        assert log == [("start", "s", "你好")]
+        assert tracker.stats()["coalesced"] == 1
+
+        # 一个标签页停止时另一个仍在等待，这一轮继续，不推送取消事件
+        await tracker.cancel("tab1", "用户停止")
+        assert main.turn_singleflight.stats()["in_flight"] == 1
+        assert not any(entry[0] == "event" for entry in log)
+
+        await tracker.cancel("tab2", "用户停止")
+        await asyncio.sleep(0)
+        assert main.turn_singleflight.stats() == {"in_flight": 0, "leaders": 1, "shared": 1, "cancelled": 1}
+        assert log[-1] == ("event", "generation_cancelled", "用户停止")
+
+    asyncio.run(scenario())
+
+
+def test_different_sessions_or_content_are_not_coalesced(shared_turns):
+    sessions, tracker, log = shared_turns
+
+    async def scenario():
+        start_in(sessions.get("a"), tracker, "c1", "你好")
+        start_in(sessions.get("b"), tracker, "c2", "你好")
+        start_in(sessions.get("a"), tracker, "c3", "再见")
+        await asyncio.sleep(0.01)
+        # 会话a的第二条输入不同，单独排在第一轮之后
+        assert sorted(log) == [("start", "a", "你好"), ("start", "b", "你好")]
+        assert main.turn_singleflight.stats()["leaders"] == 3
+        for connection_id in ("c1", "c2", "c3"):
+            await tracker.cancel(connection_id, "连接断开")
+
+    asyncio.run(scenario())
+
+
+def test_resending_on_the_same_connection_starts_a_new_turn(shared_turns):
+    sessions, tracker, log = shared_turns
+
+    async def scenario():
+        session = sessions.get("s")
+        start_in(session, tracker, "tab1", "你好")
+        await asyncio.sleep(0.01)
+        # 同一连接的新输入先取消上一轮，不会并入正在取消的那一轮
+        await tracker.cancel("tab1", "新输入覆盖")
+        start_in(session, tracker, "tab1", "你好")
+        await asyncio.sleep(0.01)
+        assert [entry for entry in log if entry[0] == "start"] == [("start", "s", "你好")] * 2
+        await tracker.cancel("tab1", "连接断开")
+
+    asyncio.run(scenario())
@@ -0,0 +1,59 @@
+"""WebSocket握手：新连接的初始快照与重连补发"""
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from main import MessageRecord, MessageType, RoleType
+
+
+@pytest.fixture
+def client(sessions):
+    state = sessions.get("hs")
+    for i in range(120):
+        state.messages.append(MessageRecord(RoleType.HUMAN, MessageType.USER_INPUT, f"m{i + 1}"))
+    return TestClient(main.app)
+
+
+def handshake(client, query=""):
+    with client.websocket_connect(f"/ws?session=hs{query}") as websocket:
+        return websocket.receive_json()
+
+
+def seqs(frame):
+    return [message["seq"] for message in frame["messages"]]
+
+
+@pytest.mark.parametrize("query", ["", "&since=0"])
+def test_fresh_client_gets_recent_snapshot_and_cursor(client, query):
+    frame = handshake(client, query)
+    assert frame["type"] == "connection_established"
+    assert frame["reset"] is True
+    assert seqs(frame) == list(range(121 - main.WS_INITIAL_SNAPSHOT, 121))
+    assert main.decode_history_cursor("hs", frame["cursor"]) == 121 - main.WS_INITIAL_SNAPSHOT
+    assert frame["last_seq"] == 120
+
+
+def test_reconnect_replays_only_missing_messages(client):
+    frame = handshake(client, "&since=115")
+    assert frame["reset"] is False
+    assert seqs(frame) == [116, 117, 118, 119, 120]
+    assert frame["cursor"] is None
+
+
+def test_up_to_date_client_gets_nothing(client):
+    frame = handshake(client, "&since=120")
+    assert (frame["reset"], frame["messages"]) == (False, [])
+
+
+@pytest.mark.parametrize("since", ["200", "10", "abc"])
+def test_ahead_far_behind_or_invalid_since_resets(client, monkeypatch, since):
+    monkeypatch.setattr(main, "WS_REPLAY_LIMIT", 50)
+    frame = handshake(client, f"&since={since}")
+    assert frame["reset"] is True
+    assert len(frame["messages"]) == main.WS_INITIAL_SNAPSHOT
+
+
+def test_empty_session_handshake(sessions):
+    with TestClient(main.app).websocket_connect("/ws?session=new&since=0") as websocket:
+        frame = websocket.receive_json()
+    assert (frame["reset"], frame["messages"], frame["cursor"], frame["last_seq"]) == (True, [], None, 0)